@@ -32,6 +32,11 @@ DATABASE_PORT = ""
 DATABASE_OPTIONS = {
 }
 
+# Database connection pool options (min_size, max_size, idle_timeout,
+# max_lifetime, pre_ping, wait_timeout), ignored if DATABASE_ENGINE is 'gae'
+DATABASE_POOL = {
+}
+
 # Enable/Disable internationalization support
 USE_I18N = True
 
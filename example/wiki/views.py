@@ -168,7 +168,8 @@ def index():
 
 @web.route('/Spacial:Recent_Changes')
 def changes():
-    page = max(1, request.args.get('page', type=int))
     query = Revision.all().order('-timestamp')
     return web.render_template('changes.html',
-        pagination=Pagination(query, 20, page, 'changes'))
+        pagination=Pagination(query, 20, 'changes',
+                              after=request.args.get('after'),
+                              before=request.args.get('before')))
@@ -8,12 +8,25 @@ database specific admin tasks.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LINCESE for more details.
 """
+import os
+import csv
 import sys
+import gzip
+import base64
+import decimal
+import datetime
+import threading
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 from kalapy import db
 from kalapy.admin import ActionCommand
 from kalapy.conf import settings
 from kalapy.db.engines import database
+from kalapy.db.session import _rank
 
 
 try:
@@ -46,6 +59,9 @@ class DBCommand(ActionCommand):
 
     options = (
         ('f', 'force', False, 'do not ask questions'),
+        ('b', 'batch-size', 1000, 'number of records to read or write at a time'),
+        ('F', 'format', 'json', 'format of the dumped files, json or csv'),
+        ('j', 'jobs', 1, 'number of tables to dump or load at a time'),
     )
 
     def execute(self, options, args):
@@ -114,7 +130,7 @@ class DBCommand(ActionCommand):
 
     def action_sync(self, options, args):
         """Create the database tables for all the INSTALLED_PACKAGES whose
-        tables haven't been created yet.
+        tables haven't been created yet, and the missing indexes.
         """
         models, __pending = self.get_models()
         try:
@@ -178,3 +194,307 @@ Are you sure about this action? (y/N): """ % settings.DATABASE_NAME)
             raise
         else:
             database.commit()
+
+    def action_dump(self, options, args):
+        """Dump the records of all the tables (or the tables of the given
+        packages) to the given directory, a gzipped JSON-lines or CSV file per
+        table (for example, `dump backup blog`).
+
+        The tables are read in a single transaction reading a consistent
+        snapshot of the database. The tables dumped at a time with `jobs`
+        share the snapshot on PostgreSQL only, on the other engines every
+        job reads its own snapshot, so the dump is not consistent across
+        the tables. The sharded tables are read from the shards outside the
+        snapshot.
+        """
+        if not args:
+            raise self.error('directory name required.')
+        if options.format not in ('json', 'csv'):
+            raise self.error('invalid format %r.' % options.format)
+
+        path = args[0]
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        models, __pending = self.get_models(*args[1:])
+
+        def dump(model):
+            name = os.path.join(path, '%s.%s.gz' % (model._meta.table, options.format))
+            target = open_file(name, 'wb')
+            try:
+                count = write_rows(target, name, model, options.batch_size)
+            finally:
+                target.close()
+            if options.verbose:
+                print "Dumped %d records of %r" % (count, model._meta.table)
+
+        snapshot = database.begin_snapshot()
+        if options.jobs > 1 and snapshot is None:
+            print "Warning: the jobs read separate snapshots of the database."
+        try:
+            run_jobs(dump, models, options.jobs,
+                     lambda: database.begin_snapshot(snapshot))
+        finally:
+            database.rollback()
+
+    def action_load(self, options, args):
+        """Load the records of the given model from the given file, either
+        a CSV file with the field names in the first row or a JSON-lines file
+        (.json), optionally gzipped (for example, `load blog:article
+        articles.csv.gz`). Given a directory created with `dump`, load the
+        records of all the tables found in it (for example, `load backup`).
+        """
+        if len(args) == 1 and os.path.isdir(args[0]):
+            return self.load_all(options, args[0])
+        if len(args) != 2:
+            raise self.error('model name and file name, or directory name required.')
+        try:
+            model = db.get_model(args[0])
+        except Exception, e:
+            self.error(e)
+
+        count = load_file(model, args[1], None, options.batch_size)
+        if options.verbose:
+            print "Loaded %d records into %r" % (count, model._meta.table)
+
+    def load_all(self, options, path):
+        """Load the records, keys included, of the tables dumped to the given
+        directory. The tables are loaded in the order of dependencies, the
+        tables not depending on each other at a time if `jobs` is given. Each
+        table is loaded and committed on its own.
+        """
+        files = {}
+        models, __pending = self.get_models()
+        for model in models:
+            for ext in ('.json.gz', '.csv.gz', '.json', '.csv'):
+                name = os.path.join(path, model._meta.table + ext)
+                if os.path.exists(name):
+                    files[model] = name
+                    break
+
+        ranks = {}
+        levels = {}
+        for model in models:
+            if model in files:
+                levels.setdefault(_rank(model, ranks), []).append(model)
+
+        # concurrent writes are serialized by SQLite anyway
+        jobs = options.jobs
+        if settings.DATABASE_ENGINE == 'sqlite3':
+            jobs = 1
+
+        def load(model):
+            names = [n for n, f in model.fields().items() if f.data_type is not None]
+            count = load_file(model, files[model], names, options.batch_size,
+                              restore=True)
+            if options.verbose:
+                print "Loaded %d records into %r" % (count, model._meta.table)
+
+        for level in sorted(levels):
+            run_jobs(load, levels[level], jobs)
+
+
+def run_jobs(func, items, jobs=1, setup=None):
+    """Call the given function with each of the given items. If `jobs` is more
+    than one, the function is called from that many threads at a time, each
+    with its own database connection, prepared by calling the given `setup`
+    function.
+
+    :raises: the first error raised by the function
+    """
+    if jobs < 2 or len(items) < 2:
+        for item in items:
+            func(item)
+        return
+
+    items = list(items)
+    lock = threading.Lock()
+    errors = []
+    def run():
+        database.connect()
+        try:
+            if setup is not None:
+                setup()
+            while True:
+                lock.acquire()
+                try:
+                    if errors or not items:
+                        return
+                    item = items.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    func(item)
+                except Exception:
+                    errors.append(sys.exc_info())
+        finally:
+            database.close()
+
+    threads = [threading.Thread(target=run) for i in range(min(jobs, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def load_file(model, path, names, batch_size, restore=False):
+    """Load the records of the given model from the given file (see
+    :func:`read_rows`) and commit them.
+
+    :param names: names of the fields of the JSON-lines records, by default
+                  all the fields but `key`
+    :param restore: whether to load the values as they are (see
+                    :meth:`Model.bulk_load`)
+
+    :returns: number of records loaded
+    """
+    source = open_file(path)
+    try:
+        header, rows = read_rows(source, path)
+        names = header or names
+        rows = decode_rows(model, names, rows)
+        try:
+            count = model.bulk_load(rows, names, batch_size, restore)
+        except:
+            database.rollback()
+            raise
+        else:
+            database.commit()
+    finally:
+        source.close()
+    return count
+
+def open_file(path, mode='rb'):
+    """Open the given file, gzipped if the name ends with `.gz`.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def read_rows(source, path):
+    """Read the rows of the given file, a CSV file with the field names in the
+    first row or a JSON-lines file, depending on the extension of the given
+    path.
+
+    :returns: a tuple of the list of field names (None for JSON-lines) and an
+              iterator of rows
+    """
+    if path.endswith('.gz'):
+        path = path[:-3]
+    if path.endswith('.csv'):
+        reader = csv.reader(source)
+        names = reader.next()
+        rows = ([value_from_csv(v) for v in row] for row in reader)
+        return names, rows
+    return None, (json.loads(line) for line in source if line.strip())
+
+
+def decode_rows(model, names, rows):
+    """Decode the base64 encoded values of the binary fields of the given
+    rows read with :func:`read_rows`.
+    """
+    fields = model.fields()
+    blobs = [(i, n) for i, n in enumerate(names or fields)
+             if getattr(fields.get(n), 'data_type', None) == 'blob']
+    if not blobs:
+        return rows
+    def decode(row):
+        for i, name in blobs:
+            if isinstance(row, dict):
+                i = name
+                row.setdefault(name, None)
+            if row[i] is not None:
+                row[i] = base64.b64decode(row[i])
+        return row
+    return (decode(row) for row in rows)
+
+
+def write_rows(target, path, model, batch_size=1000):
+    """Write the records of the given model, keys included, to the given file
+    as CSV with the field names in the first row or as JSON-lines, depending
+    on the extension of the given path.
+
+    The records are read in batches of the given size, each continuing from
+    the key of the last record read, so any number of records can be written
+    with constant memory.
+
+    :returns: number of records written
+    """
+    fields = [f for f in model.fields().values() if f.data_type is not None]
+    names = [f.name for f in fields]
+    blobs = [i for i, f in enumerate(fields) if f.data_type == 'blob']
+    refs = [i for i, f in enumerate(fields) if isinstance(f, db.ManyToOne)]
+    # simplejson writes decimals as numbers, read back as floats
+    decimals = [i for i, f in enumerate(fields) if isinstance(f, db.Decimal)]
+
+    if path.endswith('.gz'):
+        path = path[:-3]
+    if path.endswith('.csv'):
+        writer = csv.writer(target)
+        writer.writerow(names)
+        def write(row):
+            writer.writerow([value_to_csv(v) for v in row])
+    else:
+        def write(row):
+            target.write(json.dumps(dict(zip(names, row)), default=value_to_json))
+            target.write('\n')
+
+    count = 0
+    query = model.all().using('primary').values_list(*names)
+    for row in query.iterate(batch_size, keyset=True):
+        if blobs or refs or decimals:
+            row = list(row)
+            for i in blobs:
+                if row[i] is not None:
+                    row[i] = base64.b64encode(str(row[i]))
+            for i in refs:
+                if row[i] is not None:
+                    row[i] = row[i].key
+            for i in decimals:
+                if row[i] is not None:
+                    row[i] = str(row[i])
+        write(row)
+        count += 1
+    return count
+
+
+def value_to_json(value):
+    """Convert the values not supported by JSON to strings, which are parsed
+    back by the fields.
+    """
+    if isinstance(value, (datetime.date, datetime.time, decimal.Decimal)):
+        return str(value)
+    raise TypeError(repr(value))
+
+
+def value_to_csv(value):
+    """Convert the given value to a CSV value. None is written as ``\\N``, like
+    the text format of the engines, and a backslash is prepended to the
+    strings starting with a backslash, so empty strings, NULL values and
+    strings looking like the marker are told apart.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        if value.startswith('\\'):
+            return '\\' + value
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def value_from_csv(value):
+    """Convert the given CSV value written by :func:`value_to_csv` back to
+    unicode or None.
+    """
+    if value == '\\N':
+        return None
+    if value.startswith('\\'):
+        value = value[1:]
+    return value.decode('utf-8')
@@ -8,6 +8,16 @@ DATABASE_USER = ""
 DATABASE_PASSWORD = ""
 DATABASE_HOST = ""
 DATABASE_PORT = ""
+DATABASE_OPTIONS = {}
+DATABASE_POOL = {}
+DATABASE_REPLICAS = []
+DATABASE_SHARDS = []
+DATABASE_SHARD_KEY_RANGE = 10000000
+DATABASE_IDENTITY_MAP = False
+DATABASE_UNIT_OF_WORK = False
+
+CACHE_ENGINE = "memory"
+CACHE_OPTIONS = {}
 
 USE_I18N = True
 
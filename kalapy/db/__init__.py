@@ -15,6 +15,7 @@ from kalapy.db.fields import *
 from kalapy.db.reference import *
 from kalapy.db.model import *
 from kalapy.db.query import *
+from kalapy.db.session import *
 
 # remove module references to hide them from direct outside access
 map(lambda n: globals().pop(n), ['engines', 'model', 'fields', 'query', 'reference'])
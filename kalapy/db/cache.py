@@ -0,0 +1,401 @@
+"""
+kalapy.db.cache
+~~~~~~~~~~~~~~~
+
+This module implements the second-level model cache, which keeps the field
+values of the records of models declaring ``__cache__`` across requests, and
+the query result cache used by :meth:`Query.cached`.
+
+The cache backend is configured with ``CACHE_ENGINE`` (``memory`` or
+``memcached``) and ``CACHE_OPTIONS`` settings.
+
+:copyright: (c) 2010 Amit Mendapara.
+:license: BSD, see LICENSE for more details.
+"""
+import time
+import random
+import threading
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from werkzeug.contrib.cache import BaseCache
+from werkzeug.local import Local
+
+from kalapy.conf import settings
+
+
+__all__ = ('MemoryCache', 'get_cache')
+
+
+class MemoryCache(BaseCache):
+    """A thread-safe in-process cache bounded by number of entries and time.
+    Once the cache is full, the least recently used entries are evicted.
+
+    :param size: maximum number of entries
+    :param ttl: default timeout in seconds, 0 means never expire
+    """
+
+    def __init__(self, size=1000, ttl=300):
+        super(MemoryCache, self).__init__(ttl)
+        self.size = size
+        self.__lock = threading.Lock()
+        self.__entries = {} # key -> [expires, last used, value]
+
+    def __expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time.time() + timeout if timeout else None
+
+    def __evict(self):
+        # evict the least recently used tenth at once to amortize sorting
+        items = self.__entries.items()
+        items.sort(key=lambda item: item[1][1])
+        for key, entry in items[:max(1, len(items) // 10)]:
+            del self.__entries[key]
+
+    def get(self, key):
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                del self.__entries[key]
+                return None
+            entry[1] = time.time()
+            return entry[2]
+        finally:
+            self.__lock.release()
+
+    def set(self, key, value, timeout=None):
+        self.__lock.acquire()
+        try:
+            if key not in self.__entries and len(self.__entries) >= self.size:
+                self.__evict()
+            self.__entries[key] = [self.__expires(timeout), time.time(), value]
+        finally:
+            self.__lock.release()
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is None:
+            self.set(key, value, timeout)
+
+    def delete(self, key):
+        self.__lock.acquire()
+        try:
+            self.__entries.pop(key, None)
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__entries.clear()
+        finally:
+            self.__lock.release()
+
+    def inc(self, key, delta=1):
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__entries[key] = entry = [None, time.time(), 0]
+            entry[2] = (entry[2] or 0) + delta
+            return entry[2]
+        finally:
+            self.__lock.release()
+
+
+_cache = None
+
+def get_cache():
+    """Returns the cache backend configured with `CACHE_ENGINE` setting.
+    """
+    global _cache
+    if _cache is None:
+        opts = settings.CACHE_OPTIONS
+        if settings.CACHE_ENGINE == 'memcached':
+            from werkzeug.contrib.cache import MemcachedCache, GAEMemcachedCache
+            prefix = opts.get('key_prefix', 'kalapy:')
+            if settings.DATABASE_ENGINE == 'gae':
+                _cache = GAEMemcachedCache(0, prefix)
+            else:
+                _cache = MemcachedCache(opts.get('memcached_servers', []), 0, prefix)
+        else:
+            _cache = MemoryCache(opts.get('size', 1000), opts.get('ttl', 300))
+    return _cache
+
+
+def _token():
+    return '%x' % random.getrandbits(32)
+
+
+def _version(model):
+    """Returns the current version of the cached records of the given model.
+    The version is a random token, so an evicted version doesn't make the
+    records cached with an earlier version valid again.
+    """
+    cache = get_cache()
+    key = 'v:%s' % model._meta.table
+    version = cache.get(key)
+    if version is None:
+        version = _token()
+        cache.set(key, version, 0)
+    return version
+
+
+def bump(model):
+    """Invalidate all the cached records of the given model at once by changing
+    the version of the model.
+    """
+    _written(model, None)
+    get_cache().set('v:%s' % model._meta.table, _token(), 0)
+
+
+def _versions(tables):
+    """Returns the current versions of the given tables as a tuple, read with
+    a single cache read. Like the model versions, a table version is a random
+    token changed whenever the table is written.
+    """
+    cache = get_cache()
+    keys = ['t:%s' % t for t in tables]
+    versions = list(cache.get_many(*keys))
+    for i, version in enumerate(versions):
+        if version is None:
+            versions[i] = _token()
+            cache.set(keys[i], versions[i], 0)
+    return tuple(versions)
+
+
+def caches_queries():
+    """Whether the query result cache is enabled with the `query_cache` option
+    of `CACHE_OPTIONS` setting. The table versions are only changed if it is,
+    as that costs a cache write for every change.
+    """
+    return bool(settings.CACHE_OPTIONS.get('query_cache', False))
+
+
+def touch(model, deleted=False):
+    """Change the version of the table of the given model, which makes all the
+    cached query results involving the table stale. Nothing is changed if the
+    query result cache is not enabled (see :func:`caches_queries`).
+
+    :param model: the model whose records are changed
+    :param deleted: if True, the records are deleted and the tables referring
+                    the model are changed as well as the references might be
+                    cascaded or set to null by the database
+    """
+    models = [model]
+    if deleted:
+        for field in model._meta.virtual_fields.values():
+            models.append(getattr(field, 'm2m', None) or field.reference)
+    for m in models:
+        _written(m)
+    if not caches_queries():
+        return
+    get_cache().set_many(dict([('t:%s' % m._meta.table, _token()) for m in models]), 0)
+
+
+def query_key(tables, *args):
+    """Returns the cache key of a query result. The key depends on the given
+    args describing the query and on the current versions of the given tables
+    involved in the query.
+    """
+    value = repr((_versions(tables),) + args)
+    return 'q:%s' % md5(value).hexdigest()
+
+
+_local = Local()
+
+def _written(model, keys=()):
+    """Remember the given model, and the given keys of its records, are changed
+    by the current transaction. If keys is None, all the records might be
+    changed.
+    """
+    try:
+        written = _local.written
+    except AttributeError:
+        written = _local.written = {}
+    entry = written.setdefault(model._meta.name, [model, set()])
+    if keys is None:
+        entry[1] = None
+    elif entry[1] is not None:
+        entry[1].update(keys)
+
+
+def is_written(model, key=None):
+    """Whether the given record of the given model, or any of its records if
+    key is None, is changed by the current transaction. Such records are not
+    cached before the transaction ends, as the other connections would read
+    the uncommitted values from the cache.
+    """
+    entry = getattr(_local, 'written', {}).get(model._meta.name)
+    if entry is None:
+        return False
+    return key is None or entry[1] is None or key in entry[1]
+
+
+def tables_written(tables):
+    """Whether any of the given tables is changed by the current transaction.
+    The query results involving such tables are not cached before the
+    transaction ends, as the table versions only change then.
+    """
+    written = getattr(_local, 'written', {})
+    tables = set(tables)
+    return bool([m for m, keys in written.values() if m._meta.table in tables])
+
+
+def end_transaction(rollback=False):
+    """Called when the current transaction ends. The cached query results of
+    the changed tables are invalidated, as they might have been cached by
+    other connections before the changes got visible to them. For the same
+    reason, the cached records changed by the transaction are removed again.
+    If it is rolled back, all the cached records of the changed models are
+    invalidated, as the records read within the transaction might have been
+    cached.
+    """
+    written = getattr(_local, 'written', None)
+    if written:
+        for model, keys in written.values():
+            touch(model)
+            if not model._meta.cache:
+                continue
+            if rollback or keys is None:
+                bump(model)
+            elif keys:
+                version = _version(model)
+                get_cache().delete_many(*[_entry_key(model, version, k) for k in keys])
+    _local.written = {}
+
+
+def _entry_key(model, version, key):
+    return 'm:%s:%s:%s' % (model._meta.table, version, key)
+
+
+def get_many(model, keys):
+    """Get the cached instances of the given model for the given keys with a
+    single cache read. The records changed by the current transaction are
+    not read from the cache.
+
+    :returns: a dict of instances by key
+    """
+    keys = [k for k in keys if not is_written(model, k)]
+    if not keys:
+        return {}
+    version = _version(model)
+    names = [_entry_key(model, version, k) for k in keys]
+    result = {}
+    for key, entry in zip(keys, get_cache().get_many(*names)):
+        if entry is not None:
+            result[key] = model._from_cache(key, *entry)
+    return result
+
+
+def dump(obj):
+    """Returns the loaded field values of the given instance as a tuple of
+    key, values and names of reference fields, which can be cached and turned
+    back into an instance with ``Model._from_cache``.
+    """
+    from kalapy.db.model import Model
+
+    values, refs = {}, []
+    for name, value in obj._values.items():
+        field = obj._meta.fields.get(name)
+        if field is None or field.data_type is None:
+            continue
+        if isinstance(value, Model):
+            value = value.key
+            refs.append(name)
+        values[name] = value
+    return obj.key, values, tuple(refs)
+
+
+def dump_rows(rows):
+    """Returns the given rows of values with the model instances, like the
+    values of the reference fields, replaced with their keys. The instances
+    are not cached themselves, as they would be shared by the readers and
+    changed when they are loaded.
+    """
+    from kalapy.db.model import Model
+    return [tuple([v.key if isinstance(v, Model) else v for v in row])
+            for row in rows]
+
+
+def load_rows(rows, fields):
+    """Returns the given rows cached with :func:`dump_rows` with new instances
+    for the keys of the given reference fields.
+
+    :param fields: the field of each value, None for the other values
+    """
+    refs = [(i, f) for i, f in enumerate(fields)
+            if getattr(f, 'reference', None) is not None]
+    if not refs:
+        return rows
+    result = []
+    for row in rows:
+        row = list(row)
+        for i, field in refs:
+            row[i] = field.database_to_python(row[i])
+        result.append(tuple(row))
+    return result
+
+
+def set_many(model, instances):
+    """Cache the field values of the given instances of the given model,
+    except the ones changed by the current transaction (see :func:`is_written`).
+    """
+    version = _version(model)
+    mapping = {}
+    for obj in instances:
+        if not obj.is_saved or is_written(model, obj.key):
+            continue
+        key, values, refs = dump(obj)
+        mapping[_entry_key(model, version, key)] = (values, refs)
+    if mapping:
+        get_cache().set_many(mapping, model._meta.cache.get('ttl'))
+
+
+def _lookup_key(model, version, name, value):
+    value = md5(repr(value)).hexdigest()
+    return 'u:%s:%s:%s:%s' % (model._meta.table, version, name, value)
+
+
+def get_key(model, name, value):
+    """Get the cached key of the record of the given model whose unique field
+    given by name has the given value.
+
+    :returns: the key or None
+    """
+    return get_cache().get(_lookup_key(model, _version(model), name, value))
+
+
+def set_key(model, name, value, key):
+    """Cache the key of the record of the given model whose unique field given
+    by name has the given value, unless the record is changed by the current
+    transaction.
+    """
+    if is_written(model, key):
+        return
+    get_cache().set(_lookup_key(model, _version(model), name, value), key,
+                    model._meta.cache.get('ttl'))
+
+
+def invalidate(instances, deleted=False):
+    """Remove the cached values of the given instances and invalidate the
+    cached query results involving their tables (see :func:`touch`).
+    """
+    keys = {}
+    for obj in instances:
+        model = obj.__class__
+        keys.setdefault(model._meta.name, (model, []))
+        if model._meta.cache and obj.is_saved:
+            keys[model._meta.name][1].append(obj.key)
+    for model, items in keys.values():
+        touch(model, deleted)
+        if items:
+            _written(model, items)
+            version = _version(model)
+            get_cache().delete_many(*[_entry_key(model, version, k) for k in items])
@@ -10,14 +10,22 @@ loads the configured storage engine and exports implemented interfaces.
 """
 import os
 
+from itertools import count
+
 from werkzeug import import_string
-from werkzeug.local import LocalStack
+from werkzeug.local import Local, LocalStack
 
 from kalapy.conf import settings, ConfigError
 from kalapy.core import signals
+from kalapy.db.engines.pool import ConnectionPool
+from kalapy.db.engines.sharding import Router, FanOut
+from kalapy.db.fields import ValidationError
+from kalapy.db.cache import end_transaction
+from kalapy.db.session import clear_sessions, flush_sessions
 
 
-__all__ = ('Database', 'DatabaseError', 'IntegrityError', 'database')
+__all__ = ('Database', 'DatabaseError', 'IntegrityError', 'database',
+           'connection_pool', 'replica_pools', 'shard_pools', 'router')
 
 
 if not settings.DATABASE_ENGINE:
@@ -36,30 +44,303 @@ except (ImportError, AttributeError):
         _("Engine %(name)r not supported.", name=settings.DATABASE_ENGINE))
 
 
+def create_database(**options):
+    """Create a new database instance with the configured settings. The given
+    options (`name`, `host`, `port`, `user` and `password`) override the
+    settings, used to connect to the read replicas.
+    """
+    params = dict(
+            name=settings.DATABASE_NAME,
+            host=settings.DATABASE_HOST,
+            port=settings.DATABASE_PORT,
+            user=settings.DATABASE_USER,
+            password=settings.DATABASE_PASSWORD)
+    params.update(options)
+    return Database(**params)
+
+
+#: pool of database connections configured with `DATABASE_POOL` settings,
+#: None if the engine doesn't support pooling
+connection_pool = None
+
+#: pools of connections to the read replicas configured with
+#: `DATABASE_REPLICAS` settings, empty if the engine doesn't support pooling
+replica_pools = []
+
+#: pools of connections to the shards configured with `DATABASE_SHARDS`
+#: settings, empty if the engine doesn't support pooling
+shard_pools = []
+
+if Database.supports_pooling:
+    connection_pool = ConnectionPool(create_database, error=DatabaseError,
+                                     **settings.DATABASE_POOL)
+    for options in settings.DATABASE_REPLICAS:
+        replica_pools.append(ConnectionPool(
+            lambda options=options: create_database(**options),
+            error=DatabaseError, **settings.DATABASE_POOL))
+    for options in settings.DATABASE_SHARDS:
+        shard_pools.append(ConnectionPool(
+            lambda options=options: create_database(**options),
+            error=DatabaseError, **settings.DATABASE_POOL))
+
+#: the router of the records of sharded models to the shards
+router = Router(shard_pools, settings.DATABASE_SHARD_KEY_RANGE)
+
+_replica_counter = count()
+
+
 class Connection(object):
+    """The context local database connection. The connection is checked out
+    from the :data:`connection_pool` on first use and returned to the pool
+    when closed.
+
+    If read replicas are configured, the queries are sent to a replica picked
+    in round-robin order, which is used till the connection is closed. Once
+    something is written, the queries are sent to the primary database till
+    the connection is closed, so the changes are visible to them even if the
+    replicas are lagging behind.
+
+    If shards are configured, the records of the sharded models are read from
+    and written to the shards picked by the :data:`router`. The connections to
+    the shards are checked out on first use and committed or rolled back
+    along with the primary connection (without a two-phase commit).
+    """
 
     __ctx = LocalStack()
+    __local = Local()
+
+    #: methods changing the database, the raw cursor may do so as well
+    writes = ('cursor', 'insert_records', 'run_in_transaction', 'alter_table')
 
     def __getattr__(self, name):
         if self.__ctx.top is None:
             self.connect()
+        if name in self.writes:
+            self.__local.written = True
         return getattr(self.__ctx.top, name)
 
+    def __primary(self):
+        # the primary database to write to
+        if self.__ctx.top is None:
+            self.connect()
+        self.__local.written = True
+        return self.__ctx.top
+
+    def shard(self, index):
+        """Returns the database of the shard with the given index, checked out
+        from its pool on first use in the current context.
+        """
+        shards = getattr(self.__local, 'shards', None)
+        if shards is None:
+            shards = self.__local.shards = {}
+        if index not in shards:
+            pool = router.pools[index]
+            shards[index] = (pool, pool.acquire())
+        return shards[index][1]
+
+    def __sharded(self, model):
+        return model._meta.shard is not None and router.size > 0
+
+    def __writers(self, qset):
+        if self.__sharded(qset.model):
+            return [self.shard(i) for i in router.shards(qset)]
+        return [self.__primary()]
+
+    def __group(self, instances):
+        # group the instances by the database to write to, the instances of
+        # the sharded models are grouped once the others are written as their
+        # shards may depend on the keys of the others
+        primary, sharded = [], []
+        for obj in instances:
+            if self.__sharded(obj.__class__):
+                sharded.append(obj)
+            else:
+                primary.append(obj)
+        if primary:
+            yield None, self.__primary(), primary
+        groups = {}
+        for obj in sharded:
+            groups.setdefault(router.shard_of(obj), []).append(obj)
+        for index in sorted(groups):
+            yield index, self.shard(index), groups[index]
+
+    def update_records(self, *instances):
+        unique, seen = [], set()
+        for obj in instances:
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                unique.append(obj)
+        instances = unique
+        for obj in instances:
+            if obj.is_saved:
+                self.__check_shard(obj.__class__, obj._dirty)
+        for index, db, objs in self.__group(instances):
+            new = [obj for obj in objs if not obj.is_saved]
+            db.update_records(*objs)
+            if index is not None:
+                self.__check_keys(index, new)
+        return [obj.key for obj in instances]
+
+    def __check_shard(self, model, names):
+        # the records stay in the shard picked when they are inserted, so the
+        # queries by the shard key would miss them if it's changed
+        if self.__sharded(model) and model._meta.shard in names:
+            raise ValidationError(
+                _('The shard key %(name)r of the saved records of %(model)r '
+                  'can not be changed', name=model._meta.shard,
+                    model=model._meta.name))
+
+    def __check_keys(self, index, instances):
+        # the keys allocated by a shard past its range would be taken for
+        # the keys of the next shard
+        first = router.first_key(index)
+        for obj in instances:
+            if not first <= obj.key < first + router.key_range:
+                raise DatabaseError(
+                    _('Key %(key)s of %(model)r is out of the key range of '
+                      'shard %(shard)s, increase DATABASE_SHARD_KEY_RANGE',
+                        key=obj.key, model=obj._meta.name, shard=index))
+
+    def delete_records(self, *instances):
+        keys = []
+        for index, db, objs in self.__group(instances):
+            keys.extend(db.delete_records(*objs))
+        return keys
+
+    def bulk_load(self, model, names, rows, batch_size=1000):
+        if self.__sharded(model):
+            raise TypeError(
+                _("Can't bulk load the sharded model %(model)r",
+                    model=model._meta.name))
+        return self.__primary().bulk_load(model, names, rows, batch_size)
+
+    def delete_all(self, qset):
+        return sum([db.delete_all(qset) for db in self.__writers(qset)])
+
+    def update_all(self, qset, values):
+        self.__check_shard(qset.model, values)
+        return sum([db.update_all(qset, values) for db in self.__writers(qset)])
+
+    def __tables(self, model):
+        if self.__sharded(model):
+            return [self.shard(i) for i in range(router.size)]
+        return [self.__primary()]
+
+    def exists_table(self, model):
+        return self.__tables(model)[0].exists_table(model)
+
+    def create_table(self, model):
+        for i, db in enumerate(self.__tables(model)):
+            if self.__sharded(model) and not db.exists_table(model):
+                db.create_table(model)
+                db.set_next_key(model, router.first_key(i))
+            else:
+                db.create_table(model)
+
+    def drop_table(self, model):
+        for db in self.__tables(model):
+            db.drop_table(model)
+
+    @property
+    def written(self):
+        """Whether something is written with the connection of the current
+        context since it's been acquired.
+        """
+        return getattr(self.__local, 'written', False)
+
+    def reader(self, using=None):
+        """Returns the database to read from, the primary database (this
+        connection) or a read replica.
+
+        :param using: ``'primary'`` or ``'replica'`` to pin the database,
+                      by default a replica is used unless something is
+                      written with this connection
+        """
+        if not replica_pools or using == 'primary' or \
+                (using is None and self.written):
+            return self
+        replica = getattr(self.__local, 'replica', None)
+        if replica is None:
+            pool = replica_pools[_replica_counter.next() % len(replica_pools)]
+            replica = self.__local.replica = (pool, pool.acquire())
+        return replica[1]
+
+    def route(self, qset):
+        """Returns the database to read the records matched by the given query
+        set from. For the sharded models, it's the matching shard or an
+        instance of :class:`FanOut` reading from all the matching shards.
+        Otherwise it's the database returned by :meth:`reader`.
+
+        :param qset: an instance of :class:`kalapy.db.query.QSet`
+        """
+        if self.__sharded(qset.model):
+            shards = [self.shard(i) for i in router.shards(qset)]
+            if len(shards) == 1:
+                return shards[0]
+            return FanOut(shards)
+        return self.reader(qset.using)
+
+    @property
+    def connected(self):
+        """Whether the connection is acquired for the current context.
+        """
+        return self.__ctx.top is not None
+
     def connect(self):
         if self.__ctx.top is None:
-            db = Database(
-                    name=settings.DATABASE_NAME,
-                    host=settings.DATABASE_HOST,
-                    port=settings.DATABASE_PORT,
-                    user=settings.DATABASE_USER,
-                    password=settings.DATABASE_PASSWORD)
+            if connection_pool is not None:
+                db = connection_pool.acquire()
+            else:
+                db = create_database()
             self.__ctx.push(db)
         self.__ctx.top.connect()
 
+    def commit(self):
+        flush_sessions()
+        clear_sessions()
+        if self.__ctx.top is not None:
+            self.__ctx.top.commit()
+        for pool, db in self.__shards():
+            db.commit()
+        self.__end_read()
+        end_transaction()
+
+    def rollback(self):
+        clear_sessions()
+        if self.__ctx.top is not None:
+            self.__ctx.top.rollback()
+        for pool, db in self.__shards():
+            db.rollback()
+        self.__end_read()
+        end_transaction(rollback=True)
+
+    def __shards(self):
+        shards = getattr(self.__local, 'shards', None) or {}
+        return shards.values()
+
+    def __end_read(self):
+        # end the read transaction, so the replica shows recent changes
+        replica = getattr(self.__local, 'replica', None)
+        if replica is not None:
+            replica[1].rollback()
+
     def close(self):
+        clear_sessions(release=True)
+        end_transaction(rollback=True)
+        replica = getattr(self.__local, 'replica', None)
+        if replica is not None:
+            replica[0].release(replica[1])
+        self.__local.replica = None
+        self.__local.written = False
+        for pool, db in self.__shards():
+            pool.release(db)
+        self.__local.shards = None
         if self.__ctx.top is not None:
-            self.__ctx.top.close()
-            self.__ctx.pop()
+            db = self.__ctx.pop()
+            if connection_pool is not None:
+                connection_pool.release(db)
+            else:
+                db.close()
 
 
 #: context local database connection
@@ -67,7 +348,8 @@ database = Connection()
 
 
 def commit():
-    """Commit the changes to the database.
+    """Commit the changes to the database. The pending changes of the sessions
+    in unit of work mode are written first.
     """
     database.commit()
 
@@ -85,7 +367,8 @@ def run_in_transaction(func, *args, **kw):
 
 
 def open_connection():
-    """Open database connection when request started.
+    """Open database connection. It's not required for requests as the
+    connection is acquired on first use.
     """
     database.connect()
 
@@ -103,6 +386,5 @@ def rollback_connection(error):
 
 # only register signals if database is configured.
 if settings.DATABASE_NAME:
-    signals.connect('request-started')(open_connection)
     signals.connect('request-finished')(close_connection)
     signals.connect('request-exception')(rollback_connection)
@@ -8,7 +8,7 @@ Implementes Google AppEngine backend.
 :license: BSD, see LICENSE for more details.
 """
 import re
-from itertools import chain
+from itertools import chain, islice
 
 try:
     from google.appengine.api import datastore
@@ -19,8 +19,10 @@ except ImportError:
 
 from google.appengine.api import datastore_errors, datastore_types
 
+from kalapy.db import cache
 from kalapy.db.engines.interface import IDatabase
 from kalapy.db.model import Model
+from kalapy.db.query import Query as DBQuery, _resolve
 from kalapy.conf import settings
 
 __all__ = ('DatabaseError', 'IntegrityError', 'Database')
@@ -67,6 +69,15 @@ class Database(IDatabase):
         result = "class %s(db.Model):" % model.__name__
         for name, field in model.fields().items():
             result += "\n    %s = db.%s(...)" % (name, field.__class__.__name__)
+        if model._meta.indexes:
+            # the composite indexes to be added to index.yaml
+            result += "\n\n# index.yaml"
+            for item in model._meta.indexes:
+                result += "\n# - kind: %s\n#   properties:" % model._meta.table
+                for field, desc in item:
+                    result += "\n#   - name: %s" % field.name
+                    if desc:
+                        result += "\n#     direction: desc"
         return result
 
     def exists_table(self, model):
@@ -94,6 +105,8 @@ class Database(IDatabase):
 
             if not obj.is_saved:
                 obj._payload = datastore.Entity(obj._meta.table)
+            elif obj._payload is None: # lazy instance, not loaded yet
+                obj._payload = datastore.Get(obj.key)
 
             # test unique contraints
             if self.check_unique:
@@ -105,6 +118,7 @@ class Database(IDatabase):
             result.append(obj.key)
             obj.set_dirty(False)
 
+        cache.invalidate(instances)
         return result
 
     def delete_records(self, instance, *args):
@@ -122,6 +136,7 @@ class Database(IDatabase):
 
         keys = [obj.key for obj in instances]
         datastore.Delete(keys)
+        cache.invalidate(instances, deleted=True)
 
         for obj in instances:
             obj._key = None
@@ -129,15 +144,31 @@ class Database(IDatabase):
 
         return keys
 
-    def fetch(self, qset, limit, offset):
+    def delete_all(self, qset):
+        # the datastore has no set based delete, so do it per entity
+        instances = map(qset.model._from_database_values,
+                        self.fetch(qset, -1, 0))
+        if instances:
+            self.delete_records(*instances)
+        return len(instances)
+
+    def update_all(self, qset, values):
+        instances = map(qset.model._from_database_values,
+                        self.fetch(qset, -1, 0))
+        for obj in instances:
+            for k, v in values.items():
+                setattr(obj, k, v)
+        if instances:
+            self.update_records(*instances)
+        return len(instances)
+
+    def fetch(self, qset, limit, offset, batch_size=None):
         limit = datastore.MAXIMUM_RESULTS if limit == -1 else limit
-        orderings = []
-        try:
-            name, how = qset.order
-            how = Query.ASCENDING if how == 'ASC' else Query.DESCENDING
-            orderings = [(name, how)]
-        except:
-            pass
+        ordering = [(name, Query.ASCENDING if how == 'ASC' else Query.DESCENDING)
+                    for name, how in qset.ordering()]
+        # key is not a property, the entities are ordered by key either by
+        # the datastore or by sort_result
+        orderings = [(name, how) for name, how in ordering if name != 'key']
 
         keys = self._keys(qset)
         result = []
@@ -146,7 +177,35 @@ class Database(IDatabase):
             result = [e for e in datastore.Get(keys) if e]
         else: # else build query, the results should be ANDed
             query_set = self._build_query_set(qset, orderings)
-            result_set = [[e for e in q.Get(limit, offset) if e] for q in query_set]
+            if qset.seek and orderings:
+                # seek with the first ordering property, the rest is
+                # filtered out after sorting
+                name, how = orderings[0]
+                op = '>=' if how == Query.ASCENDING else '<='
+                query_set.append(
+                    Query(qset.model._meta.table, {'%s %s' % (name, op): qset.seek[0]}, orderings))
+            # a single datastore query is ordered by the datastore, which
+            # orders the entities of equal values by key
+            keyed = [i for i, (name, how) in enumerate(ordering) if name == 'key']
+            if len(query_set) == 1 and type(query_set[0]) is Query and \
+               keyed in ([], [len(ordering) - 1]) and \
+               ordering[-1:] != [('key', Query.DESCENDING)]:
+                if not qset.seek:
+                    for e in query_set[0].Get(limit, offset):
+                        if e:
+                            yield dict(e, key=str(e.key()), _payload=e)
+                    return
+                # the entities equal to the first value but preceding the
+                # cursor are skipped, so read on till enough entities follow
+                rows = (dict(e, key=str(e.key()), _payload=e)
+                        for e in query_set[0].Run() if e)
+                rows = (r for r in rows if follows(r, ordering, qset.seek))
+                for row in islice(rows, offset, offset + limit):
+                    yield row
+                return
+            # the limits are applied once the preceding entities are skipped
+            size, skip = (datastore.MAXIMUM_RESULTS, 0) if qset.seek else (limit, offset)
+            result_set = [[e for e in q.Get(size, skip) if e] for q in query_set]
             keys = [set([e.key() for e in result]) for result in result_set]
             keys = reduce(lambda a, b: a & b, keys)
 
@@ -156,8 +215,12 @@ class Database(IDatabase):
                     result.setdefault(e.key(), e)
             result = result.values()
 
-        for e in sort_result(result, orderings)[:limit]:
-            yield dict(e, key=str(e.key()), _payload=e)
+        rows = [dict(e, key=str(e.key()), _payload=e) for e in result]
+        rows = sort_result(rows, ordering)
+        if qset.seek:
+            rows = [r for r in rows if follows(r, ordering, qset.seek)][offset:]
+        for row in rows[:limit]:
+            yield row
 
     def count(self, qset):
         return len(list(self.fetch(qset, -1, 0)))
@@ -167,6 +230,10 @@ class Database(IDatabase):
             q = qset.items[0]
             if len(q.items) == 1 and q.items[0][0] == 'key':
                 keys = q.items[0][2]
+                if isinstance(keys, DBQuery):
+                    if q.items[0][1] != 'in':
+                        return []
+                    return subquery_values(keys)
                 if not isinstance(keys, (list, tuple)):
                     return [keys]
                 return keys
@@ -178,6 +245,11 @@ class Database(IDatabase):
 
         def _query(item):
             name, op, value = item
+            if isinstance(value, DBQuery):
+                value = subquery_values(value)
+            if '.' in name:
+                raise DatabaseError(
+                    _('Dotted field names are not supported: %(name)s', name=name))
             if op == '=':
                 return LikeQuery(kind, name, value, orderings)
             elif op == 'not in':
@@ -311,23 +383,57 @@ class MultiQuery(datastore.MultiQuery):
         return False
 
 
+def subquery_values(query, size=500):
+    """A helper function to read the values selected by the given subquery
+    (see :meth:`Query.filter`) in chunks, as the datastore has no nested
+    queries.
+    """
+    qset, name = query._subquery()
+    field = _resolve(qset.model, name)
+    return [field.python_to_database(v) for v in
+            query.values_list(name, flat=True).iterate(size)]
+
+
+def _ordering_value(row, name):
+    """A helper function to get the value of the given row the rows are
+    ordered by. The keys are compared as :class:`datastore.Key` instances, as
+    the order of the encoded keys differs from the order of the datastore.
+    """
+    if name == 'key':
+        return row['_payload'].key()
+    return row[name]
+
+
 def sort_result(result, orderings):
     """A helper function to sort the final result.
     """
-    try:
-        name, how = orderings[0]
-    except:
+    if not orderings:
         return result
 
     def compare(a, b):
-        if how == 2:
-            return -cmp(a[name], b[name])
-        return cmp(a[name], b[name])
+        for name, how in orderings:
+            res = cmp(_ordering_value(a, name), _ordering_value(b, name))
+            if res:
+                return -res if how == 2 else res
+        return 0
 
     result.sort(compare)
     return result
 
 
+def follows(row, orderings, values):
+    """A helper function to check whether the given row follows the given
+    values of the ordering properties (see :meth:`Query.after`).
+    """
+    for (name, how), value in zip(orderings, values):
+        if name == 'key':
+            value = datastore.Key(value)
+        res = cmp(_ordering_value(row, name), value)
+        if res:
+            return (-res if how == 2 else res) > 0
+    return False
+
+
 def check_unique(model_instance, values):
     """A helper function to check unique contraints.
     """
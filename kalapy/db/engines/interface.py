@@ -9,6 +9,8 @@ instead.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
+from itertools import imap, islice
+
 
 class IDatabase(object):
     """The database interface. Backend engines should implement this class
@@ -24,6 +26,16 @@ class IDatabase(object):
     #: mimetype of return value of :meth:`schema_table`.
     schema_mime = "text/plain"
 
+    #: whether the engine supports dotted field names in queries
+    supports_joins = False
+
+    #: whether the connections can be shared using a connection pool
+    supports_pooling = False
+
+    #: the DB-API thread safety level, a connection can be used by several
+    #: threads if it's 2 or higher
+    threadsafety = 0
+
     def __init__(self, name, host=None, port=None, user=None, password=None):
         """Initialize the database.
         """
@@ -43,6 +55,13 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def ping(self):
+        """Check whether the database connection is still usable.
+
+        :returns: True if the connection is alive else False
+        """
+        return True
+
     def commit(self):
         """Commit the changes to the database.
         """
@@ -52,6 +71,21 @@ class IDatabase(object):
         """Rollback all the changes made since the last commit.
         """
         raise NotImplementedError
+
+    def begin_snapshot(self, snapshot=None):
+        """Start a new transaction reading a consistent snapshot of the
+        database, which ends with :meth:`rollback`. The engines able to share
+        the snapshot with other connections return its id, to be given to
+        this method of the other connections so they read the same snapshot.
+
+        The default implementation does nothing, the engines supporting
+        transactions should override it.
+
+        :param snapshot: the id of a snapshot to share
+
+        :returns: the id of the snapshot or None
+        """
+        return None
     
     def run_in_transaction(self, func, *args, **kw):
         """A helper function to run the specified func in a transaction. This
@@ -102,7 +136,8 @@ class IDatabase(object):
         raise NotImplementedError
 
     def create_table(self, model):
-        """Create a table for the given model if it doesn't exist.
+        """Create a table for the given model if it doesn't exist. The indexes
+        of the model are created as well if they don't exist.
 
         :param model: a subclass of :class:`Model`
         """
@@ -142,6 +177,22 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def bulk_load(self, model, names, rows, batch_size=1000):
+        """Insert the given rows into the table of the given model using the
+        fastest way supported by the database, without creating instances.
+
+        :param model: a subclass of :class:`Model`
+        :param names: sequence of column names
+        :param rows: iterable of tuples of database values, ordered as `names`
+        :param batch_size: number of rows to write at a time
+
+        :returns: number of rows inserted
+        :raises:
+            - :class:`DatabaseError`
+            - :class:`IntegrityError`
+        """
+        raise NotImplementedError
+
     def delete_records(self, instance, *args):
         """Delete database records for the given model instances. This method
         also accepts keys.
@@ -160,7 +211,34 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
-    def fetch(self, qset, limit, offset):
+    def delete_all(self, qset):
+        """Delete all the database records matched by the given query set
+        with a single statement, without loading them.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+
+        :returns: number of records deleted
+        :raises:
+            - :class:`DatabaseError`
+            - :class:`IntegrityError`
+        """
+        raise NotImplementedError
+
+    def update_all(self, qset, values):
+        """Update all the database records matched by the given query set
+        with a single statement, without loading them.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+        :param values: a dict of field name and validated value
+
+        :returns: number of records updated
+        :raises:
+            - :class:`DatabaseError`
+            - :class:`IntegrityError`
+        """
+        raise NotImplementedError
+
+    def fetch(self, qset, limit, offset, batch_size=None):
         """Fetch records from database filtered by the given query set bound
         to given limit and offset.
 
@@ -175,6 +253,8 @@ class IDatabase(object):
         :param qset: the query set, an instance of :class:`db.query.QSet`
         :param limit: number of records to be fetch
         :param offset: offset from where to fetch records
+        :param batch_size: if given, number of records to read from the
+                           database at a time (a hint for the engine)
 
         :returns: an interator of dict of name, value mappings
         :raises:
@@ -182,6 +262,31 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def load(self, qset, limit, offset, batch_size=None):
+        """Same as :meth:`fetch` but returns model instances instead of dict
+        of values. Engines can override it to create the instances directly
+        from the database rows.
+
+        :returns: an iterator of model instances
+        """
+        return imap(qset.model._from_database_values,
+                    self.fetch(qset, limit, offset, batch_size))
+
+    def values(self, qset, names, limit, offset, batch_size=None):
+        """Same as :meth:`fetch` but returns only the values of the given
+        fields as tuples. The values are converted to python values.
+
+        :param qset: an instance of :class:`kalapy.db.query.QSet`
+        :param names: sequence of field names
+        :param limit: number of records to fetch
+        :param offset: offset from where to fetch records
+        :param batch_size: number of rows to read from the database at a time
+
+        :returns: an iterator of tuples
+        """
+        for obj in self.load(qset, limit, offset, batch_size):
+            yield tuple([getattr(obj, name) for name in names])
+
     def count(self, qset):
         """Returns the total number of records matched by given query set.
 
@@ -193,3 +298,50 @@ class IDatabase(object):
         """
         raise NotImplementedError
 
+    def exists(self, qset):
+        """Check whether the given query set matches any record.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+
+        :returns: True or False
+        :raises:
+            - :class:`DatabaseError`
+        """
+        return bool(list(islice(self.fetch(qset, 1, 0), 1)))
+
+    def aggregate(self, qset, group_by, aggregates):
+        """Compute the given aggregates of the records matched by the given
+        query set, for each group of records having same values of the given
+        fields. The default implementation computes them in Python over the
+        values of all the matched records, engines supporting aggregate
+        functions should override it.
+
+        :param qset: the query set, an instance of :class:`db.query.QSet`
+        :param group_by: sequence of field names to group by
+        :param aggregates: sequence of :class:`db.query.Aggregate` instances
+
+        :returns: list of tuples of group values followed by the aggregates,
+                  ordered by the group values
+        :raises:
+            - :class:`DatabaseError`
+        """
+        from kalapy.db.model import Model
+
+        size = len(group_by)
+        names = tuple(group_by) + tuple([a.name for a in aggregates])
+        groups = {}
+        for row in self.values(qset, names, -1, 0):
+            group = tuple(row[:size])
+            # model instances are grouped by key
+            ident = tuple([v.key if isinstance(v, Model) else v for v in group])
+            groups.setdefault(ident, (group, []))[1].append(row[size:])
+        if not group_by and not groups:
+            groups[()] = ((), [])
+
+        result = []
+        for ident in sorted(groups):
+            group, rows = groups[ident]
+            values = [a.compute([r[i] for r in rows]) for i, a in enumerate(aggregates)]
+            result.append(group + tuple(values))
+        return result
+
@@ -7,12 +7,15 @@ MySQL backend engine.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
+import tempfile
+
 import MySQLdb as dbapi
 from MySQLdb.converters import conversions
 from MySQLdb.constants import FIELD_TYPE
 
+from kalapy.conf import settings
 from kalapy.db.engines import utils
-from kalapy.db.engines.relational import RelationalDatabase
+from kalapy.db.engines.relational import RelationalDatabase, QueryBuilder
 
 
 __all__ = ('DatabaseError', 'IntegrityError', 'Database')
@@ -27,6 +30,13 @@ CONV.update({
 })
 
 class Database(RelationalDatabase):
+    """The MySQL database. The following ``DATABASE_OPTIONS`` are supported:
+
+    - ``local_infile`` whether to load the records with ``LOAD DATA LOCAL
+      INFILE`` in :meth:`bulk_load`, which requires the client to allow the
+      server to read local files (default False, multi-row INSERT statements
+      are used instead)
+    """
 
     data_types = {
         "key"       :   "INTEGER AUTO_INCREMENT PRIMARY KEY",
@@ -43,9 +53,13 @@ class Database(RelationalDatabase):
 
     schema_mime = 'text/x-mysql'
 
+    threadsafety = dbapi.threadsafety
+
     def __init__(self, name, host=None, port=None, user=None, password=None):
         super(Database, self).__init__(name, host, port, user, password)
         self.connection = None
+        self.local_infile = settings.DATABASE_OPTIONS.get('local_infile', False)
+        self.consecutive_keys = None
 
     def connect(self):
         if self.connection is not None:
@@ -57,6 +71,8 @@ class Database(RelationalDatabase):
             'use_unicode': True,
             'conv': CONV,
         }
+        if self.local_infile:
+            args['local_infile'] = 1
         if self.user:
             args['user'] = self.user
         if self.password:
@@ -66,8 +82,12 @@ class Database(RelationalDatabase):
         if self.port:
             args['port'] = self.port
         self.connection = dbapi.connect(**args)
+        self.consecutive_keys = None
         return self
 
+    def query_builder(self, qset):
+        return QueryBuilder(qset)
+
     def fix_quote(self, sql):
         return sql.replace('"', '`')
 
@@ -84,6 +104,86 @@ class Database(RelationalDatabase):
             """, (model._meta.table, self.name,))
         return bool(cursor.fetchone()[0])
 
-    def lastrowid(self, cursor, model):
-        cursor.execute('SELECT LAST_INSERT_ID()')
-        return cursor.fetchone()[0]
+    def exists_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT COUNT(*)
+                FROM information_schema.statistics
+                    WHERE table_name = %s AND table_schema = %s AND index_name = %s;
+            """, (model._meta.table, self.name, name,))
+        return bool(cursor.fetchone()[0])
+
+    def set_next_key(self, model, key):
+        cursor = self.cursor()
+        cursor.execute(self.fix_quote(
+            'ALTER TABLE "%s" AUTO_INCREMENT = %d' % (model._meta.table, key)))
+
+    def begin_snapshot(self, snapshot=None):
+        # the InnoDB snapshots can't be shared
+        self.rollback()
+        cursor = self.cursor()
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+        return None
+
+    def load_batch(self, cursor, model, names, rows):
+        if not self.local_infile:
+            # executemany of MySQLdb sends a single multi-row INSERT
+            return super(Database, self).load_batch(cursor, model, names, rows)
+
+        # LOAD DATA reads from a file, the rows are written to a temporary
+        # file in its default format (tab separated, backslash escaped)
+        data = tempfile.NamedTemporaryFile(suffix='.tsv')
+        try:
+            data.writelines([utils.row_to_text(row) for row in rows])
+            data.flush()
+            sql = 'LOAD DATA LOCAL INFILE %%s INTO TABLE "%s" CHARACTER SET utf8 (%s)' % (
+                    model._meta.table, ", ".join(['"%s"' % k for k in names]))
+            cursor.execute(self.fix_quote(sql), (data.name,))
+        finally:
+            data.close()
+
+    def get_insert_sql(self, model, names, count=1):
+        if not names:
+            return 'INSERT INTO "%s" () VALUES %s' % (
+                    model._meta.table, ", ".join(['()'] * count))
+        return super(Database, self).get_insert_sql(model, names, count)
+
+    def has_consecutive_keys(self, cursor):
+        """Whether the keys generated by a multi-row INSERT are consecutive,
+        checked once per connection. They are if `auto_increment_increment`
+        is 1 and `innodb_autoinc_lock_mode` is 0 (traditional) or 1
+        (consecutive), but not in the interleaved mode (2, the default since
+        MySQL 8.0).
+        """
+        if self.consecutive_keys is None:
+            self.execute(cursor, 'SELECT @@auto_increment_increment, '
+                                 '@@innodb_autoinc_lock_mode')
+            increment, mode = cursor.fetchone()
+            self.consecutive_keys = int(increment) == 1 and int(mode) in (0, 1)
+        return self.consecutive_keys
+
+    def insert_records(self, cursor, model, names, rows):
+        if len(rows) > 1 and not self.has_consecutive_keys(cursor):
+            # the keys of a multi-row insert can't be told, insert the rows
+            # one by one
+            sql = self.fix_quote(self.get_insert_sql(model, names))
+            keys = []
+            for row in rows:
+                self.execute(cursor, sql, row)
+                keys.append(cursor.lastrowid)
+            return keys
+
+        # LAST_INSERT_ID() (cursor.lastrowid) is the key of the first row
+        sql = self.get_insert_sql(model, names, len(rows))
+        self.execute(cursor, self.fix_quote(sql), [v for row in rows for v in row])
+        first = cursor.lastrowid
+        return range(first, first + len(rows))
+
+
+class QueryBuilder(QueryBuilder):
+
+    def subquery(self, sql):
+        # MySQL doesn't allow to select from the table being modified, unless
+        # it is wrapped in a derived table.
+        return 'SELECT "key" FROM (%s) AS "t0"' % sql
@@ -0,0 +1,211 @@
+"""
+kalapy.db.engines.pool
+~~~~~~~~~~~~~~~~~~~~~~
+
+This module implements a thread-safe pool of database connections used by
+the context local :data:`kalapy.db.engines.database` connection.
+
+:copyright: (c) 2010 Amit Mendapara.
+:license: BSD, see LICENSE for more details.
+"""
+import time
+import threading
+
+
+__all__ = ('ConnectionPool',)
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of database connections. The connections are created
+    with the given factory, which should return a :class:`IDatabase` instance,
+    when there is no idle connection available and the pool is not full.
+    Otherwise :meth:`acquire` waits for a connection to be released.
+
+    >>> pool = ConnectionPool(lambda: Database('test'), max_size=5)
+    >>> db = pool.acquire()
+    >>> try:
+    ...     db.cursor().execute(...)
+    ... finally:
+    ...     pool.release(db)
+
+    :param factory: a callable returning new database instances
+    :param min_size: number of connections kept open even if idle
+    :param max_size: maximum number of open connections
+    :param idle_timeout: seconds after which the idle connections are closed
+    :param max_lifetime: seconds after which the connections are recycled
+    :param pre_ping: whether to check the connections with :meth:`IDatabase.ping`
+                     before handing them out
+    :param wait_timeout: seconds to wait for a connection if the pool is full
+    :param error: the exception class to raise on timeout
+    """
+
+    def __init__(self, factory, min_size=0, max_size=10, idle_timeout=300,
+                 max_lifetime=3600, pre_ping=True, wait_timeout=30,
+                 error=RuntimeError):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError(_('Invalid pool size %(min)s..%(max)s',
+                min=min_size, max=max_size))
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.pre_ping = pre_ping
+        self.wait_timeout = wait_timeout
+        self.error = error
+
+        self.__lock = threading.Condition()
+        self.__idle = []    # list of (db, released time)
+        self.__created = {} # creation time by id of db
+        self.__size = 0
+
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def acquire(self):
+        """Get a connection from the pool, a new connection is opened if there
+        is no idle connection and the pool is not full.
+
+        :returns: a connected database instance
+        :raises: the `error` exception if no connection gets available within
+                 `wait_timeout` seconds
+        """
+        while True:
+            db = self.__checkout()
+            if db is None:
+                try:
+                    db = self.factory()
+                    db.connect()
+                except:
+                    self.__discard(None)
+                    raise
+                self.__lock.acquire()
+                try:
+                    self.__created[id(db)] = time.time()
+                finally:
+                    self.__lock.release()
+                return db
+            if not self.pre_ping or db.ping():
+                return db
+            self.__discard(db)
+
+    def release(self, db):
+        """Return the given connection to the pool. The pending transaction is
+        rolled back. The connection is closed if it is too old or broken.
+
+        :param db: a database instance returned by :meth:`acquire`
+        """
+        try:
+            db.rollback()
+        except Exception:
+            return self.__discard(db)
+
+        self.__lock.acquire()
+        try:
+            created = self.__created.get(id(db), 0)
+            if time.time() - created < self.max_lifetime:
+                self.__idle.append((db, time.time()))
+                self.__lock.notify()
+                return
+        finally:
+            self.__lock.release()
+        self.__discard(db)
+
+    def clear(self):
+        """Close all the idle connections.
+        """
+        self.__lock.acquire()
+        try:
+            idle, self.__idle = self.__idle, []
+        finally:
+            self.__lock.release()
+        for db, released in idle:
+            self.__discard(db)
+
+    def stats(self):
+        """Returns a dict with the pool statistics, the number of open
+        connections (`size`), connections `in_use` and `idle`, the number of
+        `waits` for a connection and the total `wait_time` in seconds as well
+        as the number of `timeouts`.
+        """
+        self.__lock.acquire()
+        try:
+            return dict(size=self.__size,
+                        in_use=self.__size - len(self.__idle),
+                        idle=len(self.__idle),
+                        waits=self.waits,
+                        wait_time=self.wait_time,
+                        timeouts=self.timeouts)
+        finally:
+            self.__lock.release()
+
+    def __checkout(self):
+        """Get an idle connection or reserve a slot for a new connection, in
+        which case None is returned.
+        """
+        start = time.time()
+        waited = False
+        self.__lock.acquire()
+        try:
+            expired = self.__expire()
+            while not self.__idle and self.__size >= self.max_size:
+                remaining = start + self.wait_timeout - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise self.error(
+                        _('Timed out after %(timeout)s seconds waiting for a '
+                          'database connection, all %(size)s connections are '
+                          'in use.', timeout=self.wait_timeout, size=self.__size))
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                self.__lock.wait(remaining)
+            if waited:
+                self.wait_time += time.time() - start
+            if self.__idle:
+                return self.__idle.pop()[0]
+            self.__size += 1
+            return None
+        finally:
+            self.__lock.release()
+            for db in expired:
+                self.__close(db)
+
+    def __expire(self):
+        """Remove the connections idle for too long or too old from the idle
+        connections and return them. Should be called with lock acquired.
+        """
+        now = time.time()
+        keep, expired = [], []
+        for db, released in self.__idle:
+            if now - self.__created.get(id(db), 0) >= self.max_lifetime or \
+               (now - released >= self.idle_timeout and \
+                self.__size - len(expired) > self.min_size):
+                expired.append(db)
+            else:
+                keep.append((db, released))
+        self.__idle = keep
+        for db in expired:
+            self.__created.pop(id(db), None)
+        self.__size -= len(expired)
+        return expired
+
+    def __discard(self, db):
+        """Close the given connection and free its slot.
+        """
+        self.__lock.acquire()
+        try:
+            self.__size -= 1
+            self.__created.pop(id(db), None)
+            self.__lock.notify()
+        finally:
+            self.__lock.release()
+        if db is not None:
+            self.__close(db)
+
+    def __close(self, db):
+        try:
+            db.close()
+        except Exception:
+            pass
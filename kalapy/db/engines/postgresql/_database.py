@@ -7,9 +7,18 @@ PostgreSQL backend engine.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
+import re
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
 import psycopg2 as dbapi
 from psycopg2.extensions import UNICODE
 
+from kalapy.conf import settings
+from kalapy.db.engines import utils
 from kalapy.db.engines.relational import RelationalDatabase, QueryBuilder
 
 
@@ -22,7 +31,66 @@ DatabaseError = dbapi.DatabaseError
 IntegrityError = dbapi.IntegrityError
 
 
+def _numbered(sql):
+    """Replace the ``%s`` placeholders of the given statement with the
+    numbered ``$n`` placeholders of prepared statements.
+
+    :returns: a tuple of the statement and the number of parameters
+    """
+    count = [0]
+    def repl(match):
+        if match.group(1) == '%':
+            return '%'
+        count[0] += 1
+        return '$%d' % count[0]
+    sql = re.sub(r'%(%|s)', repl, sql)
+    return sql, count[0]
+
+
+class ServerCursor(object):
+    """Wraps a named server-side cursor, which reads the rows from the server
+    as they are requested. The first rows are read in advance, as psycopg2
+    reports the description of the result only once the rows are read.
+    """
+
+    def __init__(self, cursor, size):
+        self.cursor = cursor
+        self.rows = cursor.fetchmany(size)
+        self.description = cursor.description
+
+    def fetchmany(self, size):
+        if self.rows:
+            rows, self.rows = self.rows, []
+            return rows
+        return self.cursor.fetchmany(size)
+
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows + self.cursor.fetchall()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
 class Database(RelationalDatabase):
+    """The PostgreSQL database. The following ``DATABASE_OPTIONS`` are
+    supported:
+
+    - ``prepare_threshold`` number of times a statement is executed by a
+      connection before it's prepared on the server with ``PREPARE`` and then
+      executed with ``EXECUTE``, which saves parsing and planning it again
+      (default 0, the statements are not prepared)
+    - ``prepare_limit`` maximum number of statements prepared per connection
+      (default 100)
+    - ``server_cursors`` whether to read the results of the queries without
+      limit with named server-side cursors, so they are not read into memory
+      at once (default False)
+    """
 
     data_types = {
         "key"       :   "SERIAL PRIMARY KEY",
@@ -37,9 +105,18 @@ class Database(RelationalDatabase):
         "binary"    :   "BLOB",
     }
 
+    threadsafety = dbapi.threadsafety
+
     def __init__(self, name, host=None, port=None, user=None, password=None):
         super(Database, self).__init__(name, host, port, user, password)
         self.connection = None
+        options = settings.DATABASE_OPTIONS
+        self.prepare_threshold = options.get('prepare_threshold', 0)
+        self.prepare_limit = options.get('prepare_limit', 100)
+        self.server_cursors = options.get('server_cursors', False)
+        self.prepared = {}   # statement -> (name, number of parameters)
+        self.executions = {} # statement -> number of executions
+        self.cursors = 0
 
     def connect(self):
         if self.connection is not None:
@@ -59,6 +136,77 @@ class Database(RelationalDatabase):
         self.connection.set_isolation_level(1) # make transaction transparent to all cursors
         return self
 
+    def close(self):
+        super(Database, self).close()
+        # the prepared statements are gone with the connection
+        self.prepared.clear()
+        self.executions.clear()
+
+    def deallocate(self):
+        """Drop all the statements prepared by this connection, as they might
+        be invalid after the tables are changed.
+        """
+        if self.prepared:
+            self.cursor().execute('DEALLOCATE ALL')
+        self.prepared.clear()
+        self.executions.clear()
+
+    def prepare(self, cursor, sql):
+        """Prepare the given statement if it's been executed frequently.
+
+        :returns: a tuple of the name of the prepared statement and the number
+                  of its parameters, or None if it's not prepared
+        """
+        try:
+            return self.prepared[sql]
+        except KeyError:
+            pass
+        count = self.executions.get(sql, 0) + 1
+        if count < self.prepare_threshold or \
+           len(self.prepared) >= self.prepare_limit:
+            self.executions[sql] = count
+            return None
+        self.executions.pop(sql, None)
+        name = 'kalapy_%d' % (len(self.prepared) + 1)
+        statement, size = _numbered(sql)
+        cursor.execute('PREPARE %s AS %s' % (name, statement))
+        self.prepared[sql] = (name, size)
+        return self.prepared[sql]
+
+    def execute(self, cursor, sql, params=(), many=False):
+        prepared = None
+        if self.prepare_threshold and getattr(cursor, 'name', None) is None:
+            prepared = self.prepare(cursor, sql)
+        if prepared is not None:
+            name, size = prepared
+            sql = 'EXECUTE %s' % name
+            if size:
+                sql = '%s (%s)' % (sql, ', '.join(['%s'] * size))
+        super(Database, self).execute(cursor, sql, params, many)
+
+    def select(self, qset, limit, offset, names=None, cursor=None):
+        if cursor is not None or not self.server_cursors or limit > -1:
+            return super(Database, self).select(qset, limit, offset, names, cursor)
+        if not self.connection:
+            self.connect()
+        self.cursors += 1
+        cursor = self.connection.cursor('kalapy_cursor_%d' % self.cursors)
+        cursor.itersize = self.fetch_size
+        super(Database, self).select(qset, limit, offset, names, cursor)
+        return ServerCursor(cursor, self.fetch_size)
+
+    def create_table(self, model):
+        self.deallocate()
+        super(Database, self).create_table(model)
+
+    def alter_table(self, model, name=None):
+        self.deallocate()
+        super(Database, self).alter_table(model, name)
+
+    def drop_table(self, model):
+        self.deallocate()
+        super(Database, self).drop_table(model)
+
     def exists_table(self, model):
         cursor = self.cursor()
         cursor.execute("""
@@ -67,16 +215,61 @@ class Database(RelationalDatabase):
             """, (model._meta.table,))
         return bool(cursor.fetchone())
 
-    def lastrowid(self, cursor, model):
-        cursor.execute('SELECT last_value FROM "%s_key_seq"' % model._meta.table)
+    def exists_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT relname FROM pg_class
+                WHERE relkind = 'i' AND relname = %s;
+            """, (name,))
+        return bool(cursor.fetchone())
+
+    def set_next_key(self, model, key):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT setval(pg_get_serial_sequence(%s, 'key'), %s, false);
+            """, ('"%s"' % model._meta.table, key))
+
+    def insert_records(self, cursor, model, names, rows):
+        # read the generated keys from the INSERT itself, the sequence's
+        # last_value is global to all the sessions.
+        sql = '%s RETURNING "key"' % self.get_insert_sql(model, names, len(rows))
+        self.execute(cursor, self.fix_quote(sql), [v for row in rows for v in row])
+        return [row[0] for row in cursor.fetchall()]
+
+    def begin_snapshot(self, snapshot=None):
+        self.rollback()
+        cursor = self.cursor()
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+        if snapshot:
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+            return snapshot
+        cursor.execute('SELECT pg_export_snapshot()')
         return cursor.fetchone()[0]
 
+    def bulk_load(self, model, names, rows, batch_size=1000):
+        count = super(Database, self).bulk_load(model, names, rows, batch_size)
+        if 'key' in names:
+            # move the sequence past the keys loaded
+            self.cursor().execute(self.fix_quote("""
+                SELECT setval(pg_get_serial_sequence(%%s, 'key'),
+                    (SELECT COALESCE(MAX("key"), 0) + 1 FROM "%s"), false);
+                """ % model._meta.table), ('"%s"' % model._meta.table,))
+        return count
+
+    def load_batch(self, cursor, model, names, rows):
+        sql = 'COPY "%s" (%s) FROM STDIN' % (
+                model._meta.table, ", ".join(['"%s"' % k for k in names]))
+        data = StringIO(''.join([utils.row_to_text(row) for row in rows]))
+        cursor.copy_expert(self.fix_quote(sql), data)
+
     def query_builder(self, qset):
         return QueryBuilder(qset)
 
 
 class QueryBuilder(QueryBuilder):
 
+    nulls_first = False
+
     def handle_like(self, name, value):
-        return '"%s" ILIKE %%s' % (name)
+        return '%s ILIKE %%s' % (name)
 
@@ -9,22 +9,86 @@ for relational database systems. Engines for an RDBMS should inherit from the
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
-import re
+from itertools import islice
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from kalapy.db import cache
 from kalapy.db.engines.interface import IDatabase
+from kalapy.db.fields import Field
 from kalapy.db.model import Model
-from kalapy.db.reference import ManyToOne
+from kalapy.db.query import Query, Q, QSet, _resolve
+from kalapy.db.reference import ManyToOne, OneToMany
+from kalapy.utils.containers import OrderedDict
+
+
+__all__ = ('RelationalDatabase', 'QueryBuilder', 'StatementCache',)
+
+
+class StatementCache(object):
+    """A bounded cache of compiled SQL statements. Once the cache is full it
+    is simply cleared, the frequently used statements will be back soon.
 
+    The number of cache hits and misses are recorded to monitor the cache
+    efficiency (see :meth:`info`).
 
-__all__ = ('RelationalDatabase', 'QueryBuilder',)
+    :param size: maximum number of statements to cache
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.statements = {}
+
+    def get(self, key):
+        try:
+            value = self.statements[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if len(self.statements) >= self.size:
+            self.statements.clear()
+        self.statements[key] = value
+
+    def clear(self):
+        self.statements.clear()
+        self.hits = self.misses = 0
+
+    def info(self):
+        """Returns a dict with number of cache `hits`, `misses` and `size`,
+        the number of statements currently cached.
+        """
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self.statements))
 
 
 class RelationalDatabase(IDatabase):
 
+    supports_joins = True
+
+    supports_pooling = True
+
+    #: cache of compiled statements, shared by all the connections
+    statement_cache = StatementCache()
+
     data_types = {}
 
     schema_mime = 'text/x-sql'
 
+    #: number of rows to read from the cursor at a time
+    fetch_size = 100
+
+    #: maximum number of parameters to be used in a single statement
+    max_params = 999
+
     def __init__(self, name, host=None, port=None, user=None, password=None):
         super(RelationalDatabase, self).__init__(name, host, port, user, password)
         self.connection = None
@@ -47,6 +111,13 @@ class RelationalDatabase(IDatabase):
             self.connection.close()
         self.connection = None
 
+    def ping(self):
+        try:
+            self.cursor().execute('SELECT 1')
+        except Exception:
+            return False
+        return True
+
     def commit(self):
         self.connection.commit()
 
@@ -65,6 +136,22 @@ class RelationalDatabase(IDatabase):
         """
         return sql
 
+    def execute(self, cursor, sql, params=(), many=False):
+        """Execute the given statement with the given cursor. Engines can
+        override it to prepare the frequently executed statements.
+
+        :param cursor: a cursor returned by :meth:`cursor`
+        :param sql: the SQL statement
+        :param params: the parameters, a sequence of parameter sequences if
+                       `many` is True
+        :param many: whether to execute the statement for each parameter
+                     sequence
+        """
+        if many:
+            cursor.executemany(sql, params)
+        else:
+            cursor.execute(sql, params)
+
     def get_field_sql(self, field, for_alter=False):
         res = '"%s" %s' % (field.name, self.get_data_type(field))
         if not for_alter:
@@ -94,22 +181,92 @@ class RelationalDatabase(IDatabase):
         for item in model._meta.unique:
             output.append('UNIQUE(%s)' % ", ".join(['"%s"' % f.name for f in item]))
 
-        # generate foreign key constraints
+        # generate foreign key constraints, the referenced records of sharded
+        # models may be in other databases
         for field in fields:
-            if isinstance(field, ManyToOne):
+            if isinstance(field, ManyToOne) and not model._meta.shard:
                 output.append(self.get_fk_sql(field))
 
         output = ",\n    ".join(output)
         output = 'CREATE TABLE "%s" (\n    %s\n);' % (model._meta.table, output)
         return self.fix_quote(output)
 
+    def get_indexes(self, model):
+        """Returns the indexes of the given model, the ones declared with
+        ``__indexes__`` and the ones for the indexed fields and the
+        :class:`ManyToOne` fields not covered by any other index or unique
+        constraint.
+
+        :param model: a subclass of :class:`Model`
+
+        :returns: a list of (name, columns) tuples, where columns is a list of
+                  (column name, descending) tuples
+        """
+        items = list(model._meta.indexes)
+        leading = [item[0][0] for item in items] + \
+                  [item[0] for item in model._meta.unique]
+        for field in model.fields().values():
+            if field.name == 'key' or field._data_type is None:
+                continue
+            if field.is_indexed or isinstance(field, ManyToOne):
+                if field not in leading:
+                    items.append(((field, False),))
+
+        result = []
+        for item in items:
+            name = '%s_%s_idx' % (model._meta.table,
+                                  '_'.join([f.name for f, desc in item]))
+            if len(name) > 60: # most databases limit the names to 63 chars
+                name = '%s_%s_idx' % (name[:48], md5(name).hexdigest()[:8])
+            result.append((name, [(f.name, desc) for f, desc in item]))
+        return result
+
+    def get_index_sql(self, model, name, columns):
+        """Returns the CREATE INDEX statement for the given index.
+
+        :param model: a subclass of :class:`Model`
+        :param name: name of the index
+        :param columns: list of (column name, descending) tuples
+        """
+        columns = ", ".join([('"%s" DESC' if desc else '"%s"') % c
+                             for c, desc in columns])
+        return self.fix_quote('CREATE INDEX "%s" ON "%s" (%s);' % (
+                              name, model._meta.table, columns))
+
+    def exists_index(self, model, name):
+        """Check whether the index with the given name exists on the table of
+        the given model.
+
+        :param model: a subclass of :class:`Model`
+        :param name: name of the index
+
+        :returns: True if index exists else False
+        """
+        raise NotImplementedError
+
+    def set_next_key(self, model, key):
+        """Set the key of the next record inserted into the table of the
+        given model, used to allocate distinct key ranges to the shards.
+
+        :param model: a subclass of :class:`Model`
+        :param key: the next key
+        """
+        raise NotImplementedError
+
     def schema_table(self, model):
-        return self.get_create_sql(model)
+        output = [self.get_create_sql(model)]
+        for name, columns in self.get_indexes(model):
+            output.append(self.get_index_sql(model, name, columns))
+        return "\n".join(output)
 
     def create_table(self, model):
+        cursor = self.cursor()
         if not self.exists_table(model):
-            cursor = self.cursor()
             cursor.execute(self.get_create_sql(model))
+        # create the missing indexes of existing tables as well
+        for name, columns in self.get_indexes(model):
+            if not self.exists_index(model, name):
+                cursor.execute(self.get_index_sql(model, name, columns))
 
     def drop_table(self, model):
         if self.exists_table(model):
@@ -128,42 +285,135 @@ class RelationalDatabase(IDatabase):
     def lastrowid(self, cursor, model):
         return cursor.lastrowid
 
-    def update_records(self, instance, *args):
+    def get_insert_sql(self, model, names, count=1):
+        """Build an INSERT statement for the given number of rows.
 
-        result = []
-        instances = [instance] + list(args)
-
-        cursor = self.cursor()
+        :param model: a subclass of :class:`Model`
+        :param names: sequence of column names
+        :param count: number of rows to be inserted
+        """
+        if not names:
+            return 'INSERT INTO "%s" DEFAULT VALUES' % model._meta.table
+        row = "(%s)" % ", ".join(['%s'] * len(names))
+        return 'INSERT INTO "%s" (%s) VALUES %s' % (
+                model._meta.table,
+                ", ".join(['"%s"' % k for k in names]),
+                ", ".join([row] * count))
+
+    def insert_records(self, cursor, model, names, rows):
+        """Insert the given rows with a single statement and return the keys
+        generated for them in the same order.
+
+        The default implementation relies on the keys of a multi-row insert
+        being contiguous and :meth:`lastrowid` returning the key of the last
+        row, which is the case for SQLite. Engines should override this method
+        if that's not true.
+
+        :param cursor: the database cursor
+        :param model: a subclass of :class:`Model`
+        :param names: sequence of column names
+        :param rows: list of value lists, ordered as `names`
+
+        :returns: list of keys
+        """
+        sql = self.get_insert_sql(model, names, len(rows))
+        self.execute(cursor, self.fix_quote(sql), [v for row in rows for v in row])
+        last = self.lastrowid(cursor, model)
+        return range(last - len(rows) + 1, last + 1)
 
-        for obj in instances:
+    def update_records(self, instance, *args):
 
+        instances = []
+        seen = set()
+        for obj in [instance] + list(args):
             assert isinstance(obj, Model), 'update_records expects Model instances'
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                instances.append(obj)
 
-            items = obj._to_database_values(True).items()
-
-            keys = [x[0] for x in items]
-            vals = [x[1] for x in items]
-
-            if not obj.is_saved:
-                keys = ['"%s"' % k for k in keys]
-                sql = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
-                        obj._meta.table,
-                        ", ".join(keys),
-                        ", ".join(['%s'] * len(vals)))
-                cursor.execute(self.fix_quote(sql), vals)
-                obj._key = self.lastrowid(cursor, obj.__class__)
-                result.append(obj.key)
-            else:
-                keys = ", ".join(['"%s" = %%s' % k for k in keys])
-                sql = 'UPDATE "%s" SET %s WHERE "key" = %%s' % (obj._meta.table, keys)
+        cursor = self.cursor()
 
-                vals.append(obj.key)
-                cursor.execute(self.fix_quote(sql), vals)
-                result.append(obj.key)
+        pending = instances
+        while pending:
+            # an instance must wait till the unsaved instances it refers are
+            # inserted, as their keys are not known yet.
+            unsaved = set([id(o) for o in pending if not o.is_saved])
+            groups = OrderedDict()
+            waiting = []
+            for obj in pending:
+                if [o for o in obj._get_related() \
+                        if id(o) in unsaved and o is not obj]:
+                    waiting.append(obj)
+                    continue
+                group = (obj.__class__, obj.is_saved, _dirty_names(obj))
+                groups.setdefault(group, []).append(obj)
+
+            if not groups: # circular references, nothing we can do about it
+                for obj in waiting:
+                    group = (obj.__class__, obj.is_saved, _dirty_names(obj))
+                    groups.setdefault(group, []).append(obj)
+                waiting = []
+
+            for (model, saved, names), objs in groups.items():
+                self._write_group(cursor, model, saved, names, objs)
+
+            pending = waiting
 
+        for obj in instances:
             obj.set_dirty(False)
 
-        return result
+        cache.invalidate(instances)
+        return [obj.key for obj in instances]
+
+    def _write_group(self, cursor, model, saved, names, objs):
+        """Write the given instances of the same model having same set of
+        dirty fields using as few statements as possible.
+        """
+        rows = []
+        for obj in objs:
+            values = obj._to_database_values(True)
+            rows.append([values[k] for k in names])
+
+        if saved:
+            if not names:
+                return
+            keys = ", ".join(['"%s" = %%s' % k for k in names])
+            sql = 'UPDATE "%s" SET %s WHERE "key" = %%s' % (model._meta.table, keys)
+            for obj, row in zip(objs, rows):
+                row.append(obj.key)
+            self.execute(cursor, self.fix_quote(sql), rows, many=True)
+            return
+
+        size = max(1, self.max_params // max(1, len(names))) if names else 1
+        for i in range(0, len(rows), size):
+            keys = self.insert_records(cursor, model, names, rows[i:i+size])
+            for obj, key in zip(objs[i:i+size], keys):
+                obj._key = key
+
+    def bulk_load(self, model, names, rows, batch_size=1000):
+        cursor = self.cursor()
+        count = 0
+        for batch in _batches(rows, batch_size):
+            self.load_batch(cursor, model, names, batch)
+            count += len(batch)
+        if model._meta.cache:
+            cache.bump(model)
+        cache.touch(model)
+        return count
+
+    def load_batch(self, cursor, model, names, rows):
+        """Insert the given rows for :meth:`bulk_load`. The default
+        implementation executes a single row INSERT statement for all the rows
+        with `executemany`, engines should override it to use the native bulk
+        loading statement if any.
+
+        :param cursor: the database cursor
+        :param model: a subclass of :class:`Model`
+        :param names: sequence of column names
+        :param rows: list of tuples of values, ordered as `names`
+        """
+        sql = self.get_insert_sql(model, names)
+        self.execute(cursor, self.fix_quote(sql), rows, many=True)
 
     def delete_records(self, instance, *args):
 
@@ -178,7 +428,8 @@ class RelationalDatabase(IDatabase):
                             instance._meta.table, ", ".join(['%s'] * len(keys)))
 
         cursor = self.cursor()
-        cursor.execute(self.fix_quote(sql), keys)
+        self.execute(cursor, self.fix_quote(sql), keys)
+        cache.invalidate(instances, deleted=True)
 
         for obj in instances:
             obj._key = None
@@ -186,30 +437,188 @@ class RelationalDatabase(IDatabase):
 
         return keys
 
+    def delete_all(self, qset):
+        sql = self.compile(qset, lambda b: b.delete()[0], 'delete')
+        cursor = self.cursor()
+        self.execute(cursor, sql, qset.params())
+        if qset.model._meta.cache:
+            cache.bump(qset.model)
+        cache.touch(qset.model, deleted=True)
+        return cursor.rowcount
+
+    def update_all(self, qset, values):
+        fields = qset.model._meta.fields
+        values = [(k, fields[k].python_to_database(v)) for k, v in values.items()]
+        sql = self.compile(qset, lambda b: b.update(values)[0],
+                           'update', tuple([k for k, v in values]))
+        cursor = self.cursor()
+        self.execute(cursor, sql, [v for k, v in values] + qset.params())
+        if qset.model._meta.cache:
+            cache.bump(qset.model)
+        cache.touch(qset.model)
+        return cursor.rowcount
+
     def query_builder(self, qset):
         return QueryBuilder(qset)
 
-    def fetch(self, qset, limit, offset):
-        cursor = self.cursor()
-        sql, params = self.query_builder(qset).select('*', limit, offset)
-        cursor.execute(self.fix_quote(sql), params)
+    def compile(self, qset, build, *key):
+        """Compile the given query set into an SQL statement. The statement is
+        cached on the shape of the query set (see :meth:`QSet.shape`) and the
+        given key, so queries of same shape are compiled only once.
+
+        The parameters of the statement should be the values returned by
+        :meth:`QSet.params` preceded or followed by the additional values the
+        statement is built with.
+
+        :param qset: the query set
+        :param build: a callable that builds the statement from a
+                      :class:`QueryBuilder` instance
+        :param key: additional values to be used as cache key
+
+        :returns: the SQL statement
+        """
+        key = (self.__class__, qset.shape()) + key
+        sql = self.statement_cache.get(key)
+        if sql is None:
+            sql = self.fix_quote(build(self.query_builder(qset)))
+            self.statement_cache.set(key, sql)
+        return sql
+
+    def select(self, qset, limit, offset, names=None, cursor=None):
+        """Execute the select statement for the given query set and return
+        the cursor. Only the columns of the given field names are selected if
+        provided. The statement is executed with the given cursor if any.
+        """
+        cursor = cursor or self.cursor()
+        params = qset.params()
+        if limit > -1:
+            params.append(limit)
+            if offset > -1:
+                params.append(offset)
+        sql = self.compile(qset,
+                lambda b: b.select(b.columns(qset.related, names), limit, offset)[0],
+                'select', limit > -1, limit > -1 and offset > -1, names)
+        self.execute(cursor, sql, params)
+        return cursor
+
+    def fetch(self, qset, limit, offset, batch_size=None):
+        cursor = self.select(qset, limit, offset)
         names = [desc[0] for desc in cursor.description]
-        for row in cursor.fetchall():
+        for row in _iter_rows(cursor, batch_size or self.fetch_size):
             yield dict([(name, row[i]) for i, name in enumerate(names)])
 
+    def load(self, qset, limit, offset, batch_size=None):
+        cursor = self.select(qset, limit, offset)
+        loader = qset.model._loader(tuple([d[0] for d in cursor.description]))
+        batch_size = batch_size or self.fetch_size
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            # deferred values are loaded at once for the rows read together
+            batch = {}
+            for row in rows:
+                yield loader(row, batch)
+
+    def values(self, qset, names, limit, offset, batch_size=None):
+        cursor = self.select(qset, limit, offset, names)
+        identity = Field.database_to_python.im_func
+        convs = [_resolve(qset.model, name).database_to_python for name in names]
+        convs = [(i, conv) for i, conv in enumerate(convs) \
+                if conv.im_func is not identity]
+        for row in _iter_rows(cursor, batch_size or self.fetch_size):
+            if convs:
+                row = list(row)
+                for i, conv in convs:
+                    row[i] = conv(row[i])
+            yield tuple(row)
+
     def count(self, qset):
         cursor = self.cursor()
-        sql, params = self.query_builder(qset).select('count("key")')
-        sql = re.sub(' ORDER BY "\w+" (ASC|DESC)', '', sql)
-        cursor.execute(self.fix_quote(sql), params)
+        def build(builder):
+            builder.order = ()
+            return builder.select('count(%s)' % builder.column('key'))[0]
+        sql = self.compile(qset, build, 'count')
+        self.execute(cursor, sql, qset.params())
         try:
             return cursor.fetchone()[0]
         except:
             return 0
 
 
+    def exists(self, qset):
+        cursor = self.cursor()
+        def build(builder):
+            builder.order = ()
+            return builder.select('1', 1)[0]
+        sql = self.compile(qset, build, 'exists')
+        self.execute(cursor, sql, qset.params() + [1])
+        return cursor.fetchone() is not None
+
+    def aggregate(self, qset, group_by, aggregates):
+        cursor = self.cursor()
+        group_by = tuple(group_by)
+        functions = tuple([(a.function, a.name) for a in aggregates])
+        sql = self.compile(qset, lambda b: b.aggregate(group_by, functions)[0],
+                           'aggregate', group_by, functions)
+        self.execute(cursor, sql, qset.params())
+
+        convs = [_resolve(qset.model, name).database_to_python for name in group_by]
+        for a in aggregates:
+            field = _resolve(qset.model, a.name)
+            if a.typed:
+                convs.append(lambda v, field=field: self.aggregate_to_python(field, v))
+            else:
+                convs.append(lambda v: v)
+        return [tuple([conv(v) for conv, v in zip(convs, row)])
+                for row in cursor.fetchall()]
+
+    def aggregate_to_python(self, field, value):
+        """Convert the aggregated value of the given field, like the sum or
+        the largest value, to python representation for the field. Engines
+        not reporting the types of the aggregated values should override it.
+        """
+        return field.database_to_python(value)
+
+
+def _batches(iterable, size):
+    """Split the given iterable into lists of given size, the last one may be
+    shorter.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+def _iter_rows(cursor, size):
+    """Iterate over the rows of the cursor, reading given number of rows
+    at a time.
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def _dirty_names(obj):
+    """Returns sorted tuple of names of the dirty fields of the given model
+    instance, which are to be stored in the database.
+    """
+    fields = obj._meta.fields
+    return tuple(sorted([k for k in obj._dirty if k != 'key' and k in fields]))
+
+
 class QueryBuilder(object):
     """The SQL query builder for relational database engines.
+
+    Dotted field names (like ``page.name``) in filters and ordering are
+    resolved through the reference fields and compiled to ``LEFT JOIN``
+    clauses.
     """
 
     op_alias = {
@@ -227,14 +636,11 @@ class QueryBuilder(object):
     def __init__(self, qset):
         self.qset = qset
         self.model = qset.model
-        self.order = None
+        self.table = qset.model._meta.table
+        self.order = qset.ordering()
+        self.joins = OrderedDict()
         self.all = []
 
-        try:
-            self.order = "ORDER BY \"%s\" %s" % tuple(qset.order)
-        except:
-            pass
-
         for q in qset:
             if len(q.items) > 1:
                 statements = []
@@ -252,83 +658,330 @@ class QueryBuilder(object):
                 name, op, val = q.items[0]
                 self.all.append(self.parse(name, op, val))
 
-    def select(self, what, limit=None, offset=None):
-        """Build the select query.
+        if qset.seek:
+            self.all.append(self.seek(self.order, qset.seek))
+
+    def seek(self, order, values):
+        """Build the condition selecting the records following the given
+        values of the ordering columns, like ``(a > %s) OR (a = %s AND b > %s)``
+        for ascending columns `a` and `b`. The NULL values are compared with
+        ``IS NULL`` and placed in the order as the database does (see
+        :attr:`nulls_first`).
+
+        :param order: list of `(name, direction)` tuples
+        :param values: the values of the ordering columns of the record to follow
+
+        :returns: a tuple `(str, params)`
         """
-        query = "SELECT %s FROM \"%s\"" % (what, self.model._meta.table)
-        if self.all:
-            query = "%s WHERE %s" % (query, " AND ".join(["(%s)" % s for s, b in self.all]))
-        if self.order:
-            query = "%s %s" % (query, self.order)
-        if limit > -1:
-            query = "%s LIMIT %d" % (query, limit)
-            if offset > -1:
-                query = "%s OFFSET %d" % (query, offset)
+        clauses = []
+        params = []
+        for i, (name, how) in enumerate(order):
+            items = []
+            for (n, h), value in zip(order[:i], values[:i]):
+                column = self.column(n)
+                if value is None:
+                    items.append('%s IS NULL' % column)
+                else:
+                    items.append('%s = %%s' % column)
+                    params.append(value)
+            items.append(self.follows(self.column(name), how, values[i]))
+            if values[i] is not None:
+                params.append(values[i])
+            clauses.append("(%s)" % " AND ".join(items))
+        return " OR ".join(clauses), params
+
+    #: whether NULL comes before the other values in ascending order, as on
+    #: SQLite and MySQL
+    nulls_first = True
+
+    def follows(self, column, how, value):
+        """Build the condition selecting the values of the given column
+        following the given value in the given direction.
+        """
+        nulls_last = self.nulls_first == (how == 'DESC')
+        if value is None:
+            return '1 = 0' if nulls_last else '%s IS NOT NULL' % column
+        sql = '%s %s %%s' % (column, '>' if how == 'ASC' else '<')
+        if nulls_last:
+            return '(%s OR %s IS NULL)' % (sql, column)
+        return sql
+
+    def column(self, name):
+        """Get the qualified column name for the given field name. If the name
+        is a dotted name, the required tables are joined.
+
+        :param name: field name, can be dotted name like `page.name`
+        """
+        parts = name.split('.')
+        model = self.model
+        alias = self.table
+        path = None
+        for part in parts[:-1]:
+            field = model._meta.fields.get(part) or \
+                    model._meta.virtual_fields.get(part)
+            path = "%s.%s" % (path, part) if path else part
+            alias = self.join(path, alias, field)
+            model = field.reference
+        return '"%s"."%s"' % (alias, parts[-1])
+
+    def join(self, path, parent, field):
+        """Join the table referenced by the given field.
+
+        :param path: the dotted path of the field
+        :param parent: alias of the table the field belongs to
+        :param field: a :class:`ManyToOne` field
+
+        :returns: alias of the joined table
+        """
+        try:
+            return self.joins[path][0]
+        except KeyError:
+            pass
+        alias = "t%d" % (len(self.joins) + 1)
+        cond = '"%s"."key" = "%s"."%s"' % (alias, parent, field.name)
+        self.joins[path] = (alias, 'LEFT JOIN "%s" AS "%s" ON %s' % (
+                field.reference._meta.table, alias, cond))
+        return alias
+
+    def columns(self, related=(), names=None):
+        """Get the columns to be selected, all the columns of the model table
+        and of the tables of the given related fields, which are labeled with
+        dotted names.
+
+        :param related: sequence of dotted names of :class:`ManyToOne` fields
+        :param names: if given, only the columns of these field names
+        """
+        if names:
+            return ", ".join(map(self.column, names))
+        deferred = self.qset.deferred
+        if deferred:
+            result = ['"%s"."%s"' % (self.table, name) for name, field in
+                      self.model._meta.fields.items()
+                      if field.data_type is not None and name not in deferred]
+        else:
+            result = ['"%s".*' % self.table]
+        for path in related:
+            model = self.model
+            for part in path.split('.'):
+                model = model._meta.fields[part].reference
+            for name, field in model._meta.fields.items():
+                if field.data_type is None or field.is_deferred:
+                    continue
+                result.append('%s AS "%s.%s"' % (
+                    self.column("%s.%s" % (path, name)), path, name))
+        return ", ".join(result)
+
+    def source(self):
+        """Build the FROM clause, including the joins.
+        """
+        result = 'FROM "%s"' % self.table
+        if self.joins:
+            result = "%s %s" % (result, " ".join([j for a, j in self.joins.values()]))
+        return result
 
+    def where(self):
+        """Build the WHERE clause.
+
+        :returns: a tuple `(str, params)`, the str is empty if there is no
+                  filter.
+        """
         params = []
         for q, v in self.all:
             if isinstance(v, (list, tuple)):
                 params.extend(v)
             else:
                 params.append(v)
+        if not self.all:
+            return "", params
+        return "WHERE %s" % " AND ".join(["(%s)" % s for s, b in self.all]), params
+
+    def ordering(self):
+        """Build the ORDER BY clause of the list of `(name, direction)` tuples
+        given by :attr:`order`, which can be cleared to build statements not
+        depending on the order, like counting the records.
+
+        :returns: the ORDER BY clause or an empty string
+        """
+        if not self.order:
+            return ""
+        return "ORDER BY %s" % ", ".join(
+            ["%s %s" % (self.column(n), how) for n, how in self.order])
+
+    def select(self, what, limit=None, offset=None):
+        """Build the select query.
+        """
+        # the joins required by the ordering are added first
+        order = self.ordering()
+        query = "SELECT %s %s" % (what, self.source())
+        where, params = self.where()
+        if where:
+            query = "%s %s" % (query, where)
+        if order:
+            query = "%s %s" % (query, order)
+        if limit > -1:
+            query = "%s LIMIT %%s" % query
+            params.append(limit)
+            if offset > -1:
+                query = "%s OFFSET %%s" % query
+                params.append(offset)
+        return query, params
+
+    def aggregate(self, group_by, functions):
+        """Build the select query computing the given aggregate functions for
+        each group of the given fields.
+
+        :param group_by: sequence of field names
+        :param functions: sequence of (function name, field name) tuples
+        """
+        groups = map(self.column, group_by)
+        what = groups + ['%s(%s)' % (f, self.column(n)) for f, n in functions]
+        query = "SELECT %s %s" % (", ".join(what), self.source())
+        where, params = self.where()
+        if where:
+            query = "%s %s" % (query, where)
+        if groups:
+            query = "%s GROUP BY %s ORDER BY %s" % (
+                query, ", ".join(groups), ", ".join(groups))
+        return query, params
+
+    def nested(self, query):
+        """Build the nested select statement of the given query used as the
+        value of an ``in`` or ``not in`` filter.
+
+        :returns: a tuple `(str, params)`
+        """
+        qset, name = query._subquery()
+        builder = self.__class__(qset)
+        builder.order = ()
+        return builder.select(builder.column(name))
+
+    def subquery(self, sql):
+        """Prepare the given select statement to be used as a subquery of a
+        statement modifying the same table.
+        """
+        return sql
+
+    def filtered(self):
+        """Build the condition to restrict a DELETE or UPDATE statement to the
+        matched records. If the query has joins, the keys are selected with a
+        subquery.
+
+        :returns: a tuple `(str, params)`
+        """
+        if not self.joins:
+            return self.where()
+        sql, params = self.select(self.column('key'))
+        return 'WHERE "key" IN (%s)' % self.subquery(sql), params
 
+    def delete(self):
+        """Build the delete query.
+        """
+        query = "DELETE FROM \"%s\"" % self.table
+        where, params = self.filtered()
+        if where:
+            query = "%s %s" % (query, where)
         return query, params
 
+    def update(self, values):
+        """Build the update query.
+
+        :param values: a list of `(name, value)` tuples to be set
+        """
+        query = "UPDATE \"%s\" SET %s" % (self.table,
+                ", ".join(['"%s" = %%s' % k for k, v in values]))
+        where, params = self.filtered()
+        if where:
+            query = "%s %s" % (query, where)
+        return query, [v for k, v in values] + params
+
     def parse(self, name, operator, value):
         """Parse the simple query statement.
 
-        :param name: name of the field
+        :param name: name of the field, can be a dotted name
         :param operator: the operator
         :param value: the filter values
 
         :returns: a tuple `(str, value)`
         :rtype: tuple
         """
-        field = self.model._meta.fields[name]
+        parts = name.split('.')
+        model = self.model
+        for i, part in enumerate(parts[:-1]):
+            field = model._meta.fields.get(part) or \
+                    model._meta.virtual_fields.get(part)
+            if isinstance(field, OneToMany):
+                return self.reverse(parts[:i], field, '.'.join(parts[i+1:]),
+                                    operator, value)
+            model = field.reference
+        field = model._meta.fields[parts[-1]]
 
         op = operator.lower()
         op = self.op_alias.get(op, op)
 
+        if isinstance(value, Query):
+            sql, params = self.nested(value)
+            return '%s %s (%s)' % (self.column(name), op.replace('_', ' ').upper(), sql), params
+
         handler = getattr(self, 'handle_%s' % op)
         validator = getattr(self, 'validate_%s' % op, self.validate)
         value = validator(field, value)
 
-        return handler(name, value), value
+        return handler(self.column(name), value), value
+
+    def reverse(self, path, field, name, operator, value):
+        """Build the condition selecting the records with at least one record
+        related by the given :class:`OneToMany` field matching the filter.
+        Unlike a join, it doesn't repeat the records for every match.
+
+        :param path: the dotted path of the model of the field, as a list
+        :param field: the :class:`OneToMany` field
+        :param name: the field name of the related model to filter by
+
+        :returns: a tuple `(str, params)`
+        """
+        qset = QSet(field.reference)
+        # the value is already converted by Q.validate
+        qset.items.append(Q('%s %s' % (name, operator), value))
+        builder = self.__class__(qset)
+        builder.order = ()
+        sql, params = builder.select(builder.column(field.reverse_name))
+        return '%s IN (%s)' % (self.column('.'.join(path + ['key'])), sql), params
 
     def validate(self, field, value):
-        return field.python_to_database(value)
+        # the values are already converted by Q.validate
+        return value
 
     def validate_in(self, field, value):
         assert isinstance(value, (list, tuple))
-        return [field.python_to_database(v) for v in value]
+        return value
 
     def validate_not_in(self, field, value):
         return self.validate_in(field, value)
 
     def handle_in(self, name, value):
-        return '"%s" IN (%s)' % (name, ', '.join(['%s'] * len(value)))
+        return '%s IN (%s)' % (name, ', '.join(['%s'] * len(value)))
 
     def handle_not_in(self, name, value):
         assert isinstance(value, (list, tuple))
-        return '"%s" NOT IN (%s)' % (name, ', '.join(['%s'] * len(value)))
+        return '%s NOT IN (%s)' % (name, ', '.join(['%s'] * len(value)))
 
     def handle_like(self, name, value):
-        return '"%s" LIKE %%s' % (name)
+        return '%s LIKE %%s' % (name)
 
     def handle_eq(self, name, value):
-        return '"%s" = %%s' % (name)
+        return '%s = %%s' % (name)
 
     def handle_neq(self, name, value):
-        return '"%s" != %%s' % (name)
+        return '%s != %%s' % (name)
 
     def handle_gt(self, name, value):
-        return '"%s" > %%s' % (name)
+        return '%s > %%s' % (name)
 
     def handle_lt(self, name, value):
-        return '"%s" < %%s' % (name)
+        return '%s < %%s' % (name)
 
     def handle_gte(self, name, value):
-        return '"%s" >= %%s' % (name)
+        return '%s >= %%s' % (name)
 
     def handle_lte(self, name, value):
-        return '"%s" <= %%s' % (name)
+        return '%s <= %%s' % (name)
@@ -0,0 +1,199 @@
+"""
+kalapy.db.engines.sharding
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+This module implements the horizontal sharding of the models declaring a
+shard key field with ``__shard__``. The records of such models are stored in
+the databases configured with ``DATABASE_SHARDS`` setting instead of the
+primary database.
+
+A new record is stored in the shard picked by the hash of its shard key
+value. The keys of the records are allocated in distinct ranges per shard of
+``DATABASE_SHARD_KEY_RANGE`` keys each, so the keys are unique across the
+shards and the shard of an existing record is known from its key.
+
+The queries filtering by the shard key or by the key are sent to the
+matching shards only, other queries are sent to all the shards and the
+results are merged.
+
+:copyright: (c) 2010 Amit Mendapara.
+:license: BSD, see LICENSE for more details.
+"""
+import sys
+import threading
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from kalapy.db.engines.interface import IDatabase
+
+
+__all__ = ('Router', 'FanOut')
+
+
+class Router(object):
+    """Maps the records of the sharded models to the shards.
+
+    :param pools: the list of connection pools of the shards
+    :param key_range: number of keys allocated to each shard
+    """
+
+    def __init__(self, pools, key_range):
+        self.pools = pools
+        self.key_range = key_range
+
+    @property
+    def size(self):
+        """Number of shards.
+        """
+        return len(self.pools)
+
+    def first_key(self, shard):
+        """Returns the first key allocated to the given shard.
+        """
+        return shard * self.key_range + 1
+
+    def shard_by_key(self, key):
+        """Returns the shard of the record with the given key.
+        """
+        return int((key - 1) // self.key_range) % self.size
+
+    def shard_by_value(self, value):
+        """Returns the shard of the new records with the given shard key value.
+        """
+        from kalapy.db.model import Model
+        if isinstance(value, Model):
+            value = value.key
+        if isinstance(value, (int, long)):
+            value = int(value)
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return int(md5(repr(value)).hexdigest()[:8], 16) % self.size
+
+    def shard_of(self, obj):
+        """Returns the shard of the given model instance.
+        """
+        if obj.is_saved:
+            return self.shard_by_key(obj.key)
+        return self.shard_by_value(obj._values.get(obj._meta.shard))
+
+    def shards(self, qset):
+        """Returns the sorted list of shards which may hold the records matched
+        by the given query set, by its ``==`` and ``in`` conditions on the
+        shard key and on the key.
+        """
+        result = set(range(self.size))
+        shard = qset.model._meta.shard
+        for q in qset.items:
+            if len(q.items) != 1:
+                continue
+            name, op, value = q.items[0]
+            if op == '==':
+                values = [value]
+            elif op == 'in' and isinstance(value, (list, tuple)):
+                values = value
+            else:
+                continue
+            if name == 'key':
+                result &= set([self.shard_by_key(v) for v in values
+                                if v is not None])
+            elif name == shard:
+                result &= set([self.shard_by_value(v) for v in values])
+        result = list(result)
+        result.sort()
+        return result
+
+
+class FanOut(IDatabase):
+    """Reads the records matched by a query set from several shards and merges
+    the results honoring the order and the limits of the query set. The shards
+    are queried concurrently if their connections can be used by several
+    threads (see :attr:`IDatabase.threadsafety`), one after another otherwise.
+
+    The query sets ordering by or selecting dotted names, selecting related
+    records or deferring fields are not supported across the shards and raise
+    :class:`TypeError`.
+
+    :param databases: the list of connected databases of the shards
+    """
+
+    def __init__(self, databases):
+        self.databases = databases
+
+    def map(self, func):
+        """Call the given function with each database and return the list of
+        the results.
+        """
+        databases = self.databases
+        if len(databases) < 2 or \
+           min([db.threadsafety for db in databases]) < 2:
+            return map(func, databases)
+
+        results = [None] * len(databases)
+        errors = []
+        def run(i, db):
+            try:
+                results[i] = func(db)
+            except Exception:
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=run, args=(i, db))
+                   for i, db in enumerate(databases)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return results
+
+    def check(self, qset, names=()):
+        """Check the given query set, and the given names of the fields to
+        select, can be read from several shards.
+
+        :raises: :class:`TypeError` if not supported
+        """
+        model = qset.model._meta.name
+        for name, how in qset.ordering():
+            if '.' in name:
+                raise TypeError(
+                    _('Sharded model %(model)r can not be ordered by %(name)r',
+                        model=model, name=name))
+        for name in names:
+            if '.' in name:
+                raise TypeError(
+                    _('Sharded model %(model)r can not select %(name)r',
+                        model=model, name=name))
+        if qset.related or qset.deferred:
+            raise TypeError(
+                _('Sharded model %(model)r can not select related records or '
+                  'defer fields across shards', model=model))
+
+    def fetch(self, qset, limit, offset, batch_size=None):
+        self.check(qset)
+        order = qset.ordering()
+
+        size = -1 if limit < 0 else limit + offset
+        rows = []
+        for result in self.map(
+                lambda db: list(db.fetch(qset, size, 0, batch_size))):
+            rows.extend(result)
+
+        for name, how in reversed(order):
+            rows.sort(key=lambda row: row.get(name), reverse=how == 'DESC')
+
+        if limit < 0:
+            return iter(rows[offset:])
+        return iter(rows[offset:offset + limit])
+
+    def values(self, qset, names, limit, offset, batch_size=None):
+        self.check(qset, names)
+        return super(FanOut, self).values(qset, names, limit, offset, batch_size)
+
+    def count(self, qset):
+        return sum(self.map(lambda db: db.count(qset)))
+
+    def exists(self, qset):
+        return True in self.map(lambda db: db.exists(qset))
@@ -10,6 +10,7 @@ SQLite3 backend engine.
 import os, decimal
 import sqlite3 as dbapi
 
+from kalapy.conf import settings
 from kalapy.db.engines import utils
 from kalapy.db.engines.relational import RelationalDatabase
 
@@ -29,6 +30,12 @@ IntegrityError = dbapi.IntegrityError
 
 
 class Database(RelationalDatabase):
+    """The SQLite database. The following ``DATABASE_OPTIONS`` are supported:
+
+    - ``foreign_keys`` whether to enforce the foreign key constraints and their
+      ``ON DELETE`` rules with ``PRAGMA foreign_keys`` (default False, as
+      SQLite does)
+    """
 
     data_types = {
         "key"       :   "INTEGER PRIMARY KEY AUTOINCREMENT",
@@ -43,6 +50,8 @@ class Database(RelationalDatabase):
         "binary"    :   "BLOB",
     }
 
+    threadsafety = dbapi.threadsafety
+
     def connect(self):
         if self.connection is not None:
             return self
@@ -52,9 +61,20 @@ class Database(RelationalDatabase):
                 raise DatabaseError(
                     _("Database %(name)r doesn't exist.", name=self.name))
 
-        self.connection = dbapi.connect(self.name, detect_types=dbapi.PARSE_DECLTYPES)
+        # pooled connections are used by one thread at a time
+        self.connection = dbapi.connect(self.name, detect_types=dbapi.PARSE_DECLTYPES,
+                                        check_same_thread=False)
+        if settings.DATABASE_OPTIONS.get('foreign_keys', False):
+            self.connection.execute('PRAGMA foreign_keys = ON')
         return self
 
+    def begin_snapshot(self, snapshot=None):
+        # the reads of a transaction see the same data, but the SELECT
+        # statements don't start one implicitly
+        self.rollback()
+        self.cursor().execute('BEGIN')
+        return None
+
     def exists_table(self, model):
         cursor = self.cursor()
         cursor.execute("""
@@ -63,6 +83,29 @@ class Database(RelationalDatabase):
             """, (model._meta.table,))
         return bool(cursor.fetchone())
 
+    def exists_index(self, model, name):
+        cursor = self.cursor()
+        cursor.execute("""
+            SELECT "name" FROM sqlite_master
+                WHERE type = "index" AND name = %s;
+            """, (name,))
+        return bool(cursor.fetchone())
+
+    def set_next_key(self, model, key):
+        cursor = self.cursor()
+        cursor.execute('DELETE FROM sqlite_sequence WHERE name = %s',
+                       (model._meta.table,))
+        cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)',
+                       (model._meta.table, key - 1))
+
+    def aggregate_to_python(self, field, value):
+        # the declared types of the aggregated columns are not detected
+        if isinstance(value, basestring) and field.data_type == 'datetime':
+            value = utils.datetime_to_python(value)
+        elif value is not None and field.data_type == 'decimal':
+            value = utils.decimal_to_python(str(value))
+        return super(Database, self).aggregate_to_python(field, value)
+
 
     def cursor(self):
         if not self.connection:
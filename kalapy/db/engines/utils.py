@@ -59,3 +59,27 @@ def str_to_database(value):
     """
     return value.decode('utf-8')
 
+def value_to_text(value):
+    """Convert the given database value to the tab separated text format read
+    by PostgreSQL ``COPY`` and MySQL ``LOAD DATA`` statements. None is
+    written as ``\\N`` and the special characters are escaped with ``\\``.
+    """
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        return value and '1' or '0'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, datetime.datetime):
+        value = value.isoformat(' ')
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+                .replace('\n', '\\n').replace('\r', '\\r')
+
+def row_to_text(row):
+    """Convert the given row of database values to a line of the tab separated
+    text format (see :func:`value_to_text`).
+    """
+    return '%s\n' % '\t'.join([value_to_text(v) for v in row])
+
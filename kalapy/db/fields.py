@@ -50,6 +50,8 @@ class Field(object):
           one of the key.
         - a callable that returns a list of (value, string) tuple
     :param validator: a validator function to validate the field values
+    :param deferred: whether the field value should be loaded from the
+                     database only when accessed, useful for large values
     """
 
     # for internal use only
@@ -58,7 +60,8 @@ class Field(object):
     _data_type = "char"
 
     def __init__(self, label=None, name=None, default=None, required=False,
-        unique=False, indexed=False, selection=None, validator=None):
+        unique=False, indexed=False, selection=None, validator=None,
+        deferred=False):
         """Create a new instance of this :class:`Field`.
         """
 
@@ -71,6 +74,7 @@ class Field(object):
         self._required = required
         self._unique = unique
         self._indexed = indexed
+        self._deferred = deferred
 
         self._selection = selection() if callable(selection) else selection
         self._selection_list = [x[0] for x in self._selection] if self._selection else []
@@ -90,12 +94,16 @@ class Field(object):
     def __get__(self, model_instance, model_class):
         if model_instance is None:
             return self
+        if self.name in model_instance._deferred:
+            model_instance._load_deferred()
         return model_instance._values.get(self.name)
 
     def __set__(self, model_instance, value):
         value = self._validate(model_instance, value)
         model_instance._values[self.name] = value
         model_instance._dirty[self.name] = True
+        if self.name in model_instance._deferred:
+            model_instance._deferred = model_instance._deferred - set([self.name])
 
     def python_to_database(self, value):
         """Database representation of this field value.
@@ -219,6 +227,12 @@ class Field(object):
         """
         return self._indexed
 
+    @property
+    def is_deferred(self):
+        """Whether the value of this field is loaded only when accessed.
+        """
+        return self._deferred
+
 
 class AutoKey(Field):
     """AutoKey field is used to define primary key of Model classes.
@@ -538,8 +552,16 @@ def _parse_datetime(value, type=datetime.datetime):
         datetime.time: '%H:%M:%S'
     }
     format = formats[type]
+    # fraction of seconds, as written by str() of datetime and time values
+    micro = 0
+    if type is not datetime.date and '.' in value:
+        value, fraction = value.rsplit('.', 1)
+        if not fraction.isdigit() or len(fraction) > 6:
+            raise ValidationError(
+                _('Invalid fraction of seconds: %(value)s', value=fraction))
+        micro = int(fraction.ljust(6, '0'))
     try:
-        value = datetime.datetime.strptime(value, format)
+        value = datetime.datetime.strptime(value, format).replace(microsecond=micro)
     except ValueError, e:
         raise ValidationError(e)
     try:
@@ -8,11 +8,12 @@ and get_models functions.
 :copyright: (c) 2010 Amit Mendapara.
 :license: BSD, see LICENSE for more details.
 """
-import sys, types
+import sys, copy, types
 
 from kalapy.core.pool import pool
 from kalapy.db.fields import Field, AutoKey, FieldError
-from kalapy.db.query import Query
+from kalapy.db.query import Query, _resolve
+from kalapy.db.session import current_session
 from kalapy.utils.containers import OrderedDict
 
 
@@ -33,6 +34,10 @@ class Options(object):
         self.virtual_fields = OrderedDict()
         self.ref_models = []
         self.unique = []
+        self.indexes = []
+        self.shard = None
+        self.loaders = {}
+        self.cache = {}
 
     @property
     def model(self):
@@ -104,6 +109,11 @@ class ModelType(type):
 
         # update meta information
         unique = attrs.pop('__unique__', [])
+        indexes = attrs.pop('__indexes__', [])
+        shard = attrs.pop('__shard__', None)
+        if '__cache__' in attrs:
+            meta.cache.clear()
+            meta.cache.update(attrs.pop('__cache__') or {})
         if meta.name is None:
             meta_name = name.lower()
             if meta.package:
@@ -117,6 +127,7 @@ class ModelType(type):
 
         # overwrite model class in the pool
         pool.register_model(cls)
+        meta.loaders.clear()
 
         cls._values = None
 
@@ -153,6 +164,30 @@ class ModelType(type):
                 assert isinstance(field, Field), 'expected a field'
             meta.unique.append(item)
 
+        # prepare indexes, a list of (field, descending) tuples for each
+        for item in indexes:
+            item = list(item) if isinstance(item, (list, tuple)) else [item]
+            for i, field in enumerate(item):
+                desc = False
+                if isinstance(field, basestring):
+                    desc = field.startswith('-')
+                    field = meta.fields.get(field.lstrip('-'))
+                if not isinstance(field, Field) or field.data_type is None:
+                    raise AttributeError(
+                        _('No such field %(name)r in model %(model)r',
+                            name=item[i], model=meta.name))
+                item[i] = (field, desc)
+            meta.indexes.append(tuple(item))
+
+        # the name of the shard key field
+        if shard is not None and shard != meta.shard:
+            field = meta.fields.get(shard)
+            if field is None or field.data_type is None:
+                raise AttributeError(
+                    _('No such field %(name)r in model %(model)r',
+                        name=shard, model=meta.name))
+            meta.shard = shard
+
         return cls
 
     def add_field(cls, field, name=None):
@@ -175,6 +210,7 @@ class ModelType(type):
             cls._meta.fields[name] = field
 
         field.__configure__(cls, name)
+        cls._meta.loaders.clear()
 
     def __repr__(cls):
         return "<Model %r: class %s>" % (cls._meta.name, cls.__name__)
@@ -282,6 +318,35 @@ class Model(object):
     >>> u = User(name="some")
     >>> u.save()
 
+    The records of frequently read and rarely changed models can be cached
+    across requests by declaring the cache options (see ``CACHE_ENGINE``
+    setting)::
+
+        class Page(Model):
+            name = String(unique=True)
+
+            __cache__ = dict(ttl=300)
+
+    The fields declared with `indexed=True` and the :class:`ManyToOne` fields
+    are indexed. Indexes on multiple fields are declared by the field names,
+    prefixed with `-` for descending order::
+
+        class Revision(Model):
+            page = ManyToOne(Page)
+            timestamp = DateTime()
+
+            __indexes__ = [('page', '-timestamp')]
+
+    The records of a model declaring a shard key field are distributed over
+    the databases configured with ``DATABASE_SHARDS`` setting by the value of
+    that field (see :mod:`kalapy.db.engines.sharding`). The shard key of a
+    saved record can't be changed::
+
+        class Revision(Model):
+            page = ManyToOne(Page)
+
+            __shard__ = 'page'
+
     `key`
 
         Represents the key field for the data model (primary key).
@@ -291,6 +356,12 @@ class Model(object):
 
     __metaclass__ = ModelType
 
+    #: names of the fields not loaded from the database yet
+    _deferred = frozenset()
+
+    #: list of instances loaded together, to load deferred fields at once
+    _batch = None
+
     def __new__(cls, **kw):
         if cls is Model:
             raise TypeError(_("You can't create instance of Model class"))
@@ -386,14 +457,210 @@ class Model(object):
         obj._key = values.pop('key', None)
         obj._payload = values.pop('_payload', None)
 
-        fields = obj.fields()
+        # values of the related instances are labeled with dotted names
+        related = {}
+        for k in [k for k in values if '.' in k]:
+            name, rest = k.split('.', 1)
+            related.setdefault(name, {})[rest] = values.pop(k)
+
+        fields = cls._meta.fields
         for k, v in values.items():
             values[k] = fields[k].database_to_python(v)
 
+        for k, v in related.items():
+            if v.get('key') is not None:
+                values[k] = fields[k].reference._from_database_values(v)
+
         obj._values.update(values)
         obj._dirty = {}
         return obj
 
+    @classmethod
+    def _loader(cls, names):
+        """Returns a function to create instances of this model from the
+        database rows with the given column names. Values of the related
+        instances are expected to be labeled with dotted names.
+
+        The function is created once per model and column names and the
+        instances are created without calling the constructor, only the
+        fields with custom database_to_python are converted. The fields
+        without column are deferred (see :meth:`Query.defer`).
+
+        :param names: tuple of column names of the rows
+
+        :returns: a function taking a row and an optional dict of deferred
+                  loading batches by model and returning an instance
+        """
+        meta = cls._meta
+        try:
+            return meta.loaders[names]
+        except KeyError:
+            pass
+
+        klass = pool.get_model(cls)
+        fields = meta.fields
+        identity = Field.database_to_python.im_func
+
+        key = None
+        plain, convert, related = [], [], OrderedDict()
+        deferred = set([n for n, f in fields.items()
+                        if n != 'key' and f.data_type is not None])
+        for i, name in enumerate(names):
+            if '.' in name:
+                name, rest = name.split('.', 1)
+                related.setdefault(name, []).append((i, rest))
+            elif name == 'key':
+                key = i
+            elif name in fields:
+                deferred.discard(name)
+                conv = fields[name].database_to_python
+                if conv.im_func is identity:
+                    plain.append((name, i))
+                else:
+                    convert.append((name, i, conv))
+
+        subloaders = []
+        for name, items in related.items():
+            rest = tuple([n for i, n in items])
+            if name not in fields or 'key' not in rest:
+                continue
+            sub = fields[name].reference._loader(rest)
+            subloaders.append((name, [i for i, n in items],
+                               items[rest.index('key')][0], sub))
+
+        new = object.__new__
+        deferred = frozenset(deferred)
+
+        def load(row, batch=None):
+            obj = new(klass)
+            obj._key = row[key] if key is not None else None
+            obj._payload = None
+            obj._values = values = dict([(n, row[i]) for n, i in plain])
+            for n, i, conv in convert:
+                values[n] = conv(row[i])
+            for n, indices, k, sub in subloaders:
+                if row[k] is not None:
+                    values[n] = sub([row[i] for i in indices], batch)
+            obj._dirty = {}
+            if deferred:
+                obj._deferred = deferred
+                if batch is not None:
+                    obj._batch = batch.setdefault(klass, [])
+                    obj._batch.append(obj)
+            return obj
+
+        meta.loaders[names] = load
+        return load
+
+    @classmethod
+    def _from_cache(cls, key, values, refs):
+        """Create an instance of this model from the values read from the
+        model cache (see :mod:`kalapy.db.cache`). The fields not cached are
+        deferred.
+
+        :param key: the record key
+        :param values: mapping of field names to python values
+        :param refs: names of the reference fields, whose values are keys
+
+        :returns: an instance of this model
+        """
+        fields = cls._meta.fields
+        obj = object.__new__(pool.get_model(cls))
+        obj._key = key
+        obj._payload = None
+        obj._values = values = dict(values)
+        obj._dirty = {}
+        for name in refs:
+            values[name] = fields[name].database_to_python(values[name])
+        deferred = frozenset([n for n, f in fields.items() if n != 'key' \
+                        and f.data_type is not None and n not in values])
+        if deferred:
+            obj._deferred = deferred
+        return obj
+
+    @classmethod
+    def _from_key(cls, key, batch=None):
+        """Create a lazy instance of this model for the given key. None of the
+        field values are loaded until any of them is accessed.
+
+        :param key: the record key
+        :param batch: a list of lazy instances to be loaded together, the new
+                      instance will be added to the list
+
+        :returns: an instance of this model
+        """
+        session = current_session()
+        if session is not None:
+            obj = session.get(cls, key)
+            if obj is not None:
+                return obj
+
+        obj = cls.__new__(cls)
+        obj._key = key
+        obj._payload = None
+        obj._values = {}
+        obj._dirty = {}
+        obj._deferred = frozenset([n for n in cls._meta.fields if n != 'key'])
+        if batch is None:
+            batch = []
+        batch.append(obj)
+        obj._batch = batch
+        if session is not None:
+            session.add(obj)
+        return obj
+
+    def _merge(self, other):
+        """Update the deferred field values of this instance with the values
+        of the given instance of the same record.
+
+        :param other: an instance loaded from the database or None if the
+                      record doesn't exist
+        """
+        if other is None:
+            self._deferred = frozenset()
+            return
+        for k, v in other._values.items():
+            if k in self._deferred:
+                self._values[k] = v
+        self._payload = other._payload
+        # the values deferred by the other instance are loaded with its batch
+        self._deferred = self._deferred & other._deferred
+        if self._deferred and other._batch is not None:
+            self._batch = other._batch
+            self._batch.append(self)
+
+    def _load_deferred(self):
+        """Load the deferred field values of this instance. The deferred values
+        of all the instances of the batch this instance belongs to are loaded
+        at once.
+        """
+        from kalapy.db.reference import IN_BATCH_SIZE
+
+        batch = [o for o in (self._batch or [self]) if o._deferred]
+        if self not in batch:
+            batch.append(self)
+
+        names = set()
+        for obj in batch:
+            names.update(obj._deferred)
+        names = [n for n, f in self._meta.fields.items()
+                 if n in names and f.data_type is not None]
+
+        keys = list(set([o.key for o in batch if o.is_saved]))
+        loaded = {}
+        for i in range(0, len(keys) if names else 0, IN_BATCH_SIZE):
+            query = self.all().filter('key in', keys[i:i+IN_BATCH_SIZE])
+            for row in query.values_list('key', *names).fetch(-1):
+                loaded[row[0]] = row[1:]
+
+        for obj in batch:
+            if obj.key in loaded:
+                for name, value in zip(names, loaded[obj.key]):
+                    if name in obj._deferred:
+                        obj._values[name] = value
+            obj._deferred = frozenset()
+            obj._batch = None
+
     def _get_related(self):
         """Get the list of all related model instances associated with this
         model instance. Used to get all dirty instances of related model
@@ -424,28 +691,195 @@ class Model(object):
         It also saves all dirty instances of related model instances referenced
         by :class:`ManyToOne` properties.
 
+        Within a session in unit of work mode, the instance is only registered
+        with the session and written when the changes are committed, so the
+        key of a new instance is None till then (see :class:`Session`).
+
         :returns: an unique key id
         :raises: :class:`DatabaseError` if instance could not be commited.
         """
         if self.is_saved and not self.is_dirty:
             return self.key
 
+        session = current_session()
+        if session is not None and session.unit_of_work:
+            session.save(self)
+            return self.key
+
         from kalapy.db.engines import database
 
         objects = self._get_related() + [self] # first save all related records
         database.update_records(*objects)
 
+        if session is not None:
+            map(session.add, objects)
+
         return self.key
 
+    @classmethod
+    def bulk_save(cls, objects):
+        """Writes all the given instances to the database at once.
+
+        The instances are grouped by their dirty fields, so that new records
+        are inserted with multi-row INSERT statements and existing records are
+        updated with a single batched UPDATE statement per group, which is
+        much faster then calling :meth:`save` on every instance.
+
+        >>> User.bulk_save([User(name='some%d' % i) for i in range(1000)])
+
+        Like :meth:`save`, dirty instances of related models referenced by
+        :class:`ManyToOne` properties are also saved.
+
+        :param objects: sequence of instances of this model
+
+        :returns: list of keys of the given instances
+        :raises:
+            - :class:`TypeError`: if any object is not an instance of this model
+            - :class:`DatabaseError`: if instances could not be commited.
+        """
+        objects = list(objects)
+        related = []
+        for obj in objects:
+            if not isinstance(obj, cls):
+                raise TypeError(
+                    _('%(model)r instances required', model=cls._meta.name))
+            related.extend(obj._get_related())
+
+        if not objects:
+            return []
+
+        from kalapy.db.engines import database
+        database.update_records(*(related + objects))
+
+        session = current_session()
+        if session is not None:
+            map(session.add, related + objects)
+
+        return [obj.key for obj in objects]
+
+    @classmethod
+    def bulk_load(cls, rows, names=None, batch_size=1000, restore=False):
+        """Insert the given rows into the database using the fastest way
+        supported by the database engine, ``COPY`` on PostgreSQL, ``LOAD DATA
+        LOCAL INFILE`` on MySQL if the ``local_infile`` option is enabled and
+        a batched INSERT otherwise.
+
+        The rows are validated and converted to database values as they are
+        read, without creating model instances, so any number of rows can be
+        loaded with constant memory.
+
+        >>> User.bulk_load(({'name': name} for name in names), batch_size=5000)
+        >>> User.bulk_load(reader, names=('name', 'lang'))
+
+        The fields not given are set to their default values. The validators
+        of the fields are called with a single instance of this model holding
+        the values of the row being loaded.
+
+        If `restore` is True, the rows are loaded as they are, for example to
+        restore a dump of the records. The empty values are not replaced with
+        the default values and are not validated, the fields not given are
+        left empty and the `auto_now` fields keep the given time.
+
+        :param rows: iterable of dicts, or of sequences of the values of the
+                     fields given by `names`
+        :param names: names of the fields (including `key` to load the keys as
+                      well), by default all the fields but `key`
+        :param batch_size: number of rows to write at a time
+        :param restore: whether to load the values as they are
+
+        :returns: number of rows loaded
+        :raises:
+            - :class:`AttributeError`: if there is no such field
+            - :class:`ValidationError`: if any value is invalid
+            - :class:`DatabaseError`: if the rows could not be written
+        """
+        fields = OrderedDict([(n, f) for n, f in cls.fields().items() \
+                              if f._data_type is not None])
+        if names is None:
+            names = [n for n in fields if n != 'key']
+        for name in names:
+            if name not in fields:
+                raise AttributeError(
+                    _('No such field %(name)r in model %(model)r',
+                        name=name, model=cls._meta.name))
+
+        given = [fields[n] for n in names]
+        defaults = [f for n, f in fields.items() if n != 'key' and \
+                    n not in names and f.default is not None]
+        if restore:
+            defaults = []
+
+        from kalapy.db.engines import database
+        return database.bulk_load(cls, [f.name for f in given + defaults],
+                                  cls._load_values(rows, given, defaults, restore),
+                                  batch_size)
+
+    @classmethod
+    def _load_values(cls, rows, fields, defaults, restore=False):
+        """Validate the values of the given rows for :meth:`bulk_load` and
+        yield them as tuples of database values, followed by the default values
+        of the given default fields. If `restore` is True, the empty values are
+        kept as they are.
+
+        .. notes::
+
+            For internal use only.
+        """
+        names = [f.name for f in fields]
+        size = len(names)
+        if restore:
+            # copies of the auto_now fields converting the values as given
+            fields = list(fields)
+            for i, field in enumerate(fields):
+                if getattr(field, 'auto_now', False):
+                    fields[i] = copy.copy(field)
+                    fields[i].auto_now = False
+        proto = cls()
+        for row in rows:
+            if isinstance(row, dict):
+                values = [row.get(n) for n in names]
+            else:
+                values = list(row)
+                if len(values) != size:
+                    raise ValueError(
+                        _('Expected %(size)d values, got %(count)d',
+                            size=size, count=len(values)))
+            proto._values = dict(zip(names, values))
+            result = []
+            for field, value in zip(fields, values):
+                if restore and field.empty(value):
+                    result.append(field.python_to_database(value))
+                    continue
+                if field.empty(value) and field.default is not None:
+                    value = field.default
+                # like the constructor, empty values of optional fields are
+                # not validated
+                if field.name != 'key' and \
+                   (field.is_required or not field.empty(value)):
+                    value = field._validate(proto, value)
+                result.append(field.python_to_database(value))
+            for field in defaults:
+                result.append(field.python_to_database(field.default))
+            yield tuple(result)
+
     def delete(self):
         """Deletes the instance from the database.
 
+        Within a session in unit of work mode, the record is deleted when the
+        changes are committed.
+
         :raises:
             - :class:`TypeError`: if instance is not saved
             - :class:`DatabaseError`: if instance could not be deleted.
         """
         if not self.is_saved:
             raise TypeError(_("Can't delete, instance doesn't exists."))
+        session = current_session()
+        if session is not None:
+            if session.unit_of_work:
+                return session.delete(self)
+            session.remove(self)
+
         from kalapy.db.engines import database
         database.delete_records(self)
         self._key = None
@@ -476,7 +910,22 @@ class Model(object):
         if not isinstance(keys, (list, tuple)):
             keys = [keys]
             single = True
-        result = cls.all().filter('key in', keys).fetch(-1)
+
+        session = current_session()
+        if session is not None:
+            # serve the instances known to the session without a query
+            found = {}
+            for key in keys:
+                obj = session.get(cls, key)
+                if obj is not None:
+                    found[key] = obj
+            missing = [k for k in keys if k not in found]
+            if missing:
+                for obj in cls.all().filter('key in', missing).fetch(-1):
+                    found[obj.key] = obj
+            result = [found[k] for k in keys if k in found]
+        else:
+            result = cls.all().filter('key in', keys).fetch(-1)
 
         if single:
             return result[0] if result else None
@@ -494,7 +943,10 @@ class Model(object):
     @classmethod
     def select(cls, *fields):
         """Mimics `SELECT` column query. If fields are not given it is equivalent
-        to :meth:`all()`.
+        to :meth:`all()`. Only the columns of the given fields are selected
+        from the database (see :meth:`Query.values_list`), unless some of the
+        given names are not columns, like properties or virtual fields, in
+        which case the values are read from the model instances.
 
         >>> names = User.select('name').fetch(-1)
         >>> print names
@@ -510,14 +962,23 @@ class Model(object):
 
         :returns: an :class:`Query` instance
         """
-        def mapper(obj):
-            if not fields:
-                return obj
-            if len(fields) > 1:
-                return tuple([getattr(obj, name) for name in fields])
-            return getattr(obj, fields[0])
+        if not fields:
+            return Query(cls)
 
-        return Query(cls, mapper)
+        def column(name):
+            try:
+                return _resolve(cls, name).data_type is not None
+            except AttributeError:
+                return False
+
+        if [name for name in fields if not column(name)]:
+            def mapper(obj):
+                if len(fields) > 1:
+                    return tuple([getattr(obj, name) for name in fields])
+                return getattr(obj, fields[0])
+            return Query(cls, mapper)
+
+        return Query(cls).values_list(*fields, flat=len(fields) == 1)
 
     @classmethod
     def fields(cls):
@@ -10,13 +10,173 @@ from the database.
 
 """
 import re
+import time
+import base64
+import decimal
+import datetime
+import warnings
 from copy import deepcopy
+from itertools import islice
 
+from kalapy.db import cache
+from kalapy.db.session import current_session
+from kalapy.utils.containers import OrderedDict
 
-__all__ = ('Query', 'Q')
+
+__all__ = ('Query', 'Q', 'Sum', 'Avg', 'Min', 'Max', 'Count', 'Paginator')
 
 _FILTER_REGEX = re.compile(
-    '^\s*([\w]+)\s+(>|<|>=|<=|==|!=|=|in|not in)\s*$', re.I)
+    '^\s*([\w]+(?:\.[\w]+)*)\s+(>|<|>=|<=|==|!=|=|in|not in)\s*$', re.I)
+
+
+#: cache of parsed filter strings
+_FILTERS = {}
+
+
+def _resolve(model, name, reverse=False):
+    """Resolve the given field name, which can be a dotted name like
+    `page.name` following reference fields, and return the field.
+
+    :param reverse: whether the name can follow :class:`OneToMany` fields,
+                    only allowed in filters
+
+    :raises: :class:`AttributeError` if the name can't be resolved
+    """
+    from kalapy.db.reference import ManyToOne, OneToMany
+
+    refs = reverse and (ManyToOne, OneToMany) or ManyToOne
+    parts = name.split('.')
+    for part in parts[:-1]:
+        field = model._meta.fields.get(part) or model._meta.virtual_fields.get(part)
+        if not isinstance(field, refs):
+            raise AttributeError(
+                _('No such reference field %(name)r in model %(model)r',
+                    name=part, model=model._meta.name))
+        model = field.reference
+
+    if parts[-1] not in model._meta.fields:
+        raise AttributeError(
+            _('No such field %(name)r in model %(model)r',
+                name=parts[-1], model=model._meta.name))
+    return model._meta.fields[parts[-1]]
+
+def _overrides(model, name):
+    """Check whether the given model class overrides the given method of the
+    :class:`Model` class.
+    """
+    from kalapy.db.model import Model
+    method = getattr(model._meta.model, name).im_func
+    return method is not getattr(Model, name).im_func
+
+
+def _database_value(field, value):
+    """Convert the given value of the given field to the database value. The
+    date and time fields are converted here as the ones declared with
+    `auto_now` would return the current time.
+    """
+    if field.data_type != 'datetime' or value is None:
+        return field.python_to_database(value)
+    from kalapy.db.fields import _date_to_datetime, _time_to_datetime
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return _date_to_datetime(value)
+    return _time_to_datetime(value)
+
+
+def _encode_cursor(values):
+    """Encode the given database values into an opaque, URL-safe string.
+    Every value is written as a type tag, the length and the value itself.
+    """
+    items = []
+    for value in values:
+        if value is None:
+            tag, value = 'n', ''
+        elif isinstance(value, bool):
+            tag, value = 'b', str(int(value))
+        elif isinstance(value, (int, long)):
+            tag, value = 'i', str(value)
+        elif isinstance(value, float):
+            tag, value = 'f', repr(value)
+        elif isinstance(value, decimal.Decimal):
+            tag, value = 'd', str(value)
+        elif isinstance(value, datetime.datetime):
+            tag, value = 't', value.isoformat()
+        elif isinstance(value, basestring):
+            tag = 's'
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+        else:
+            raise TypeError(
+                _('Unsupported cursor value %(value)r', value=value))
+        items.append('%s%d:%s' % (tag, len(value), value))
+    return base64.urlsafe_b64encode(''.join(items)).rstrip('=')
+
+
+def _decode_cursor(cursor):
+    """Decode the values encoded with :func:`_encode_cursor`.
+
+    :raises: :class:`ValueError` if the cursor is malformed
+    """
+    try:
+        cursor = str(cursor)
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values, i = [], 0
+        while i < len(data):
+            tag = data[i]
+            j = data.index(':', i)
+            size = int(data[i+1:j])
+            value = data[j+1:j+1+size]
+            i = j + 1 + size
+            if tag == 'n':
+                value = None
+            elif tag == 'b':
+                value = value == '1'
+            elif tag == 'i':
+                value = int(value)
+            elif tag == 'f':
+                value = float(value)
+            elif tag == 'd':
+                value = decimal.Decimal(value)
+            elif tag == 't':
+                value, __dot, micro = value.partition('.')
+                value = datetime.datetime(
+                    *time.strptime(value, '%Y-%m-%dT%H:%M:%S')[:6])
+                value = value.replace(microsecond=int(micro or 0))
+            elif tag == 's':
+                value = value.decode('utf-8')
+            else:
+                raise ValueError(tag)
+            values.append(value)
+        return tuple(values)
+    except Exception:
+        raise ValueError(_('Invalid cursor %(cursor)r', cursor=cursor))
+
+
+def _prefetch(model, instances, names):
+    """Load the related instances of the given relation fields for all the
+    given model instances. See :meth:`Query.prefetch`.
+    """
+    from kalapy.db.reference import IRelation
+
+    names = list(names)
+    paths = OrderedDict()
+    for name in names:
+        name, __dot, rest = name.partition('.')
+        paths.setdefault(name, [])
+        if rest:
+            paths[name].append(rest)
+
+    for name, rest in paths.items():
+        field = model._meta.fields.get(name) or model._meta.virtual_fields.get(name)
+        if not isinstance(field, IRelation):
+            raise AttributeError(
+                _('No such relation field %(name)r in model %(model)r',
+                    name=name, model=model._meta.name))
+        related = field.prefetch(instances)
+        if rest and related:
+            _prefetch(field.reference, related, rest)
+
 
 class Q(object):
     """Encapsulates query filters as objects that can then be used to perform
@@ -26,24 +186,30 @@ class Q(object):
 
     The ``AND`` operation is not supported as ``AND`` is the default behaviour
     of multiple :func:`Query.filter` calls.
+
+    The value of ``in`` and ``not in`` filters can be a :class:`Query` selecting
+    a single field (see :meth:`Model.select`), or the keys of its records.
     """
     def __init__(self, query, value):
         try:
-            name, op = _FILTER_REGEX.match(query).groups()
-        except:
-            raise Exception(
-                _('Malformed filter string: %(filter)s', filter=query))
+            name, op = _FILTERS[query]
+        except KeyError:
+            try:
+                name, op = _FILTER_REGEX.match(query).groups()
+            except:
+                raise Exception(
+                    _('Malformed filter string: %(filter)s', filter=query))
+            if len(_FILTERS) >= 1000:
+                _FILTERS.clear()
+            _FILTERS[query] = (name, op)
         self.items = [(name, op, value)]
 
     def validate(self, model):
         for i, (name, operator, value) in enumerate(self.items):
-            if name not in model._meta.fields:
-                raise AttributeError(
-                    _('No such field %(name)r in model %(model)r',
-                        name=name, model=model._meta.name))
-
-            field = model._meta.fields[name]
-            if operator in ('in', 'not in'):
+            field = _resolve(model, name, True)
+            if operator in ('in', 'not in') and isinstance(value, Query):
+                value._subquery() # check it selects a single field
+            elif operator in ('in', 'not in'):
                 assert isinstance(value, (list, tuple))
                 value = [field.python_to_database(v) for v in value]
             else:
@@ -68,6 +234,89 @@ class Q(object):
         return "(" + " OR ".join(map(str, self.items)) + ")"
 
 
+class Aggregate(object):
+    """Base class of the aggregate functions to be used with
+    :meth:`Query.aggregate`. The database engines compute the aggregates with
+    the SQL function given by :attr:`function`, others use :meth:`compute`.
+
+    :param name: name of the field to aggregate, can be a dotted name
+    """
+
+    #: name of the SQL aggregate function
+    function = None
+
+    #: whether the result has the type of the field values
+    typed = True
+
+    def __init__(self, name):
+        self.name = name
+
+    def compute(self, values):
+        """Compute the aggregate of the given values in Python.
+
+        :param values: list of field values, None values are ignored
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.name)
+
+
+class Sum(Aggregate):
+    """Sum of the values of the given field.
+    """
+    function = 'SUM'
+
+    def compute(self, values):
+        values = [v for v in values if v is not None]
+        return sum(values[1:], values[0]) if values else None
+
+
+class Avg(Aggregate):
+    """Average of the values of the given field.
+    """
+    function = 'AVG'
+    typed = False
+
+    def compute(self, values):
+        values = [v for v in values if v is not None]
+        return float(sum(values)) / len(values) if values else None
+
+
+class Min(Aggregate):
+    """Smallest value of the given field.
+    """
+    function = 'MIN'
+
+    def compute(self, values):
+        values = [v for v in values if v is not None]
+        return min(values) if values else None
+
+
+class Max(Aggregate):
+    """Largest value of the given field.
+    """
+    function = 'MAX'
+
+    def compute(self, values):
+        values = [v for v in values if v is not None]
+        return max(values) if values else None
+
+
+class Count(Aggregate):
+    """Number of records having a value for the given field, all the records
+    if no field is given.
+    """
+    function = 'COUNT'
+    typed = False
+
+    def __init__(self, name='key'):
+        super(Count, self).__init__(name)
+
+    def compute(self, values):
+        return len([v for v in values if v is not None])
+
+
 class QSet(object):
     """A container of all the :class:`db.Q` instances of a :class:`db.Query`.
 
@@ -78,23 +327,112 @@ class QSet(object):
     def __init__(self, model):
         self.model = model
         self.items = []
-        self.order = None
+        self.order = ()
+        self.related = ()
+        self.deferred = frozenset([n for n, f in model._meta.fields.items()
+                                   if f.is_deferred])
+        self.seek = None
+        self.using = None
 
     def append(self, q):
         self.items.append(q.validate(self.model))
 
-    def fetch(self, limit, offset):
+    def fetch(self, limit, offset, batch_size=None):
         from kalapy.db.engines import database
-        return database.fetch(self, limit, offset)
+        return database.route(self).fetch(self, limit, offset, batch_size)
+
+    def load(self, limit, offset, batch_size=None):
+        from kalapy.db.engines import database
+        return database.route(self).load(self, limit, offset, batch_size)
+
+    def values(self, names, limit, offset, batch_size=None):
+        from kalapy.db.engines import database
+        return database.route(self).values(self, names, limit, offset, batch_size)
 
     def count(self):
         from kalapy.db.engines import database
-        return database.count(self)
+        return database.route(self).count(self)
+
+    def exists(self):
+        from kalapy.db.engines import database
+        return database.route(self).exists(self)
+
+    def aggregate(self, group_by, aggregates):
+        from kalapy.db.engines import database
+        return database.route(self).aggregate(self, group_by, aggregates)
+
+    def delete(self):
+        from kalapy.db.engines import database
+        return database.delete_all(self)
+
+    def update(self, values):
+        from kalapy.db.engines import database
+        return database.update_all(self, values)
+
+    def shape(self):
+        """Returns a hashable description of this query set, which doesn't
+        depend on the filter values but only on the fields, operators and
+        the number of values given to ``in`` and ``not in`` operators. Query
+        sets of same shape compile to same statement.
+        """
+        def size(v):
+            if isinstance(v, Query):
+                qset, name = v._subquery()
+                return (qset.shape(), name)
+            return len(v) if isinstance(v, (list, tuple)) else None
+        items = []
+        for q in self.items:
+            items.append(tuple([(n, o, size(v)) for n, o, v in q.items]))
+        seek = None
+        if self.seek is not None:
+            seek = tuple([v is None for v in self.seek])
+        return (self.model._meta.table, tuple(items), self.order, self.related,
+                tuple(sorted(self.deferred)), seek)
+
+    def ordering(self, stable=False):
+        """Returns the list of `(name, direction)` tuples the records are
+        ordered by. If `stable` is True or the query set seeks (see
+        :meth:`Query.after`), `key` is appended as a tie-breaker.
+        """
+        result = list(self.order)
+        if (stable or self.seek is not None) and \
+           not [n for n, how in result if n == 'key']:
+            result.append(('key', result[-1][1] if result else 'ASC'))
+        return result
+
+    def seek_params(self):
+        """Returns the values of the seek condition in the order they appear
+        in the condition ``(a > %s) OR (a = %s AND b > %s) ...``. The NULL
+        values are compared with ``IS NULL`` and have no parameter.
+        """
+        values = self.seek or ()
+        return [v for i in range(len(values)) for v in values[:i+1] \
+                if v is not None]
+
+    def params(self):
+        """Returns the list of filter values in the order they appear in the
+        query set.
+        """
+        result = []
+        for q in self.items:
+            for n, o, v in q.items:
+                if isinstance(v, Query):
+                    result.extend(v._subquery()[0].params())
+                elif isinstance(v, (list, tuple)):
+                    result.extend(v)
+                else:
+                    result.append(v)
+        return result + self.seek_params()
 
     def __deepcopy__(self, meta):
+        # the Q instances are not changed once added, so they can be shared
         qs = QSet(self.model)
+        qs.seek = self.seek
+        qs.using = self.using
         qs.order = self.order
-        qs.items = deepcopy(self.items, meta)
+        qs.related = self.related
+        qs.deferred = self.deferred
+        qs.items = list(self.items)
         return qs
 
     def __iter__(self):
@@ -144,6 +482,12 @@ class Query(object):
         self.__model = model
         self.__mapper = mapper
         self.__qset = QSet(model)
+        self.__prefetch = ()
+        self.__values = None
+        self.__cached = False
+        self.__ttl = None
+        self.__group_by = ()
+        self.__reverse = False
 
     def filter(self, *args):
         """Return a new :class:`Query` instance with the given query ANDed with
@@ -162,6 +506,23 @@ class Query(object):
             q = Query(User).filter(Q('name =', 'some%') | Q('age >=', 20))
             q.fetchall()
 
+        The field name can be a dotted name to filter by fields of the models
+        referenced by :class:`ManyToOne` fields, which is compiled into a
+        join::
+
+            q = Query(Revision).filter('page.name ==', 'Main_Page')
+
+        Through a :class:`OneToMany` field, the records with at least one
+        matching related record are selected with a nested select::
+
+            q = Query(Page).filter('revisions.author ==', user)
+
+        The value of ``in`` and ``not in`` filters can be another query, which
+        is compiled into a nested select::
+
+            q = Query(User).filter('key in', Article.select('author'))
+
+
         :param query: The query string or an instance of :class:`db.Q`
         :param value: The filter value, ignored if query is :class:`db.Q`
 
@@ -178,20 +539,385 @@ class Query(object):
         query.__qset.append(q)
         return query
 
-    def order(self, spec):
-        """Order the query result with given spec.
+    def order(self, *specs):
+        """Order the query result with given specs. The records are ordered by
+        the first field, then by the second one and so on. The previous order
+        of the query is replaced.
 
         >>> q = Query(User).filter("name =", "some%").filter("age >=", 20)
-        >>> q.order("-age")
+        >>> q.order("-age", "name")
+
+        The field name can be a dotted name (see :meth:`filter`).
 
-        :param spec: field name, if prefixed with `-` order by DESC else ASC
+        :param specs: field names, if prefixed with `-` order by DESC else ASC
         """
-        assert isinstance(spec, basestring)
-        self.__qset.order = (spec, 'ASC')
-        if spec.startswith('-'):
-            self.__qset.order = (spec[1:], 'DESC')
+        order = []
+        for spec in specs:
+            assert isinstance(spec, basestring)
+            _resolve(self.__model, spec.lstrip('-'))
+            if spec.startswith('-'):
+                order.append((spec[1:], 'DESC'))
+            else:
+                order.append((spec, 'ASC'))
+        self.__qset.order = tuple(order)
         return self
 
+    def prefetch(self, *names):
+        """Load the related instances of the given relation fields for all the
+        fetched records at once instead of querying for them one by one when
+        accessed.
+
+        >>> for rev in Revision.all().prefetch('page', 'page.owner').fetch(50):
+        >>>     print rev.page.name, rev.page.owner.name
+
+        The names can be :class:`ManyToOne` or :class:`OneToOne` fields as well
+        as :class:`OneToMany` and :class:`ManyToMany` fields, in which case
+        iterating over the reference set uses the prefetched instances. Fields
+        of the related models can be given with dotted names.
+
+        :param names: sequence of relation field names
+
+        :returns: a new instance of :class:`Query`
+        """
+        query = deepcopy(self)
+        query.__prefetch = self.__prefetch + names
+        return query
+
+    def select_related(self, *names):
+        """Load the instances referenced by the given :class:`ManyToOne` fields
+        with the same query by joining their tables. Fields of the related
+        models can be given with dotted names.
+
+        >>> for rev in Revision.all().select_related('page').fetch(50):
+        >>>     print rev.page.name
+
+        Database engines not supporting joins ignore it.
+
+        :param names: sequence of :class:`ManyToOne` field names
+
+        :returns: a new instance of :class:`Query`
+        """
+        from kalapy.db.reference import ManyToOne
+        for name in names:
+            model = self.__model
+            for part in name.split('.'):
+                field = model._meta.fields.get(part)
+                if not isinstance(field, ManyToOne):
+                    raise AttributeError(
+                        _('No such reference field %(name)r in model %(model)r',
+                            name=part, model=model._meta.name))
+                model = field.reference
+        query = deepcopy(self)
+        related = list(self.__qset.related)
+        for name in names:
+            # make sure the intermediate models are selected as well
+            parts = name.split('.')
+            for i in range(len(parts)):
+                path = '.'.join(parts[:i+1])
+                if path not in related:
+                    related.append(path)
+        query.__qset.related = tuple(related)
+        return query
+
+    def defer(self, *names):
+        """Don't load the values of the given fields with the records. The
+        values are loaded when accessed for the first time, at once for all
+        the records fetched together.
+
+        >>> for rev in Revision.all().defer('text').fetch(50):
+        >>>     print rev.title
+
+        The fields declared with `deferred=True` are deferred by default.
+
+        :param names: sequence of field names
+
+        :returns: a new instance of :class:`Query`
+        :raises: :class:`AttributeError` if any of the fields doesn't exist
+        """
+        names = set(names)
+        for name in names:
+            if name == 'key' or name not in self.__model._meta.fields:
+                raise AttributeError(
+                    _('No such field %(name)r in model %(model)r',
+                        name=name, model=self.__model._meta.name))
+        query = deepcopy(self)
+        query.__qset.deferred = self.__qset.deferred | names
+        return query
+
+    def only(self, *names):
+        """Defer all the fields except the given fields (see :meth:`defer`),
+        including the fields declared with `deferred=True`.
+
+        :param names: sequence of field names
+
+        :returns: a new instance of :class:`Query`
+        :raises: :class:`AttributeError` if any of the fields doesn't exist
+        """
+        fields = self.__model._meta.fields
+        for name in names:
+            if name not in fields:
+                raise AttributeError(
+                    _('No such field %(name)r in model %(model)r',
+                        name=name, model=self.__model._meta.name))
+        query = deepcopy(self)
+        query.__qset.deferred = frozenset([n for n, f in fields.items()
+            if n != 'key' and f.data_type is not None and n not in names])
+        return query
+
+    def values(self, *names):
+        """Fetch the values of the given fields as dict instead of model
+        instances. Only the given columns are selected from the database and
+        the values are converted without creating any model instance.
+
+        >>> User.all().filter('age >', 18).values('name', 'age').fetch(-1)
+        [{'name': 'a', 'age': 20}, ...]
+
+        The names can be dotted names (see :meth:`filter`). If no names are
+        given, all the fields of the model are fetched.
+
+        :param names: sequence of field names
+
+        :returns: a new instance of :class:`Query`
+        :raises: :class:`AttributeError` if any of the fields doesn't exist
+        """
+        return self.__project(names, dict)
+
+    def values_list(self, *names, **kw):
+        """Same as :meth:`values` but fetch the values as tuples. If `flat` is
+        True and a single field is given, fetch the values themselves.
+
+        >>> User.all().values_list('name', 'age').fetch(-1)
+        [('a', 20), ...]
+        >>> User.all().values_list('name', flat=True).fetch(-1)
+        ['a', ...]
+
+        :param names: sequence of field names
+        :keyword flat: whether to return single values instead of tuples
+
+        :returns: a new instance of :class:`Query`
+        :raises: :class:`AttributeError` if any of the fields doesn't exist
+        """
+        flat = kw.pop('flat', False)
+        if kw:
+            raise TypeError(_('Unexpected keyword arguments %(kw)s', kw=kw.keys()))
+        if flat and len(names) != 1:
+            raise TypeError(_('Flat values require a single field.'))
+        return self.__project(names, 'flat' if flat else tuple)
+
+    def after(self, cursor=None):
+        """Return the records following the record given by the cursor, in the
+        order of this query. The records are selected with a condition on the
+        ordering fields and `key`, which is used as a tie-breaker, so the
+        database can seek to them using an index instead of skipping the
+        preceding records with an offset.
+
+        >>> q = Revision.all().order('-timestamp')
+        >>> page = q.fetch(20)
+        >>> next_page = q.after(q.cursor(page[-1])).fetch(20)
+
+        If the cursor is None, the records are returned from the first one, in
+        the same order.
+
+        :param cursor: a cursor returned by :meth:`cursor`
+
+        :returns: a new instance of :class:`Query`
+        :raises: :class:`ValueError` if the cursor is invalid
+        """
+        return self.__seek(cursor, False)
+
+    def before(self, cursor=None):
+        """Return the records preceding the record given by the cursor, in the
+        order of this query. Fetching a number of records returns the ones
+        nearest to the cursor. See :meth:`after`.
+
+        If the cursor is None, the last records are returned.
+
+        :param cursor: a cursor returned by :meth:`cursor`
+
+        :returns: a new instance of :class:`Query`
+        :raises: :class:`ValueError` if the cursor is invalid
+        """
+        return self.__seek(cursor, True)
+
+    def __seek(self, cursor, backward):
+        query = deepcopy(self)
+        qset = query.__qset
+        qset.order = qset.order or (('key', 'ASC'),)
+        values = ()
+        if cursor is not None:
+            values = _decode_cursor(cursor)
+            if len(values) != len(qset.ordering(True)):
+                raise ValueError(_('Invalid cursor %(cursor)r', cursor=cursor))
+        if backward:
+            # read the preceding records in reverse order and reverse them
+            qset.order = tuple([(name, 'DESC' if how == 'ASC' else 'ASC')
+                                for name, how in qset.order])
+            query.__reverse = not self.__reverse
+        qset.seek = values
+        return query
+
+    def cursor(self, obj):
+        """Returns the cursor of the given record of this query to be used
+        with :meth:`after` and :meth:`before`. It's an opaque and URL-safe
+        string of the values of the ordering fields and `key` of the record.
+
+        :param obj: a model instance fetched with this query
+
+        :returns: a string
+        """
+        values = []
+        for name, how in self.__qset.ordering(True):
+            value = obj
+            for part in name.split('.'):
+                value = getattr(value, part)
+                if value is None:
+                    break
+            values.append(_database_value(_resolve(self.__model, name), value))
+        return _encode_cursor(values)
+
+    def cached(self, ttl=None):
+        """Cache the results of :meth:`fetch` and :meth:`count` of this query
+        using the cache backend configured with `CACHE_ENGINE` setting.
+
+        >>> q = Page.all().filter('owner ==', user).order('-modified').cached(600)
+        >>> pages, total = q.fetch(20, offset), q.count()
+
+        The results are cached by the statement, the filter values and the
+        limits. Any change to the records of the tables involved in the query,
+        including the tables joined by the dotted names, makes the cached
+        results stale.
+
+        The results are not cached, and are read from the database, while
+        the current transaction has changed any of the tables, as the other
+        connections would read the uncommitted results.
+
+        .. note::
+
+            The results are only cached if the query result cache is enabled
+            with the `query_cache` option of `CACHE_OPTIONS` setting,
+            otherwise this method does nothing and a warning is issued.
+
+        :param ttl: seconds to keep the results, defaults to the cache timeout
+
+        :returns: a new instance of :class:`Query`
+        """
+        query = deepcopy(self)
+        query.__cached = cache.caches_queries()
+        query.__ttl = ttl
+        if not query.__cached:
+            warnings.warn(RuntimeWarning(_('The query results are not cached '
+                'as the query_cache option is not enabled.')))
+        return query
+
+    def using(self, name):
+        """Pin the database the query reads from, when read replicas are
+        configured with `DATABASE_REPLICAS` setting. By default a replica is
+        used unless something is written during the request.
+
+        >>> page = Page.all().filter('name ==', name).using('primary').fetchone()
+
+        :param name: ``'primary'`` or ``'replica'``
+
+        :returns: a new instance of :class:`Query`
+        :raises: :class:`ValueError` if the name is not valid
+        """
+        if name not in ('primary', 'replica'):
+            raise ValueError(_('Invalid database %(name)r', name=name))
+        query = deepcopy(self)
+        query.__qset.using = name
+        return query
+
+    def __cache_key(self, names, *args):
+        """Returns the key of the cached result of this query for the given
+        args. The given field names are used by the result besides the names
+        used by the query. Returns None if any of the tables is changed by the
+        current transaction, in which case the result can't be cached.
+        """
+        qset = self.__qset
+        values = self.__values and self.__values[0]
+        tables = sorted(self._tables(names))
+        if cache.tables_written(tables):
+            return None
+        return cache.query_key(tables, qset.shape(), qset.params(), values, *args)
+
+    def _tables(self, names=()):
+        """Returns the set of the tables involved in this query, including
+        the joined tables and the tables of the subqueries.
+
+        :param names: names of other fields used with the query
+        """
+        qset = self.__qset
+        names = list(names) + [n for q in qset for n, o, v in q.items]
+        names.extend(['%s.key' % n for n in qset.related])
+        names.extend([name for name, how in qset.order])
+        if self.__values is not None:
+            names.extend(self.__values[0])
+
+        tables = set([self.__model._meta.table])
+        for name in names:
+            model = self.__model
+            for part in name.split('.')[:-1]:
+                field = model._meta.fields.get(part) or \
+                        model._meta.virtual_fields.get(part)
+                model = field.reference
+                tables.add(model._meta.table)
+        for q in qset:
+            for n, o, v in q.items:
+                if isinstance(v, Query):
+                    tables.update(v._tables())
+        return tables
+
+    def _subquery(self):
+        """Returns the query set and the name of the selected field of this
+        query when used as the value of an ``in`` filter. The keys are
+        selected if this query doesn't select a single field.
+
+        :raises: :class:`TypeError` if this query selects several fields
+        """
+        names = self.__values and self.__values[0] or ('key',)
+        if len(names) != 1:
+            raise TypeError(_('A subquery should select a single field.'))
+        return self.__qset, names[0]
+
+    def __project(self, names, kind):
+        if not names:
+            names = [n for n, f in self.__model._meta.fields.items() \
+                    if f.data_type is not None]
+        for name in names:
+            _resolve(self.__model, name)
+        query = deepcopy(self)
+        query.__values = (tuple(names), kind)
+        return query
+
+    def __read(self, qset, limit, offset, batch_size=None, names=None):
+        """Read the records of the given query set, either as model instances
+        or as tuples of values if :meth:`values` is applied.
+        """
+        if self.__values is None:
+            return qset.load(limit, offset, batch_size)
+        return qset.values(names or self.__values[0], limit, offset, batch_size)
+
+    def __load(self, items):
+        """Load the related instances requested with :meth:`prefetch` for the
+        given model instances, or prepare the values read for :meth:`values`.
+        """
+        result = list(items)
+        if self.__values is not None:
+            names, kind = self.__values
+            if kind is dict:
+                result = [dict(zip(names, row)) for row in result]
+            elif kind == 'flat':
+                result = [row[0] for row in result]
+            else:
+                result = [tuple(row[:len(names)]) for row in result]
+            return result
+        session = current_session()
+        if session is not None:
+            result = map(session.merge, result)
+        if self.__prefetch and result:
+            _prefetch(self.__model, result, self.__prefetch)
+        return result
+
     def fetch(self, limit, offset=0):
         """Fetch the given number of records from the query object from the given offset.
 
@@ -209,12 +935,162 @@ class Query(object):
         :returns: list of model instances or content if mapper is applied
         :rtype: list
         """
-        result = map(self.__model._from_database_values,
-                        self.__qset.fetch(limit, offset))
+        if self.__cached:
+            result = self.__load(self.__recall(limit, offset))
+        else:
+            result = self.__load(self.__fetch(limit, offset))
+        if self.__reverse:
+            result.reverse()
         if self.__mapper:
             return map(self.__mapper, result)
         return result
 
+    def __fetch(self, limit, offset):
+        result = None
+        if self.__model._meta.cache:
+            result = self.__lookup(limit, offset)
+        if result is None:
+            result = list(self.__read(self.__qset, limit, offset))
+        return result
+
+    def __recall(self, limit, offset):
+        """Fetch the records from the query result cache, see :meth:`cached`.
+        """
+        key = self.__cache_key((), 'fetch', limit, offset)
+        if key is None:
+            return self.__fetch(limit, offset)
+        entry = cache.get_cache().get(key)
+        if entry is not None:
+            if self.__values is not None:
+                fields = [_resolve(self.__model, n) for n in self.__values[0]]
+                return cache.load_rows(entry, fields)
+            return [self.__model._from_cache(*item) for item in entry]
+
+        result = self.__fetch(limit, offset)
+        if self.__values is None:
+            entry = [cache.dump(obj) for obj in result]
+        else:
+            entry = cache.dump_rows(result)
+        cache.get_cache().set(key, entry, self.__ttl)
+        return result
+
+    def __lookup(self, limit, offset):
+        """Fetch the records using the model cache if this query is a lookup
+        by key or by a unique field, else return None.
+        """
+        qset = self.__qset
+        if offset or limit == 0 or qset.order or qset.related or \
+           self.__values is not None or len(qset.items) != 1 or \
+           len(qset.items[0].items) != 1:
+            return None
+
+        model = self.__model
+        name, op, value = qset.items[0].items[0]
+        if name == 'key' and (op == '==' or \
+           op == 'in' and isinstance(value, (list, tuple))):
+            keys = list(value) if op == 'in' else [value]
+            found = cache.get_many(model, keys)
+            missing = [k for k in keys if k not in found]
+            if missing:
+                query = Query(model).filter('key in', missing)
+                loaded = list(query.__read(query.__qset, -1, 0))
+                cache.set_many(model, loaded)
+                for obj in loaded:
+                    found[obj.key] = obj
+            result = [found[k] for k in keys if k in found]
+        elif op == '==' and [f for f in model._meta.unique \
+                             if len(f) == 1 and f[0].name == name]:
+            result = None
+            field = model._meta.fields[name]
+            key = cache.get_key(model, name, value)
+            if key is not None:
+                result = Query(model).filter('key ==', key).fetch(1)
+                if result and field.python_to_database(
+                        getattr(result[0], name)) != value:
+                    result = None
+            if not result:
+                result = list(self.__read(qset, -1, 0))
+                if len(result) == 1:
+                    cache.set_key(model, name, value, result[0].key)
+                    cache.set_many(model, result)
+        else:
+            return None
+
+        if limit > -1:
+            result = result[:limit]
+        return result
+
+    def iterate(self, batch_size=100, keyset=False):
+        """Iterate over all the records matched by this query.
+
+        Unlike :meth:`fetch`, the records are read from a single database
+        cursor in chunks of `batch_size` rows and model instances are created
+        lazily, a chunk at a time.
+
+        Whether the rows themselves are streamed depends on the engine. The
+        sqlite3 engine reads them as requested, and so does the postgresql
+        engine if the `server_cursors` option of `DATABASE_OPTIONS` is set.
+        Otherwise the client-side cursors of psycopg2 and MySQLdb read the
+        whole result into memory when the statement is executed, so only the
+        model instances are created in chunks; use `keyset` to bound the
+        memory usage in that case.
+
+        >>> for user in Query(User).filter('age >=', 20).iterate(500):
+        >>>     print user.name
+
+        If `keyset` is True, each chunk is fetched with a separate query that
+        continues from the `key` of the last record seen instead of keeping
+        the cursor open. The query should not be ordered by any other field
+        than `key` in that case.
+
+        The records of a query returned by :meth:`before` are read from the
+        database in the reverse order, so they are all fetched at once to be
+        returned in the order of the query.
+
+        :param batch_size: number of records to fetch at a time
+        :param keyset: if True, use keyset continuation on `key`
+
+        :returns: a generator of model instances or content if mapper is applied
+        :raises: :class:`ValueError` if `keyset` is used with other ordering
+        """
+        if self.__reverse:
+            for obj in self.fetch(-1):
+                yield obj
+            return
+
+        if not keyset:
+            items = self.__read(self.__qset, -1, 0, batch_size)
+            while True:
+                result = self.__load(islice(items, batch_size))
+                if not result:
+                    break
+                for obj in result:
+                    yield self.__mapper(obj) if self.__mapper else obj
+            return
+
+        order = self.__qset.order or (('key', 'ASC'),)
+        if order[0][0] != 'key':
+            raise ValueError(
+                _('Keyset iteration requires the query to be ordered by key.'))
+
+        query = deepcopy(self)
+        query.__qset.order = order[:1]
+        op = 'key >' if order[0][1] == 'ASC' else 'key <'
+
+        # the key is read as an extra last value to continue from
+        names = None
+        if self.__values is not None:
+            names = self.__values[0] + ('key',)
+
+        q = query
+        while True:
+            rows = list(self.__read(q.__qset, batch_size, 0, names=names))
+            for obj in self.__load(rows):
+                yield self.__mapper(obj) if self.__mapper else obj
+            if len(rows) < batch_size:
+                break
+            q = query.filter(op, rows[-1][-1] if names else rows[-1].key)
+
     def fetchone(self, offset=0):
         """Fetch a single record from the query object with given offset.
 
@@ -236,7 +1112,97 @@ class Query(object):
     def count(self):
         """Return the number of records in the query object.
         """
-        return self.__qset.count()
+        if not self.__cached:
+            return self.__qset.count()
+        return self.__remember((), ('count',), self.__qset.count)
+
+    def __remember(self, names, args, func, fields=None):
+        """Returns the cached result of the given function, see :meth:`cached`.
+        If the fields of the values of the resulting rows are given, the rows
+        are cached with :func:`cache.dump_rows`.
+        """
+        key = self.__cache_key(names, *args)
+        if key is None:
+            return func()
+        result = cache.get_cache().get(key)
+        if result is None:
+            result = func()
+            entry = result if fields is None else cache.dump_rows(result)
+            cache.get_cache().set(key, entry, self.__ttl)
+        elif fields is not None:
+            result = cache.load_rows(result, fields)
+        return result
+
+    def exists(self):
+        """Check whether the query matches any record, without fetching the
+        records or counting all of them.
+
+        :returns: True or False
+        """
+        return self.__qset.exists()
+
+    def group_by(self, *names):
+        """Group the records by the given fields for :meth:`aggregate`.
+
+        >>> Revision.all().group_by('page').aggregate(edits=db.Count())
+        [{'page': <Page ...>, 'edits': 12}, ...]
+
+        The names can be dotted names (see :meth:`filter`).
+
+        :param names: sequence of field names
+
+        :returns: a new instance of :class:`Query`
+        :raises: :class:`AttributeError` if any of the fields doesn't exist
+        """
+        for name in names:
+            _resolve(self.__model, name)
+        query = deepcopy(self)
+        query.__group_by = names
+        return query
+
+    def aggregate(self, **kw):
+        """Compute the given aggregates over the matched records by the database
+        without loading the records.
+
+        >>> Order.all().filter('date >=', start).aggregate(
+        ...     total=db.Sum('amount'), latest=db.Max('date'))
+        {'total': Decimal('1240.00'), 'latest': datetime.date(2010, 6, 30)}
+
+        If the query is grouped (see :meth:`group_by`) a list of dicts is
+        returned, one for each group, having the values of the group fields
+        as well. The groups are ordered by the group fields.
+
+        :keyword kw: aliases mapping to the instances of :class:`Sum`,
+                     :class:`Avg`, :class:`Min`, :class:`Max` or :class:`Count`
+
+        :returns: a dict or a list of dicts
+        :raises:
+            - :class:`TypeError` if a value is not an aggregate
+            - :class:`AttributeError` if any of the fields doesn't exist
+        """
+        aliases = sorted(kw)
+        for alias in aliases:
+            if not isinstance(kw[alias], Aggregate):
+                raise TypeError(_('Expected an aggregate for %(name)r', name=alias))
+            _resolve(self.__model, kw[alias].name)
+
+        group_by = self.__group_by
+        aggregates = [kw[alias] for alias in aliases]
+        func = lambda: self.__qset.aggregate(group_by, aggregates)
+        if self.__cached:
+            fields = [_resolve(self.__model, name) for name in group_by]
+            fields.extend([a.typed and _resolve(self.__model, a.name) or None
+                           for a in aggregates])
+            rows = self.__remember([a.name for a in aggregates] + list(group_by),
+                                   ('aggregate', group_by, aggregates), func, fields)
+        else:
+            rows = func()
+
+        names = tuple(group_by) + tuple(aliases)
+        result = [dict(zip(names, row)) for row in rows]
+        if not group_by:
+            return result[0] if result else dict.fromkeys(aliases)
+        return result
 
     def delete(self):
         """Delete all records matched by this query.
@@ -246,9 +1212,21 @@ class Query(object):
         >>> Query(User).filter('name =', 'some%').delete()
 
         will delete all the User records by matching name starting with 'some'.
+
+        The records are deleted with a single statement without loading them,
+        unless the model overrides :meth:`Model.delete`, in which case every
+        matched instance is loaded and deleted one by one so that the overridden
+        method is called.
+
+        :returns: number of records deleted
         """
-        for obj in self.fetch(-1):
-            obj.delete()
+        if _overrides(self.__model, 'delete'):
+            result = self.fetch(-1)
+            for obj in result:
+                obj.delete()
+            return len(result)
+        self.__discard()
+        return self.__qset.delete()
 
     def update(self, **kw):
         """Update all the matched records with the given keywords mapping to
@@ -261,13 +1239,43 @@ class Query(object):
         will update all the User records by matching name starting with 'some'
         by updating `lang` to `en_EN`.
 
+        The records are updated with a single statement without loading them,
+        unless the model overrides :meth:`Model.save`, in which case every
+        matched instance is loaded and saved one by one so that the overridden
+        method is called.
+
         :keyword kw: keyword args mapping to the field properties
+
+        :returns: number of records updated
+        """
+        if _overrides(self.__model, 'save'):
+            result = self.fetch(-1)
+            for obj in result:
+                for k, v in kw.items():
+                    if k in obj._meta.fields:
+                        setattr(obj, k, v)
+                obj.save()
+            return len(result)
+
+        # validate the values against a scratch instance
+        obj = self.__model()
+        obj._dirty = {}
+        for k, v in kw.items():
+            if k in obj._meta.fields:
+                setattr(obj, k, v)
+        values = dict([(k, obj._values[k]) for k in obj._dirty])
+        if not values:
+            return 0
+        self.__discard()
+        return self.__qset.update(values)
+
+    def __discard(self):
+        """Remove the instances of the model of this query from the session
+        as they might be changed by a bulk statement.
         """
-        for obj in self.fetch(-1):
-            for k, v in kw.items():
-                if k in obj._meta.fields:
-                    setattr(obj, k, v)
-            obj.save()
+        session = current_session()
+        if session is not None:
+            session.discard(self.__model)
 
     def __getitem__(self, arg):
         if isinstance(arg, (int, long)):
@@ -281,18 +1289,113 @@ class Query(object):
                 _('Only integer indices are supported.'))
 
     def __iter__(self):
-        offset = -1
-        try:
-            while True:
-                offset += 1
-                yield self.fetch(1, offset)[0]
-        except Exception:
-            pass
+        return self.iterate()
 
     def __deepcopy__(self, meta):
         q = Query(self.__model, self.__mapper)
         q.__qset = deepcopy(self.__qset, meta)
+        q.__prefetch = self.__prefetch
+        q.__cached = self.__cached
+        q.__ttl = self.__ttl
+        q.__group_by = self.__group_by
+        q.__reverse = self.__reverse
+        q.__values = self.__values
         return q
 
     def __repr__(self):
         return repr(self.__qset)
+
+
+class Paginator(object):
+    """Paginate the records of an ordered query. The pages are fetched with
+    :meth:`Query.after` and :meth:`Query.before` from the records at the page
+    boundaries, instead of skipping the records of the preceding pages with
+    an offset, so that any page is as fast as the first one.
+
+    >>> q = Revision.all().order('-timestamp')
+    >>> page = Paginator(q, 20, after=request.args.get('after'),
+    ...                  before=request.args.get('before'))
+    >>> for rev in page.entries:
+    ...     print rev.title
+    >>> if page.has_next:
+    ...     print url_for('changes', after=page.next_cursor)
+
+    The total number of records is cached for `count_ttl` seconds (see
+    :meth:`Query.cached`).
+
+    :param query: an instance of :class:`Query`
+    :param per_page: number of records per page
+    :param after: cursor of the record preceding the page
+    :param before: cursor of the record following the page
+    :param count_ttl: seconds to cache the total number of records
+    """
+
+    def __init__(self, query, per_page=20, after=None, before=None, count_ttl=300):
+        self.query = query
+        self.per_page = per_page
+        self.after = after
+        self.before = before
+        self.count_ttl = count_ttl
+        self.__entries = None
+        self.__previous = self.__next = False
+
+    def __fetch(self):
+        if self.__entries is not None:
+            return
+        if self.before is not None:
+            entries = self.query.before(self.before).fetch(self.per_page + 1)
+            more = len(entries) > self.per_page
+            self.__previous, self.__next = more, True
+            self.__entries = entries[1:] if more else entries
+        else:
+            entries = self.query.after(self.after).fetch(self.per_page + 1)
+            more = len(entries) > self.per_page
+            self.__previous, self.__next = self.after is not None, more
+            self.__entries = entries[:self.per_page]
+
+    @property
+    def entries(self):
+        """The records of the page.
+        """
+        self.__fetch()
+        return self.__entries
+
+    @property
+    def has_previous(self):
+        self.__fetch()
+        return self.__previous and bool(self.__entries)
+
+    @property
+    def has_next(self):
+        self.__fetch()
+        return self.__next and bool(self.__entries)
+
+    @property
+    def previous_cursor(self):
+        """The cursor of the previous page to be used as `before`, None if
+        this is the first page.
+        """
+        if self.has_previous:
+            return self.query.cursor(self.__entries[0])
+        return None
+
+    @property
+    def next_cursor(self):
+        """The cursor of the next page to be used as `after`, None if this is
+        the last page.
+        """
+        if self.has_next:
+            return self.query.cursor(self.__entries[-1])
+        return None
+
+    @property
+    def count(self):
+        """The total number of records.
+        """
+        return self.query.cached(self.count_ttl).count()
+
+    @property
+    def pages(self):
+        """The total number of pages.
+        """
+        return max(0, self.count - 1) // self.per_page + 1
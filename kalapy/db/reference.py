@@ -16,6 +16,23 @@ from kalapy.db.model import ModelType, Model
 __all__ = ('ManyToOne', 'OneToOne', 'OneToMany', 'ManyToMany')
 
 
+#: maximum number of keys to be used in a single `in` filter
+IN_BATCH_SIZE = 500
+
+
+def _get_many(model, keys, name='key'):
+    """Fetch all the instances of the given model whose field, given by name,
+    matches any of the given keys. The records are fetched in batches of
+    :data:`IN_BATCH_SIZE` keys.
+    """
+    result = []
+    keys = list(keys)
+    for i in range(0, len(keys), IN_BATCH_SIZE):
+        result.extend(model.all().filter('%s in' % name,
+                                         keys[i:i+IN_BATCH_SIZE]).fetch(-1))
+    return result
+
+
 class IRelation(Field):
     """This class defines an interface method prepare which will called
     once all defined models are loaded. So the field would have chance
@@ -47,6 +64,16 @@ class IRelation(Field):
         """
         pass
 
+    def prefetch(self, instances):
+        """Load the related instances of all the given model instances at once,
+        so that accessing this field on them doesn't query the database.
+
+        :param instances: list of instances of the model this field belongs to
+
+        :returns: list of the related instances
+        """
+        raise NotImplementedError
+
     @property
     def reference(self):
         """Returns the reference class.
@@ -151,9 +178,21 @@ class ManyToOne(IRelation):
         if value is None:
             return value
         if not isinstance(value, self.reference):
-            return self.reference.get(value)
+            # don't query the database until the instance is accessed
+            return self.reference._from_key(value)
         return value
 
+    def prefetch(self, instances):
+        values = [o._values.get(self.name) for o in instances]
+        values = [v for v in values if v is not None]
+        lazy = [v for v in values if v._deferred and not v._values]
+        if lazy:
+            loaded = dict([(o.key, o) for o in
+                    _get_many(self.reference, [v.key for v in lazy])])
+            for obj in lazy:
+                obj._merge(loaded.get(obj.key))
+        return values
+
 
 class OneToOne(ManyToOne):
     """OneToOne is basically ManyToOne with unique constraint.
@@ -245,6 +284,17 @@ class O2ORel(IRelation):
     def prepare(self, model_class):
         pass
 
+    def prefetch(self, instances):
+        instances = [o for o in instances if o.is_saved]
+        related = _get_many(self.reference, [o.key for o in instances],
+                            self.reverse_name)
+        result = dict([(o._values[self.reverse_name].key, o) for o in related])
+        for obj in instances:
+            value = obj._values[self.name] = result.get(obj.key)
+            if value is not None:
+                value._values[self.reverse_name] = obj
+        return related
+
 
 class O2MSet(object):
     """A descriptor class to access OneToMany fields.
@@ -272,12 +322,22 @@ class O2MSet(object):
         return self.__ref.all().filter('%s ==' % (self.__field.reverse_name),
                 self.__obj.key)
 
+    def __iter__(self):
+        """Iterate over the related objects, uses the objects loaded with
+        :meth:`Query.prefetch` if available.
+        """
+        try:
+            return iter(self.__obj._values[self.__field.name])
+        except KeyError:
+            return iter(self.all())
+
     def add(self, *objs):
         """Add new instances to the reference set.
 
         :raises:
             TypeError: if any given object is not an instance of referenced model
         """
+        self.__obj._values.pop(self.__field.name, None)
         for obj in self.__check(*objs):
             setattr(obj, self.__field.reverse_name, self.__obj)
             obj.save()
@@ -295,6 +355,7 @@ class O2MSet(object):
                     name=self.__field.name))
 
         self.__check(*objs)
+        self.__obj._values.pop(self.__field.name, None)
 
         from kalapy.db.engines import database
         database.delete_records(*objs)
@@ -309,20 +370,14 @@ class O2MSet(object):
         if not self.__obj.is_saved:
             return
 
+        self.__obj._values.pop(self.__field.name, None)
+
         if self.__ref_field.is_required:
             raise FieldError(
                 _("objects can't be removed from %(name)r, delete the objects instead.",
                     name=self.__field.name))
 
-        from kalapy.db.engines import database
-
-        # instead of removing records at once remove them in bunches
-        l = 100
-        q = self.all()
-        result = q.fetch(l)
-        while result:
-            database.delete_records(*result)
-            result = q.fetch(l)
+        self.all().delete()
 
 
 class M2MSet(object):
@@ -352,14 +407,20 @@ class M2MSet(object):
         """Returns a :class:`Query` object pre-filtered to return related objects.
         """
         self.__check()
-        #XXX: think about a better solution
-        # Use nested SELECT or JOIN, but some backends might not support that
+
         keys = self.__m2m.select(self.__field.target) \
-                         .filter(self.__source_eq, self.__obj.key) \
-                         .fetch(-1)
-        keys = [o.key for o in keys]
+                         .filter(self.__source_eq, self.__obj.key)
         return self.__ref.all().filter('key in', keys)
 
+    def __iter__(self):
+        """Iterate over the related objects, uses the objects loaded with
+        :meth:`Query.prefetch` if available.
+        """
+        try:
+            return iter(self.__obj._values[self.__field.name])
+        except KeyError:
+            return iter(self.all())
+
     def add(self, *objs):
         """Add new instances to the reference set.
 
@@ -367,11 +428,14 @@ class M2MSet(object):
             - `TypeError`: if any given object is not an instance of referenced model
             - `ValueError`: if any of the given object is not saved
         """
+        self.__obj._values.pop(self.__field.name, None)
         keys = [obj.key for obj in self.__check(*objs) if obj.key]
 
         if keys:
+            # read only the links to the given instances
             existing = self.__m2m.select(self.__field.target) \
                                  .filter(self.__source_eq, self.__obj.key) \
+                                 .filter(self.__target_in, keys) \
                                  .fetch(-1)
             existing = [o.key for o in existing]
             objs = [o for o in objs if o.key not in existing]
@@ -391,6 +455,7 @@ class M2MSet(object):
             - `TypeError`: if any given object is not an instance of referenced model
         """
         self.__check(*objs)
+        self.__obj._values.pop(self.__field.name, None)
 
         from kalapy.db.engines import database
         database.delete_records(*objs)
@@ -401,6 +466,8 @@ class M2MSet(object):
         if not self.__obj.is_saved:
             return
 
+        self.__obj._values.pop(self.__field.name, None)
+
         from kalapy.db.engines import database
 
         # instead of removing records at once remove them in bunches
@@ -472,6 +539,19 @@ class OneToMany(IRelation):
             return self
         return O2MSet(self, model_instance)
 
+    def prefetch(self, instances):
+        instances = [o for o in instances if o.is_saved]
+        related = _get_many(self.reference, [o.key for o in instances],
+                            self.reverse_name)
+        result = {}
+        for obj in related:
+            result.setdefault(obj._values[self.reverse_name].key, []).append(obj)
+        for obj in instances:
+            obj._values[self.name] = items = result.get(obj.key, [])
+            for item in items:
+                item._values[self.reverse_name] = obj
+        return related
+
     def __set__(self, model_instance, value):
         raise ValueError(
             _('Field %(name)r is readonly.', name=self.name))
@@ -575,6 +655,21 @@ class ManyToMany(IRelation):
 
         return M2MSet(self, model_instance)
 
+    def prefetch(self, instances):
+        instances = [o for o in instances if o.is_saved]
+        links = _get_many(self.m2m, [o.key for o in instances], self.source)
+        targets = _get_many(self.reference,
+                list(set([o._values[self.target].key for o in links])))
+        targets = dict([(o.key, o) for o in targets])
+        result = {}
+        for link in links:
+            target = targets.get(link._values[self.target].key)
+            if target is not None:
+                result.setdefault(link._values[self.source].key, []).append(target)
+        for obj in instances:
+            obj._values[self.name] = result.get(obj.key, [])
+        return targets.values()
+
     def __set__(self, model_instance, value):
         raise ValueError(
             _('Field %(name)r is readonly.', name=self.name))
@@ -0,0 +1,248 @@
+"""
+kalapy.db.session
+~~~~~~~~~~~~~~~~~
+
+This module implements the database session, an identity map of the model
+instances loaded from the database, which optionally works as a unit of work
+writing all the changes at once.
+
+:copyright: (c) 2010 Amit Mendapara.
+:license: BSD, see LICENSE for more details.
+"""
+from werkzeug.local import Local
+
+from kalapy.conf import settings
+
+
+__all__ = ('Session', 'session')
+
+
+def _rank(model, ranks):
+    """Returns the position of the given model in the dependency order, models
+    referenced by other models come first.
+    """
+    name = model._meta.name
+    if name not in ranks:
+        ranks[name] = 0 # guards against circular references
+        refs = [m for m in model._meta.ref_models if m is not model]
+        ranks[name] = max([_rank(m, ranks) + 1 for m in refs] or [0])
+    return ranks[name]
+
+
+class Session(object):
+    """A session keeps track of the model instances loaded from the database,
+    so that a record is represented by a single instance as long as the
+    session is active. Instances requested by key are returned from the
+    session without querying the database and records loaded again reuse the
+    existing instances.
+
+    A session is activated with the ``with`` statement:
+
+    >>> with db.session():
+    ...     page = Page.get(1)
+    ...     assert Page.get(1) is page
+
+    If the ``DATABASE_IDENTITY_MAP`` setting is True, every connection context
+    (usually a request) has an implicit session.
+
+    A session in unit of work mode defers the writes. :meth:`Model.save` and
+    :meth:`Model.delete` only register the instances, which are written by
+    :meth:`flush` with a few batched statements, when the changes are
+    committed or the ``with`` block ends without an error:
+
+    >>> with db.session(unit_of_work=True):
+    ...     page = Page(name='Home')
+    ...     page.save()
+    ...     Revision(page=page, text='Hello!').save()
+    ...     db.commit()
+
+    If the ``DATABASE_UNIT_OF_WORK`` setting is True, every connection context
+    has an implicit session in unit of work mode.
+
+    The session is cleared when the changes are committed or rolled back and
+    when the connection is closed, the pending changes are discarded on
+    rollback.
+
+    :param unit_of_work: whether to defer the writes, defaults to the
+                         ``DATABASE_UNIT_OF_WORK`` setting
+    """
+
+    def __init__(self, unit_of_work=None):
+        if unit_of_work is None:
+            unit_of_work = settings.DATABASE_UNIT_OF_WORK
+        self.unit_of_work = unit_of_work
+        self.identity = {}
+        self.pending = []
+        self.deleted = []
+
+    def get(self, model, key):
+        """Get the registered instance of the given model with the given key.
+
+        :returns: a model instance or None
+        """
+        return self.identity.get((model._meta.name, key))
+
+    def add(self, obj):
+        """Register the given instance if it's saved and there is no instance
+        registered for the same record yet.
+        """
+        if obj.is_saved:
+            self.identity.setdefault((obj._meta.name, obj.key), obj)
+
+    def merge(self, obj):
+        """Register the given instance loaded from the database. If another
+        instance of the same record is already registered, its values not
+        loaded yet are updated with the values of the given instance.
+
+        :returns: the registered instance
+        """
+        existing = self.identity.setdefault((obj._meta.name, obj.key), obj)
+        if existing is not obj and existing._deferred:
+            existing._merge(obj)
+        return existing
+
+    def remove(self, obj):
+        """Remove the given instance from the session.
+        """
+        if self.identity.get((obj._meta.name, obj.key)) is obj:
+            del self.identity[(obj._meta.name, obj.key)]
+
+    def discard(self, model):
+        """Remove all the instances of the given model from the session.
+        """
+        name = model._meta.name
+        for k in [k for k in self.identity if k[0] == name]:
+            del self.identity[k]
+
+    def save(self, obj):
+        """Register the given instance to be written by the next :meth:`flush`.
+        """
+        if obj not in self.pending:
+            self.pending.append(obj)
+
+    def delete(self, obj):
+        """Register the given instance to be deleted by the next :meth:`flush`.
+        An instance not saved yet is just not written.
+        """
+        self.remove(obj)
+        if obj in self.pending:
+            self.pending.remove(obj)
+        if obj.is_saved and obj not in self.deleted:
+            self.deleted.append(obj)
+
+    def flush(self):
+        """Write all the pending changes to the database. The dirty instances,
+        including the dirty instances referenced by them, are ordered by the
+        dependencies of their models and written with batched INSERT and
+        UPDATE statements per model. The deleted instances are then deleted
+        with a single statement per model, the referring models first.
+        """
+        from kalapy.db.engines import database
+
+        pending, self.pending = self.pending, []
+        deleted, self.deleted = self.deleted, []
+
+        objects = []
+        seen = set()
+        def collect(obj):
+            if id(obj) in seen:
+                return
+            seen.add(id(obj))
+            for ref in obj._get_related():
+                collect(ref)
+            if obj.is_dirty or not obj.is_saved:
+                objects.append(obj)
+        map(collect, pending)
+
+        ranks = {}
+        if objects:
+            objects.sort(key=lambda obj: _rank(obj.__class__, ranks))
+            database.update_records(*objects)
+            map(self.add, objects)
+
+        groups = {}
+        for obj in deleted:
+            groups.setdefault(obj.__class__, []).append(obj)
+        models = groups.keys()
+        models.sort(key=lambda model: _rank(model, ranks), reverse=True)
+        for model in models:
+            database.delete_records(*groups[model])
+
+    def clear(self):
+        """Remove all the instances from the session and discard the pending
+        changes.
+        """
+        self.identity.clear()
+        self.pending = []
+        self.deleted = []
+
+    def __enter__(self):
+        _stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, *args):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            _stack().pop()
+            self.clear()
+
+
+_local = Local()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def session(unit_of_work=None):
+    """Create a new :class:`Session`, to be used with the ``with`` statement.
+
+    :param unit_of_work: whether to defer the writes till the changes are
+                         committed, see :class:`Session`
+    """
+    return Session(unit_of_work)
+
+
+def current_session():
+    """Returns the active session, None if there is no active session.
+    """
+    stack = _stack()
+    if stack:
+        return stack[-1]
+    if settings.DATABASE_IDENTITY_MAP or settings.DATABASE_UNIT_OF_WORK:
+        try:
+            return _local.implicit
+        except AttributeError:
+            _local.implicit = Session()
+            return _local.implicit
+    return None
+
+
+def flush_sessions():
+    """Write the pending changes of all the sessions of the current context,
+    the outer sessions first.
+    """
+    implicit = getattr(_local, 'implicit', None)
+    for s in ([implicit] if implicit else []) + _stack():
+        if s.pending or s.deleted:
+            s.flush()
+
+
+def clear_sessions(release=False):
+    """Clear all the sessions of the current context.
+
+    :param release: whether to drop the implicit session as well
+    """
+    for s in _stack():
+        s.clear()
+    implicit = getattr(_local, 'implicit', None)
+    if implicit is not None:
+        implicit.clear()
+        if release:
+            del _local.implicit
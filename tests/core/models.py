@@ -17,7 +17,7 @@ class UserDOB(User):
         return super(UserDOB, self).do_something() + 1
 
 class UserNotes(UserDOB):
-    notes = db.Text()
+    notes = db.Text(deferred=True)
 
     def do_something(self):
         return super(UserNotes, self).do_something() + 1
@@ -40,6 +40,8 @@ class Group(db.Model):
     parent = db.ManyToOne('Group', reverse_name='subgroups')
     members = db.ManyToMany(User, reverse_name='groups')
 
+    __cache__ = dict(ttl=300)
+
 class Account(db.Model):
     create_date = db.DateTime(default_now=True)
     expire_date = db.DateTime()
@@ -58,6 +60,14 @@ class Comment(db.Model):
     author = db.ManyToOne(User)
     parent = db.ManyToOne('Comment', reverse_name='children')
 
+    __indexes__ = [('article', '-pub_date')]
+
+class Note(db.Model):
+    text = db.String(size=100)
+    author = db.ManyToOne(User)
+
+    __shard__ = 'author'
+
 class UniqueTest(db.Model):
     a = db.String()
     b = db.String()
@@ -73,6 +83,8 @@ class FieldType(db.Model):
     float_value = db.Float()
     decimal_value = db.Decimal(max_digits=9, decimal_places=3)
     text_value = db.Text()
+    int_value = db.Integer(default=1)
+    update_date = db.DateTime(auto_now=True)
 
 class Cascade(db.Model):
     user1 = db.ManyToOne(User, cascade=True)
@@ -1,5 +1,13 @@
+from __future__ import with_statement
+
+import decimal
+import datetime
+from StringIO import StringIO
+
 from kalapy.conf import settings
+from kalapy.db import Q
 from kalapy.db.engines import database
+from kalapy.db.engines.pool import ConnectionPool
 from kalapy.test import TestCase
 
 from core.models import *
@@ -27,6 +35,26 @@ class DBTest(TestCase):
         self.assertFalse(database.exists_table(Comment))
         database.create_table(Comment)
 
+    def test_indexes(self):
+        if settings.DATABASE_ENGINE == "gae":
+            return
+        indexes = dict(database.get_indexes(Comment))
+        self.assertEqual(indexes['core_comment_article_pub_date_idx'],
+                [('article', False), ('pub_date', True)])
+        self.assertEqual(indexes['core_comment_author_idx'], [('author', False)])
+        # covered by the declared index
+        self.assertFalse('core_comment_article_idx' in indexes)
+
+        for name in indexes:
+            self.assertTrue(database.exists_index(Comment, name))
+        self.assertTrue('CREATE INDEX' in database.schema_table(Comment))
+
+        # missing indexes of existing tables are created
+        database.cursor().execute('DROP INDEX "core_comment_author_idx"')
+        self.assertFalse(database.exists_index(Comment, 'core_comment_author_idx'))
+        database.create_table(Comment)
+        self.assertTrue(database.exists_index(Comment, 'core_comment_author_idx'))
+
     def test_alter_table(self):
         if settings.DATABASE_ENGINE == "gae":
             return
@@ -85,6 +113,30 @@ class DBTest(TestCase):
         res = Article.all().count()
         self.assertTrue(res == 2)
 
+    def test_prepare(self):
+        if settings.DATABASE_ENGINE != 'postgresql':
+            return
+        from kalapy.db.engines import create_database
+        from kalapy.db.engines.postgresql._database import _numbered
+
+        self.assertEqual(_numbered('"a" = %s AND "b" LIKE %s -- 100%%'),
+                         ('"a" = $1 AND "b" LIKE $2 -- 100%', 2))
+
+        pg = create_database().connect()
+        try:
+            pg.prepare_threshold = 2
+            qset = User.all().filter('name ==', 'x')._subquery()[0]
+            for i in range(3):
+                self.assertEqual(pg.count(qset), 0)
+            self.assertEqual(len(pg.prepared), 1)
+
+            pg.server_cursors = True
+            cursor = pg.select(qset, -1, 0)
+            self.assertTrue(cursor.name)
+            self.assertEqual(cursor.fetchall(), [])
+        finally:
+            pg.close()
+
 
 class ModelTest(TestCase):
 
@@ -136,6 +188,100 @@ class ModelTest(TestCase):
                                    u2.address_set.all().fetch(1, 1)[0].key)
 
 
+    def test_model_bulk_save(self):
+        users = [User(name='bulk%d' % i) for i in range(5)]
+        articles = [Article(title='bulk%d' % i, author=u) for i, u in enumerate(users)]
+
+        keys = Article.bulk_save(articles)
+
+        self.assertEqual(keys, [a.key for a in articles])
+        self.assertEqual(len(set(keys)), 5)
+        for a in articles:
+            self.assertEqual(Article.get(a.key).title, a.title)
+            self.assertEqual(Article.get(a.key).author.key, a.author.key)
+
+        articles[0].title = 'changed0'
+        articles[1].title = 'changed1'
+        articles[2].text = 'text'
+        Article.bulk_save(articles)
+
+        self.assertEqual(Article.get(articles[1].key).title, 'changed1')
+        self.assertEqual(Article.get(articles[2].key).text, 'text')
+        self.assertFalse([a for a in articles if a.is_dirty])
+
+    def test_insert_records(self):
+        # the keys of a multi-row INSERT, read with RETURNING on PostgreSQL
+        if not hasattr(database, 'insert_records'):
+            return
+        rows = [['insert%02d' % i, ('en_EN', 'fr_FR')[i % 2]] for i in range(25)]
+        keys = database.insert_records(database.cursor(), User, ['name', 'lang'], rows)
+        self.assertEqual(len(set(keys)), 25)
+        users = dict([(u.key, u) for u in User.get(keys)])
+        self.assertEqual([[users[k].name, users[k].lang] for k in keys], rows)
+
+    def test_model_bulk_load(self):
+        count = User.bulk_load([{'name': 'load1', 'lang': 'en_EN'},
+                                {'name': 'load2'}], batch_size=1)
+        self.assertEqual(count, 2)
+        self.assertEqual(User.bulk_load(iter([('load3', 'fr_FR')]),
+                                        names=('name', 'lang')), 1)
+        names = [u.name for u in User.all().filter('name in', ['load1', 'load2', 'load3'])
+                                           .order('name')]
+        self.assertEqual(names, ['load1', 'load2', 'load3'])
+
+        u = User.all().filter('name ==', 'load2').fetchone()
+        Article.bulk_load([(u.key, 'loaded')], names=('author', 'title'))
+        a = Article.all().filter('title ==', 'loaded').fetchone()
+        self.assertEqual(a.author.key, u.key)
+        self.assertTrue(a.pub_date is not None)
+
+        self.assertRaises(db.ValidationError, User.bulk_load, [{'lang': 'en_EN'}])
+        self.assertRaises(db.ValidationError, User.bulk_load, [{'name': 'x', 'lang': 'xx'}])
+        self.assertRaises(AttributeError, User.bulk_load, [('x',)], names=('nick',))
+
+    def test_model_bulk_load_restore(self):
+        obj = FieldType(text_value='restored')
+        obj.int_value = None
+        obj.save()
+
+        names = ('key', 'int_value', 'update_date', 'text_value')
+        q = FieldType.all().filter('key ==', obj.key).values_list(*names)
+        row = q.fetchone()
+        self.assertEqual(row[1], None)
+        self.assertTrue(row[2] is not None)
+
+        FieldType.all().filter('key ==', obj.key).delete()
+        self.assertEqual(FieldType.bulk_load([row], names, restore=True), 1)
+        self.assertEqual(q.fetchone(), row)
+
+        # the default and the current time are used otherwise
+        FieldType.all().filter('key ==', obj.key).delete()
+        FieldType.bulk_load([row], names)
+        self.assertEqual(q.fetchone()[1], 1)
+        self.assertNotEqual(q.fetchone()[2], row[2])
+
+    def test_dump_load(self):
+        from kalapy.admin.commands.db import write_rows, read_rows, decode_rows
+
+        obj = FieldType(float_value=0.5, decimal_value=decimal.Decimal('1.250'),
+                        text_value='')
+        obj.int_value = None
+        obj.save()
+
+        names = [n for n, f in FieldType.fields().items() if f.data_type is not None]
+        q = FieldType.all().filter('key ==', obj.key).values_list(*names)
+        row = q.fetchone()
+        self.assertEqual(row[names.index('decimal_value')], decimal.Decimal('1.250'))
+
+        for path in ('fieldtype.json', 'fieldtype.csv'):
+            target = StringIO()
+            self.assertEqual(write_rows(target, path, FieldType), 1)
+            FieldType.all().delete()
+            header, rows = read_rows(StringIO(target.getvalue()), path)
+            rows = decode_rows(FieldType, header or names, rows)
+            FieldType.bulk_load(rows, header or names, restore=True)
+            self.assertEqual(q.fetchone(), row)
+
     def test_model_delete(self):
         u1 = User(name="some2")
         k1 = u1.save()
@@ -175,6 +321,122 @@ class ModelTest(TestCase):
         names = User.select('name').filter('name ==', u1.name).fetch(-1)
         self.assertTrue(names[0] == u1.name)
 
+    def test_model_cache(self):
+        from kalapy.db import cache
+
+        g = Group(name='cached')
+        g.save()
+        # the records changed by the transaction are not cached before it ends
+        self.assertEqual(Group.get(g.key).name, 'cached')
+        self.assertFalse(cache.get_many(Group, [g.key]))
+        database.commit()
+        try:
+            g1 = Group.get(g.key)
+            g2 = Group.get(g.key)
+            self.assertFalse(g1 is g2)
+            self.assertEqual(g2.name, 'cached')
+            self.assertTrue(cache.get_many(Group, [g.key]))
+
+            g2.name = 'cached2'
+            g2.save()
+            self.assertFalse(cache.get_many(Group, [g.key]))
+            self.assertEqual(Group.get(g.key).name, 'cached2')
+            self.assertEqual(Group.all().filter('name ==', 'cached2').fetchone().key, g.key)
+            self.assertEqual(cache.get_key(Group, 'name', 'cached2'), None)
+            database.commit()
+
+            g3 = Group.all().filter('name ==', 'cached2').fetchone()
+            self.assertEqual(g3.key, g.key)
+            self.assertEqual(cache.get_key(Group, 'name', 'cached2'), g.key)
+
+            Group.all().filter('name ==', 'cached2').update(name='cached3')
+            self.assertEqual(cache.get_key(Group, 'name', 'cached2'), None)
+            self.assertEqual(Group.get(g.key).name, 'cached3')
+        finally:
+            Group.all().filter('key ==', g.key).delete()
+            database.commit()
+
+    def test_model_cache_commit(self):
+        from kalapy.db import cache
+
+        g = Group(name='committed')
+        g.save()
+        database.commit()
+        try:
+            stale = cache.dump(Group.get(g.key))
+
+            g.name = 'committed2'
+            g.save()
+            self.assertFalse(cache.get_many(Group, [g.key]))
+
+            # another connection caches the committed record before the commit
+            entry = cache._entry_key(Group, cache._version(Group), g.key)
+            cache.get_cache().set(entry, stale[1:])
+            self.assertEqual(Group.get(g.key).name, 'committed2')
+
+            database.commit()
+            self.assertFalse(cache.get_many(Group, [g.key]))
+            self.assertEqual(Group.get(g.key).name, 'committed2')
+        finally:
+            Group.all().filter('key ==', g.key).delete()
+            database.commit()
+
+    def test_session(self):
+        u = User(name='a')
+        u.save()
+        a = Article(title='t', author=u)
+        a.save()
+
+        with db.session() as session:
+            u1 = User.get(u.key)
+            self.assertTrue(User.get(u.key) is u1)
+            self.assertTrue(User.get([u.key])[0] is u1)
+            self.assertTrue(User.all().filter('key ==', u.key).fetchone() is u1)
+            self.assertTrue(Article.get(a.key).author is u1)
+
+            u2 = User(name='b')
+            u2.save()
+            self.assertTrue(User.get(u2.key) is u2)
+            key = u2.key
+            u2.delete()
+            self.assertEqual(session.get(User, key), None)
+
+        self.assertFalse(User.get(u.key) is u1)
+
+    def test_unit_of_work(self):
+        old = User(name='old')
+        old.save()
+
+        with db.session(unit_of_work=True) as session:
+            u = User(name='uow')
+            a = Article(title='t1', author=u)
+            c = Comment(title='c1', article=a, author=u)
+            self.assertEqual(c.save(), None)
+            Article(title='t2', author=u).save()
+            old.delete()
+            self.assertTrue(old.is_saved)
+            self.assertEqual(User.all().filter('name ==', 'uow').count(), 0)
+
+            session.flush()
+            self.assertTrue(u.is_saved and a.is_saved and c.is_saved)
+            self.assertFalse(old.is_saved)
+            self.assertEqual(c.article.author.key, u.key)
+            self.assertEqual(Article.all().filter('author ==', u).count(), 2)
+            self.assertEqual(User.all().filter('name ==', 'old').count(), 0)
+            self.assertTrue(User.get(u.key) is u)
+
+            c.title = 'c2'
+            c.save()
+            self.assertEqual(Comment.all().filter('title ==', 'c2').count(), 0)
+
+        self.assertEqual(Comment.all().filter('title ==', 'c2').count(), 1)
+
+        with db.session(unit_of_work=True) as session:
+            u = User(name='uow2')
+            u.save()
+            session.clear()
+        self.assertEqual(User.all().filter('name ==', 'uow2').count(), 0)
+
 
 class QueryTest(TestCase):
 
@@ -199,6 +461,363 @@ class QueryTest(TestCase):
 
         self.assertEqual(r1, r2)
 
+    def test_iterate(self):
+        User.all().delete()
+        for n in list('abcdefghij'):
+            u = User(name=n)
+            u.save()
+
+        q = User.all().order('name')
+        self.assertEqual([o.name for o in q], list('abcdefghij'))
+        self.assertEqual([o.name for o in q.iterate(3)], list('abcdefghij'))
+
+        q = User.all().filter('name in', ['b', 'd', 'f', 'h'])
+        names = [o.name for o in q.iterate(3, keyset=True)]
+        self.assertEqual(sorted(names), ['b', 'd', 'f', 'h'])
+
+        try:
+            list(User.all().order('name').iterate(3, keyset=True))
+        except ValueError:
+            pass
+        else:
+            self.fail()
+
+    def test_join(self):
+        if not database.supports_joins:
+            return
+        u1 = User(name="some")
+        u2 = User(name="thing")
+        for i, u in enumerate([u1, u2, u1]):
+            Article(title="story%d" % i, author=u).save()
+
+        q = Article.all().filter('author.name ==', 'some').order('title')
+        self.assertEqual([a.title for a in q.fetch(-1)], ['story0', 'story2'])
+        self.assertEqual(q.count(), 2)
+
+        q = Article.all().filter('title in', ['story0', 'story1', 'story2']) \
+                   .order('-author.name')
+        self.assertEqual([a.author.name for a in q.fetch(-1)][0], 'thing')
+
+        q = Article.all().filter(Q('author.name ==', 'thing') | Q('title ==', 'story0'))
+        self.assertEqual(sorted([a.title for a in q.fetch(-1)]), ['story0', 'story1'])
+
+        a = Article.all().filter('title ==', 'story1').select_related('author').fetchone()
+        assert a._values['author']._deferred == set(['notes'])
+        assert a.author.name == 'thing'
+
+        q = User.all().filter('article_set.title ==', 'story1')
+        self.assertEqual([u.name for u in q.fetch(-1)], ['thing'])
+        q = User.all().filter('article_set.title in', ['story0', 'story2'])
+        self.assertEqual([u.name for u in q.fetch(-1)], ['some'])
+        self.assertEqual(q.count(), 1)
+        q = User.all().filter('article_set.author.name ==', 'some')
+        self.assertEqual([u.name for u in q.fetch(-1)], ['some'])
+        self.assertRaises(AttributeError, User.all().order, 'article_set.title')
+
+        self.assertEqual(Article.all().filter('author.name ==', 'some').delete(), 2)
+        self.assertEqual(Article.all().filter('author.name ==', 'thing') \
+                                .update(text='some text'), 1)
+        self.assertEqual(Article.all().filter('title ==', 'story1').fetchone().text, 'some text')
+
+    def test_statement_cache(self):
+        if not hasattr(database, 'statement_cache'):
+            return
+        for n in ['a', 'b', 'c']:
+            User(name=n).save()
+
+        User.all().filter('name ==', 'a').fetch(-1)
+        info = database.statement_cache.info()
+
+        for n in ['a', 'b', 'c']:
+            res = User.all().filter('name ==', n).fetch(-1)
+            self.assertEqual([u.name for u in res], [n])
+
+        self.assertEqual(database.statement_cache.info()['hits'], info['hits'] + 3)
+        self.assertEqual(database.statement_cache.info()['misses'], info['misses'])
+
+        res = User.all().filter('name in', ['a', 'b']).order('name').fetch(1, 1)
+        self.assertEqual([u.name for u in res], ['b'])
+
+    def test_loader(self):
+        d = datetime.date(2010, 1, 1)
+        User(name='a', lang='en_EN', dob=d).save()
+
+        names = ('key', 'name', 'lang', 'dob')
+        loader = User._loader(names)
+        self.assertTrue(User._loader(names) is loader)
+
+        u = User.all().filter('name ==', 'a').fetch(1)[0]
+        self.assertTrue(isinstance(u, User._meta.model))
+        self.assertEqual((u.name, u.lang, u.dob), ('a', 'en_EN', d))
+        self.assertFalse(u.is_dirty)
+
+        u = loader((u.key, 'b', None, None))
+        self.assertEqual((u.name, u.lang, u.dob), ('b', None, None))
+
+    def test_values(self):
+        d = datetime.date(2010, 1, 1)
+        for n in ['a', 'b', 'c']:
+            User(name=n, dob=d).save()
+
+        q = User.all().filter('name in', ['a', 'b']).order('name')
+        self.assertEqual(q.values('name', 'dob').fetch(-1),
+                [{'name': 'a', 'dob': d}, {'name': 'b', 'dob': d}])
+        self.assertEqual(q.values_list('name', 'dob').fetch(1, 1), [('b', d)])
+        self.assertEqual(q.values_list('name', flat=True).fetch(-1), ['a', 'b'])
+        q1 = User.all().filter('name in', ['a', 'b']).values_list('name', flat=True)
+        self.assertEqual(list(q1.iterate(1, keyset=True)), ['a', 'b'])
+        self.assertEqual(User.select('name', 'dob').filter('name ==', 'c').fetch(-1),
+                [('c', d)])
+        g = Group(name='g')
+        g.save()
+        [(name, subgroups)] = Group.select('name', 'subgroups').fetch(-1)
+        self.assertEqual(name, 'g')
+        self.assertEqual(list(subgroups), [])
+        self.assertEqual(Group.select('key', 'name').fetch(-1), [(g.key, 'g')])
+
+        self.assertRaises(AttributeError, q.values, 'foo')
+        self.assertRaises(TypeError, q.values_list, 'name', 'dob', flat=True)
+
+    def test_cached(self):
+        u = User(name='a')
+        u.save()
+        for t in ['x', 'y']:
+            Article(title=t, author=u).save()
+        database.commit()
+        try:
+            self.check_cached(u)
+        finally:
+            Article.all().filter('author ==', u).delete()
+            User.all().filter('key ==', u.key).delete()
+            database.commit()
+
+    def check_cached(self, u):
+        from kalapy.db.query import QSet
+
+        calls = []
+        count = QSet.count
+        def counting(qset):
+            calls.append(qset)
+            return count(qset)
+        QSet.count = counting
+        try:
+            q = Article.all().filter('author.name ==', 'a').cached()
+            self.assertEqual(q.count(), 2)
+            self.assertEqual(q.count(), 2)
+            self.assertEqual(len(calls), 1)
+
+            # a write to a joined table invalidates the result, which is not
+            # cached before the transaction ends
+            u.name = 'b'
+            u.save()
+            self.assertEqual(q.count(), 0)
+            self.assertEqual(q.count(), 0)
+            self.assertEqual(len(calls), 3)
+            database.commit()
+            self.assertEqual(q.count(), 0)
+            self.assertEqual(q.count(), 0)
+            self.assertEqual(len(calls), 4)
+        finally:
+            QSet.count = count
+
+        q = Article.all().filter('author ==', u).order('title').cached(60)
+        self.assertEqual([a.title for a in q.fetch(-1)], ['x', 'y'])
+        self.assertEqual([a.title for a in q.fetch(-1)], ['x', 'y'])
+        self.assertEqual(q.values_list('title', flat=True).fetch(1), ['x'])
+        self.assertEqual(q.fetchone().author.name, 'b')
+
+        # the references are cached as keys, not as shared instances
+        v = q.values('author')
+        first, second = v.fetch(-1), v.fetch(-1)
+        self.assertFalse(first[0]['author'] is second[0]['author'])
+        self.assertEqual(second[0]['author'].name, 'b')
+        g = Article.all().filter('author ==', u).group_by('author').cached()
+        first, second = g.aggregate(n=db.Count()), g.aggregate(n=db.Count())
+        self.assertFalse(first[0]['author'] is second[0]['author'])
+        self.assertEqual((second[0]['author'].key, second[0]['n']), (u.key, 2))
+
+        Article.all().filter('title ==', 'x').delete()
+        self.assertEqual([a.title for a in q.fetch(-1)], ['y'])
+        database.commit()
+
+        # the table versions are not changed if the query cache is disabled
+        from kalapy.db import cache
+        backend = cache.get_cache()
+        writes = []
+        settings.CACHE_OPTIONS['query_cache'] = False
+        backend.set_many = lambda *args: writes.append(args)
+        try:
+            Article(title='z', author=u).save()
+            self.assertEqual(writes, [])
+            q = Article.all().filter('author ==', u).cached()
+            self.assertEqual(q.count(), 2)
+            Article.all().filter('title ==', 'z').delete()
+            self.assertEqual(q.count(), 1)
+        finally:
+            del backend.set_many
+            settings.CACHE_OPTIONS['query_cache'] = True
+
+    def test_aggregate(self):
+        import decimal
+        for f, d in [(1.5, '2.250'), (2.5, '1.125'), (None, '4.000')]:
+            FieldType(float_value=f, decimal_value=decimal.Decimal(d)).save()
+
+        q = FieldType.all()
+        self.assertTrue(q.exists())
+        self.assertFalse(q.filter('float_value >', 10.0).exists())
+
+        result = q.aggregate(total=db.Sum('decimal_value'), avg=db.Avg('float_value'),
+                             low=db.Min('decimal_value'), high=db.Max('float_value'),
+                             n=db.Count('float_value'), all=db.Count())
+        self.assertEqual(result, dict(total=decimal.Decimal('7.375'), avg=2.0,
+                                      low=decimal.Decimal('1.125'), high=2.5,
+                                      n=2, all=3))
+        self.assertEqual(q.filter('float_value >', 10.0).aggregate(
+                         total=db.Sum('float_value'))['total'], None)
+
+        u1, u2 = User(name='a'), User(name='b')
+        db.Model.bulk_save([u1, u2])
+        for t, u in [('x', u1), ('y', u1), ('z', u2)]:
+            Article(title=t, author=u).save()
+        result = Article.all().group_by('author.name').aggregate(
+                 n=db.Count(), first=db.Min('title'))
+        self.assertEqual(result, [{'author.name': 'a', 'n': 2, 'first': 'x'},
+                                  {'author.name': 'b', 'n': 1, 'first': 'z'}])
+        result = Article.all().group_by('author').aggregate(n=db.Count())
+        self.assertEqual([(r['author'].key, r['n']) for r in result],
+                         [(u1.key, 2), (u2.key, 1)])
+
+        # the fallback used by the engines without aggregate functions
+        from kalapy.db.engines.interface import IDatabase
+        from kalapy.db.query import QSet
+        result = IDatabase.aggregate.im_func(database, QSet(Article),
+                 ['author'], [db.Count(), db.Min('title')])
+        self.assertEqual([(r[0].key, r[1], r[2]) for r in result],
+                         [(u1.key, 2, 'x'), (u2.key, 1, 'z')])
+
+        self.assertRaises(TypeError, q.aggregate, total='float_value')
+        self.assertRaises(AttributeError, q.aggregate, total=db.Sum('foo'))
+
+    def test_subquery(self):
+        u1, u2, u3 = User(name='a'), User(name='b'), User(name='c')
+        db.Model.bulk_save([u1, u2, u3])
+        for t, u in [('x', u1), ('y', u1), ('z', u2)]:
+            Article(title=t, author=u).save()
+
+        authors = Article.select('author').filter('title in', ['x', 'z'])
+        q = User.all().filter('key in', authors).order('name')
+        self.assertEqual([u.name for u in q.fetch(-1)], ['a', 'b'])
+        self.assertEqual(q.count(), 2)
+        q = User.all().filter('key not in', authors).filter('name in', list('abc'))
+        self.assertEqual([u.name for u in q.fetch(-1)], ['c'])
+
+        # the keys of the records of a query
+        users = User.all().filter('name ==', 'b')
+        q = Article.all().filter('author in', users)
+        self.assertEqual([a.title for a in q.fetch(-1)], ['z'])
+        # subqueries invalidate the cached results
+        q = q.cached()
+        self.assertEqual(q.count(), 1)
+        u1.name = 'b'
+        u1.save()
+        self.assertEqual(q.count(), 3)
+
+        self.assertRaises(TypeError, User.all().filter, 'key in',
+                          Article.select('author', 'title'))
+
+    def test_order(self):
+        d1, d2 = datetime.date(2010, 1, 1), datetime.date(2010, 2, 1)
+        for n, d in [('a', d1), ('b', d2), ('c', d1), ('d', d2)]:
+            User(name=n, dob=d).save()
+        q = User.all().filter('name in', list('abcd'))
+        self.assertEqual([u.name for u in q.order('-dob', 'name').fetch(-1)],
+                         ['b', 'd', 'a', 'c'])
+        self.assertEqual([u.name for u in q.order('dob', '-name').fetch(-1)],
+                         ['c', 'a', 'd', 'b'])
+        # the order is replaced
+        self.assertEqual([u.name for u in q.order('-name').fetch(-1)],
+                         ['d', 'c', 'b', 'a'])
+        self.assertEqual(q.order('dob', 'name').count(), 4)
+        q = q.order('-dob', 'name')
+        self.assertEqual(q.after(q.cursor(q.fetchone())).count(), 3)
+
+    def test_seek(self):
+        for n in ['a', 'b', 'b', 'c', 'd']:
+            User(name=n).save()
+        q = User.all().filter('name in', list('abcd')).order('-name')
+        names = [u.name for u in q.fetch(-1)]
+        keys = [u.key for u in q.after().fetch(-1)]
+
+        first = q.after().fetch(2)
+        self.assertEqual([u.name for u in first], names[:2])
+        second = q.after(q.cursor(first[-1])).fetch(2)
+        self.assertEqual([u.key for u in second], keys[2:4])
+        self.assertEqual([u.key for u in q.before(q.cursor(second[0])).fetch(2)],
+                         keys[:2])
+        self.assertEqual([u.key for u in q.before().fetch(2)], keys[-2:])
+        self.assertEqual([u.key for u in q.before(q.cursor(second[-1]))], keys[:3])
+        self.assertEqual(list(q.before().values_list('key', flat=True)), keys)
+
+        from kalapy.db.query import _encode_cursor, _decode_cursor
+        values = (None, True, 42, 1.5, u'\xe9:x', datetime.datetime(2010, 5, 7, 11, 34, 0, 5))
+        self.assertEqual(_decode_cursor(_encode_cursor(values)), values)
+
+        self.assertRaises(ValueError, q.after, 'foo')
+        self.assertRaises(ValueError, q.after, User.all().cursor(first[0]))
+
+        page = db.Paginator(q, 2)
+        self.assertEqual([u.key for u in page.entries], keys[:2])
+        self.assertFalse(page.has_previous)
+        self.assertEqual(page.count, 5)
+        self.assertEqual(page.pages, 3)
+        page = db.Paginator(q, 2, after=page.next_cursor)
+        self.assertEqual([u.key for u in page.entries], keys[2:4])
+        page = db.Paginator(q, 2, after=page.next_cursor)
+        self.assertEqual([u.key for u in page.entries], keys[4:])
+        self.assertFalse(page.has_next)
+        page = db.Paginator(q, 2, before=page.previous_cursor)
+        self.assertEqual([u.key for u in page.entries], keys[2:4])
+        self.assertTrue(page.has_previous and page.has_next)
+
+        # paging over NULL values of the ordering field
+        for n, lang in [('n1', None), ('n2', 'en_EN'), ('n3', None), ('n4', 'fr_FR')]:
+            User(name=n, lang=lang).save()
+        for order in ('lang', '-lang'):
+            q = User.all().filter('name in', ['n1', 'n2', 'n3', 'n4']).order(order)
+            keys = [u.key for u in q.after().fetch(-1)]
+            seen = []
+            page = q.after().fetch(1)
+            while page:
+                seen.append(page[0].key)
+                page = q.after(q.cursor(page[0])).fetch(1)
+            self.assertEqual(seen, keys)
+            self.assertEqual([u.key for u in q.before(q.cursor(q.after().fetch(-1)[-1])).fetch(-1)],
+                             keys[:-1])
+
+    def test_deferred(self):
+        User(name='a', lang='en_EN', notes='notes a').save()
+        User(name='b', lang='en_EN', notes='notes b').save()
+
+        a, b = User.all().filter('name in', ['a', 'b']).order('name').fetch(-1)
+        self.assertFalse('notes' in a._values or 'notes' in b._values)
+        self.assertEqual(a.notes, 'notes a')
+        # loaded for the whole batch at once
+        self.assertTrue('notes' in b._values)
+        self.assertEqual(b.notes, 'notes b')
+
+        a = User.all().filter('name ==', 'a').only('name', 'notes').fetchone()
+        self.assertEqual(sorted(a._values), ['name', 'notes'])
+        self.assertEqual(a.lang, 'en_EN')
+
+        a = User.all().filter('name ==', 'a').defer('lang').fetchone()
+        self.assertFalse('lang' in a._values or 'notes' in a._values)
+        a.lang = 'fr_FR'
+        a.save()
+        self.assertEqual(a.notes, 'notes a')
+        self.assertEqual(User.get(a.key).lang, 'fr_FR')
+
+        self.assertRaises(AttributeError, User.all().defer, 'foo')
+
     def test_like(self):
         User.all().delete()
         for n in ['some', 'thing', 'something', 'thingsome', 'ThingSomeThing']:
@@ -235,7 +854,7 @@ class QueryTest(TestCase):
 
         n1 = User.all().count()
         q = User.all().filter('name in', ['a', 'b', 'c'])
-        q.delete()
+        self.assertEqual(q.delete(), 3)
         n2 = User.all().count()
 
         self.assertTrue(n2 == n1 - 3)
@@ -256,8 +875,8 @@ class QueryTest(TestCase):
         q1 = q.filter('name in', ['a', 'b', 'c'])
         q2 = q.filter('name in', ['d', 'e', 'f'])
 
-        q1.update(lang='en_EN')
-        q2.update(lang='fr_FR')
+        self.assertEqual(q1.update(lang='en_EN'), 3)
+        self.assertEqual(q2.update(lang='fr_FR'), 3)
 
         n1 = q.filter('lang ==', 'en_EN').count()
         n2 = q.filter('lang ==', 'fr_FR').count()
@@ -265,6 +884,13 @@ class QueryTest(TestCase):
         self.assertTrue(n1 == 3)
         self.assertTrue(n2 == 3)
 
+        try:
+            q1.update(lang='en_IN')
+        except db.ValidationError:
+            pass
+        else:
+            self.fail()
+
 
 class FieldTest(TestCase):
 
@@ -417,6 +1043,43 @@ class FieldTest(TestCase):
         assert a.title == 'story1'
         assert a.author.key == u1.key
 
+    def test_ManyToOne_lazy(self):
+        u1 = User(name="some")
+        a1 = Article(title="story1", author=u1)
+        a1.save()
+
+        a = Article.get(a1.key)
+        author = a._values['author']
+        assert isinstance(author, User) and author._deferred
+        assert author.key == u1.key
+        assert author.name == 'some'
+        assert not author._deferred
+
+    def test_prefetch(self):
+        u1 = User(name="some")
+        u2 = User(name="someone")
+        for i, u in enumerate([u1, u2, u1]):
+            Article(title="story%d" % i, author=u).save()
+
+        g1 = Group(name="g1")
+        g1.save()
+        g1.members.add(u1, u2)
+
+        articles = Article.all().filter('title in', ['story0', 'story1', 'story2']) \
+                          .prefetch('author', 'author.groups').order('title').fetch(-1)
+        for a in articles:
+            assert a._values['author']._deferred == set(['notes'])
+            assert 'groups' in a._values['author']._values
+        self.assertEqual([a.author.name for a in articles], ['some', 'someone', 'some'])
+        self.assertEqual([g.name for g in articles[0].author.groups], ['g1'])
+
+        users = User.all().filter('key in', [u1.key, u2.key]) \
+                    .prefetch('article_set').order('name').fetch(-1)
+        self.assertEqual(sorted([a.title for a in users[0].article_set]),
+                         ['story0', 'story2'])
+        self.assertEqual([a.title for a in users[1].article_set], ['story1'])
+        assert users[1].article_set.all().count() == 1
+
     def test_OneToOne(self):
         u1 = User(name="some")
         u2 = User(name="someone")
@@ -548,8 +1211,158 @@ class FieldTest(TestCase):
         val = FieldType.select('text_value').fetchone()
         assert isinstance(val, basestring)
 
+    def test_DateTime(self):
+        value = datetime.datetime(2010, 5, 16, 12, 0, 0, 1234)
+        a = Account(expire_date=str(value))
+        self.assertEqual(a.expire_date, value)
+        a.expire_date = '2010-05-16 12:00:00'
+        self.assertEqual(a.expire_date, value.replace(microsecond=0))
+        self.assertRaises(db.ValidationError, Account, expire_date='2010-05-16 12:00:00.x')
+
+
+class PoolTest(TestCase):
+
+    class FakeDatabase(object):
+
+        alive = True
+
+        def connect(self):
+            return self
+
+        def close(self):
+            self.alive = False
+
+        def rollback(self):
+            pass
 
+        def ping(self):
+            return self.alive
 
+    def test_pool(self):
+        pool = ConnectionPool(self.FakeDatabase, max_size=2, wait_timeout=0.01,
+                              error=db.DatabaseError)
 
+        a = pool.acquire()
+        b = pool.acquire()
+        self.assertEqual(pool.stats()['in_use'], 2)
+        self.assertRaises(db.DatabaseError, pool.acquire)
+        self.assertEqual(pool.stats()['timeouts'], 1)
 
+        pool.release(a)
+        self.assertEqual(pool.stats()['idle'], 1)
+        self.assertTrue(pool.acquire() is a)
 
+        # broken connections are replaced
+        pool.release(b)
+        b.alive = False
+        c = pool.acquire()
+        self.assertFalse(c is b)
+        self.assertEqual(pool.stats()['size'], 2)
+
+        pool.release(a)
+        pool.release(c)
+        pool.clear()
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+class ReplicaTest(TestCase):
+
+    def test_replica(self):
+        if settings.DATABASE_ENGINE == 'gae':
+            return
+        from kalapy.db.engines import create_database, replica_pools
+
+        pool = ConnectionPool(create_database)
+        replica_pools.append(pool)
+        database.close()
+        try:
+            self.assertFalse(database.written)
+            replica = database.reader()
+            self.assertFalse(replica is database)
+            self.assertTrue(database.reader('primary') is database)
+            self.assertRaises(ValueError, User.all().using, 'secondary')
+
+            count = User.all().count()
+            User(name='replica').save()
+            self.assertTrue(database.written)
+            self.assertTrue(database.reader() is database)
+            self.assertTrue(database.reader('replica') is replica)
+
+            # the replica doesn't see the uncommitted changes
+            self.assertEqual(User.all().count(), count + 1)
+            self.assertEqual(User.all().using('replica').count(), count)
+        finally:
+            database.close()
+            replica_pools.remove(pool)
+            pool.clear()
+            database.connect()
+
+
+class ShardTest(TestCase):
+
+    def test_shard(self):
+        # the shards are in-memory sqlite databases
+        if settings.DATABASE_ENGINE != 'sqlite3':
+            return
+        from kalapy.db.engines import create_database, router
+
+        pools = [ConnectionPool(lambda: create_database(name=':memory:'))
+                 for n in range(2)]
+        router.pools.extend(pools)
+        try:
+            database.create_table(Note)
+
+            users = [User(name='shard%d' % i) for i in range(6)]
+            User.bulk_save(users)
+            notes = [Note(text='n%02d' % i, author=users[i % 6]) for i in range(12)]
+            Note.bulk_save(notes)
+
+            # the keys are unique and tell the shard of the author
+            self.assertEqual(len(set([n.key for n in notes])), 12)
+            for n in notes:
+                self.assertEqual(router.shard_by_key(n.key),
+                                 router.shard_by_value(n.author))
+            self.assertEqual(len(set([router.shard_by_key(n.key) for n in notes])), 2)
+
+            q = Note.all().filter('author ==', users[0])
+            self.assertEqual(len(router.shards(q._subquery()[0])), 1)
+            self.assertEqual(q.count(), 2)
+            self.assertEqual(Note.get(notes[3].key).text, 'n03')
+
+            # the results of all the shards are merged
+            self.assertEqual(Note.all().count(), 12)
+            texts = [n.text for n in Note.all().order('-text').fetch(3, 1)]
+            self.assertEqual(texts, ['n10', 'n09', 'n08'])
+            self.assertEqual(Note.all().aggregate(total=db.Count()), {'total': 12})
+            self.assertRaises(TypeError, Note.all().defer('text').fetch, -1)
+            self.assertRaises(TypeError,
+                Note.all().values_list('author.name').fetch, -1)
+            self.assertRaises(TypeError,
+                Note.all().select_related('author').fetch, -1)
+
+            notes[0].delete()
+            Note.bulk_save([Note(text='n12', author=users[1])])
+            self.assertEqual(Note.all().filter('text in', ['n01', 'n02']).delete(), 2)
+            self.assertEqual(Note.all().count(), 10)
+
+            # the records can't move to another shard
+            n = Note.get(notes[4].key)
+            n.author = users[5]
+            self.assertRaises(db.ValidationError, n.save)
+            self.assertRaises(db.ValidationError,
+                Note.all().filter('key ==', n.key).update, author=users[5])
+            Note.all().filter('key ==', n.key).update(text='n04!')
+            self.assertEqual(Note.get(n.key).text, 'n04!')
+
+            # a shard can't allocate the keys of the next shard
+            i = router.shard_by_value(users[0])
+            database.shard(i).set_next_key(Note, router.first_key(i + 1))
+            self.assertRaises(db.DatabaseError, Note(author=users[0]).save)
+        finally:
+            database.rollback()
+            database.drop_table(Note)
+            database.close()
+            for pool in pools:
+                router.pools.remove(pool)
+                pool.clear()
+            database.connect()
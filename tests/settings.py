@@ -30,6 +30,17 @@ DATABASE_PORT = ""
 
 # Database specific options
 DATABASE_OPTIONS = {
+    'foreign_keys': True,
+}
+
+# Database connection pool options (min_size, max_size, idle_timeout,
+# max_lifetime, pre_ping, wait_timeout), ignored if DATABASE_ENGINE is 'gae'
+DATABASE_POOL = {
+}
+
+# Cache backend options, the query result cache is enabled for the tests
+CACHE_OPTIONS = {
+    'query_cache': True,
 }
 
 # Enable/Disable internationalization support